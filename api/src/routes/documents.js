@@ -1,5 +1,5 @@
 const express = require('express');
-const { searchDocuments, getFacets, getDocumentById } = require('../services/mongodb');
+const { searchDocuments, getFacets, getEntityFacets, getDocumentById } = require('../services/mongodb');
 const { saveSearchHistory, getUserSearchHistory } = require('../services/firestore');
 
 const router = express.Router();
@@ -7,7 +7,7 @@ const router = express.Router();
 // Buscar documentos
 router.get('/search', async (req, res) => {
   try {
-    const { q, page = 1, limit = 10 } = req.query;
+    const { q, page = 1, limit = 10, cursor } = req.query;
     const facets = {};
     
     // Extraer facets de la consulta
@@ -19,8 +19,8 @@ router.get('/search', async (req, res) => {
       }
     });
     
-    // Realizar búsqueda
-    const results = await searchDocuments(q, facets, parseInt(page), parseInt(limit));
+    // Realizar búsqueda (cursor es pagination.nextCursor de la página anterior)
+    const results = await searchDocuments(q, facets, parseInt(page), parseInt(limit), cursor || null);
     
     // Guardar búsqueda en historial si hay query
     if (q && req.user?.uid) {
@@ -45,6 +45,18 @@ router.get('/facets', async (req, res) => {
   }
 });
 
+// Entidades más frecuentes de una etiqueta; su _id sirve como filtro entities
+router.get('/facets/entities/:label', async (req, res) => {
+  try {
+    const { limit = 20 } = req.query;
+    const entities = await getEntityFacets(req.params.label, parseInt(limit));
+    res.json(entities);
+  } catch (error) {
+    console.error('Error al obtener entidades:', error);
+    res.status(500).json({ error: 'Error al obtener entidades' });
+  }
+});
+
 // Obtener documento por ID
 router.get('/:id', async (req, res) => {
   try {
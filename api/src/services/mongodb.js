@@ -1,18 +1,145 @@
 const mongoose = require('mongoose');
 const { ObjectId } = mongoose.Types;
 
-// Buscar documentos usando Atlas Search
-const searchDocuments = async (query, facets = {}, page = 1, limit = 10) => {
+// Caché en memoria de los totales y de las primeras páginas de búsqueda
+const SEARCH_CACHE_TTL_MS = parseInt(process.env.SEARCH_CACHE_TTL_MS || '60000');  // 0 = sin caché
+const SEARCH_CACHE_MAX_ENTRIES = parseInt(process.env.SEARCH_CACHE_MAX_ENTRIES || '500');
+
+// Caché LRU con expiración: un Map conserva el orden de inserción, así que
+// cada lectura vuelve a insertar la entrada y al superar el límite se
+// elimina la primera (la usada hace más tiempo)
+class TTLCache {
+  constructor(ttlMs, maxEntries) {
+    this.ttlMs = ttlMs;
+    this.maxEntries = maxEntries;
+    this.entries = new Map();
+  }
+
+  get(key) {
+    const entry = this.entries.get(key);
+    if (!entry) {
+      return undefined;
+    }
+    this.entries.delete(key);
+    if (entry.expires <= Date.now()) {
+      return undefined;
+    }
+    this.entries.set(key, entry);
+    return entry.value;
+  }
+
+  set(key, value) {
+    if (this.ttlMs <= 0 || this.maxEntries <= 0) {
+      return;
+    }
+    this.entries.delete(key);
+    this.entries.set(key, { value, expires: Date.now() + this.ttlMs });
+    while (this.entries.size > this.maxEntries) {
+      this.entries.delete(this.entries.keys().next().value);
+    }
+  }
+}
+
+const searchCache = new TTLCache(SEARCH_CACHE_TTL_MS, SEARCH_CACHE_MAX_ENTRIES);
+
+// Clave de caché de una búsqueda: consulta normalizada (Atlas Search no
+// distingue mayúsculas ni espacios repetidos) y facets con claves y valores
+// ordenados, de modo que el orden de los parámetros no cambie la clave
+const searchCacheKey = (query, facets) => {
+  const normalizedQuery = (query || '').trim().replace(/\s+/g, ' ').toLowerCase();
+  const normalizedFacets = Object.keys(facets)
+    .filter((field) => Array.isArray(facets[field]) && facets[field].length > 0)
+    .sort()
+    .map((field) => [field, [...facets[field]].map(String).sort()]);
+  return JSON.stringify([normalizedQuery, normalizedFacets]);
+};
+
+// Cursores opacos para la paginación por keyset: con texto es el
+// searchSequenceToken de Atlas Search (para searchAfter) y sin texto el _id
+// del último documento devuelto
+const encodeCursor = (kind, value) =>
+  Buffer.from(JSON.stringify({ [kind]: value })).toString('base64url');
+
+const decodeCursor = (cursor, kind) => {
+  try {
+    const value = JSON.parse(Buffer.from(cursor, 'base64url').toString('utf8'))[kind];
+    if (kind === 'id') {
+      return new ObjectId(value);
+    }
+    return typeof value === 'string' ? value : null;
+  } catch (e) {
+    return null;
+  }
+};
+
+// Separador de los filtros de una entidad concreta: "ORG:World Health Organization"
+const ENTITY_VALUE_SEPARATOR = ':';
+
+// Misma normalización que el spark-job-processor (mongo_writer.entity_key)
+const entityKey = (text) => text.trim().split(/\s+/).filter(Boolean).join(' ').toLowerCase();
+
+// Condición de un filtro de entidades (se cumple con cualquiera de los valores):
+// una etiqueta ("ORG") usa el índice multikey de entities.label y una entidad
+// concreta ("ORG:WHO") el índice compuesto (entities.label, entities.key), sin
+// pasar listas de rel_doi por la API
+const entityFilter = (values) => {
+  const labels = [];
+  const entities = [];
+  for (const value of values) {
+    const separator = value.indexOf(ENTITY_VALUE_SEPARATOR);
+    if (separator < 0) {
+      labels.push(value);
+    } else {
+      entities.push({ label: value.slice(0, separator), key: entityKey(value.slice(separator + 1)) });
+    }
+  }
+  
+  const conditions = [];
+  if (labels.length > 0) {
+    conditions.push({ "entities.label": { $in: labels } });
+  }
+  conditions.push(...entities.map((entity) => ({ entities: { $elemMatch: entity } })));
+  return conditions.length === 1 ? conditions[0] : { $or: conditions };
+};
+
+// Buscar documentos usando Atlas Search.
+// Sin cursor se pagina con page (solo la primera página es barata); con el
+// cursor devuelto en pagination.nextCursor se obtiene la página siguiente
+// sin recorrer las anteriores
+const searchDocuments = async (query, facets = {}, page = 1, limit = 10, cursor = null) => {
   try {
     const db = mongoose.connection.db;
+    const cacheKey = searchCacheKey(query, facets);
+    const cursorKind = query ? 'token' : 'id';
+
+    let after = null;
+    if (cursor) {
+      after = decodeCursor(cursor, cursorKind);
+      if (after === null) {
+        console.warn('Cursor de búsqueda inválido, se usa la paginación por página');
+      }
+    }
+    const firstPage = after === null && page <= 1;
+    const pageKey = `${cacheKey}|${limit}`;
     
-    // Construir pipeline de agregación
-    const pipeline = [];
+    // Filtros de facets (las entidades se resuelven con índices)
+    const facetFilters = [];
+    for (const [field, values] of Object.entries(facets)) {
+      if (Array.isArray(values) && values.length > 0) {
+        facetFilters.push(field === 'entities'
+          ? entityFilter(values)
+          : { [field]: { $in: values } });
+      }
+    }
     
-    // Agregar búsqueda si hay query
-    if (query) {
-      pipeline.push({
-        $search: {
+    // Construir pipeline de agregación (after es el cursor, null para
+    // empezar desde el primer resultado)
+    const buildPipeline = (after) => {
+      const pipeline = [];
+      
+      // Agregar búsqueda si hay query
+      if (query) {
+        const search = {
           index: "documents_search",
           text: {
             query: query,
@@ -22,61 +149,90 @@ const searchDocuments = async (query, facets = {}, page = 1, limit = 10) => {
           highlight: {
             path: ["rel_title", "rel_abs"]
           }
+        };
+        if (after !== null) {
+          search.searchAfter = after;
         }
-      });
+        pipeline.push({ $search: search });
+        
+        // Proyectar highlights
+        pipeline.push({
+          $project: {
+            rel_title: 1,
+            rel_abs: 1,
+            author_name: 1,
+            author_inst: 1,
+            category: 1,
+            type: 1,
+            rel_date: 1,
+            entities: 1,
+            rel_doi: 1,
+            highlights: { $meta: "searchHighlights" },
+            paginationToken: { $meta: "searchSequenceToken" }
+          }
+        });
+      } else if (after !== null) {
+        // Solo facets: recorrer por _id a partir del último documento
+        pipeline.push({ $match: { _id: { $gt: after } } });
+      }
       
-      // Proyectar highlights
-      pipeline.push({
-        $project: {
-          rel_title: 1,
-          rel_abs: 1,
-          author_name: 1,
-          author_inst: 1,
-          category: 1,
-          type: 1,
-          rel_date: 1,
-          entities: 1,
-          rel_doi: 1,
-          highlights: { $meta: "searchHighlights" }
-        }
-      });
-    }
-    
-    // Aplicar filtros de facets
-    const facetFilters = [];
-    for (const [field, values] of Object.entries(facets)) {
-      if (Array.isArray(values) && values.length > 0) {
-        facetFilters.push({ [field]: { $in: values } });
+      // Aplicar filtros de facets
+      if (facetFilters.length > 0) {
+        pipeline.push({ $match: { $and: facetFilters } });
       }
-    }
+      return pipeline;
+    };
     
-    if (facetFilters.length > 0) {
-      pipeline.push({ $match: { $and: facetFilters } });
-    }
+    const pipeline = buildPipeline(after);
     
-    // Pipeline para conteo total
-    const countPipeline = [...pipeline];
+    // Pipeline para conteo total (sin cursor, cuenta todos los resultados)
+    const countPipeline = buildPipeline(null);
     countPipeline.push({ $count: "total" });
     
     // Aplicar paginación
-    pipeline.push({ $skip: (page - 1) * limit });
+    if (!query) {
+      pipeline.push({ $sort: { _id: 1 } });
+    }
+    if (after === null && page > 1) {
+      pipeline.push({ $skip: (page - 1) * limit });
+    }
     pipeline.push({ $limit: limit });
     
-    // Ejecutar consultas
-    const [results, countResult] = await Promise.all([
-      db.collection("documents").aggregate(pipeline).toArray(),
-      db.collection("documents").aggregate(countPipeline).toArray()
+    // Ejecutar consultas (el total y la primera página pueden venir de la caché)
+    const cachedTotal = searchCache.get(cacheKey);
+    const cachedResults = firstPage ? searchCache.get(pageKey) : undefined;
+    const [results, total] = await Promise.all([
+      cachedResults !== undefined
+        ? cachedResults
+        : db.collection("documents").aggregate(pipeline).toArray(),
+      cachedTotal !== undefined
+        ? cachedTotal
+        : db.collection("documents").aggregate(countPipeline).toArray()
+            .then((countResult) => (countResult.length > 0 ? countResult[0].total : 0))
     ]);
+    if (cachedTotal === undefined) {
+      searchCache.set(cacheKey, total);
+    }
+    if (firstPage && cachedResults === undefined) {
+      searchCache.set(pageKey, results);
+    }
     
-    const total = countResult.length > 0 ? countResult[0].total : 0;
+    let nextCursor = null;
+    if (results.length === limit) {
+      const last = results[results.length - 1];
+      nextCursor = query
+        ? (last.paginationToken ? encodeCursor('token', last.paginationToken) : null)
+        : encodeCursor('id', last._id.toString());
+    }
     
     return {
-      results,
+      results: results.map(({ paginationToken, ...document }) => document),
       pagination: {
         total,
         page,
         limit,
-        pages: Math.ceil(total / limit)
+        pages: Math.ceil(total / limit),
+        nextCursor
       }
     };
   } catch (error) {
@@ -85,10 +241,51 @@ const searchDocuments = async (query, facets = {}, page = 1, limit = 10) => {
   }
 };
 
-// Obtener facets disponibles
+// Valores devueltos por cada facet (los mismos límites que la agregación)
+const FACET_LIMITS = {
+  entities: 20,
+  category: 20,
+  type: 10,
+  author_name: 20
+};
+
+// Leer los conteos que el spark-job-processor mantiene en facet_counts.
+// Devuelve null si la colección no existe o está marcada como desactualizada
+const getPrecomputedFacets = async (db) => {
+  const collection = db.collection("facet_counts");
+  const meta = await collection.findOne({ _id: "_meta" });
+  if (!meta || meta.stale) {
+    return null;
+  }
+  const facets = Object.keys(FACET_LIMITS);
+  const values = await Promise.all(facets.map((facet) =>
+    collection
+      .find({ facet, count: { $gt: 0 } })
+      .sort({ count: -1 })
+      .limit(FACET_LIMITS[facet])
+      .project({ _id: 0, value: 1, count: 1 })
+      .toArray()
+  ));
+  const result = {};
+  facets.forEach((facet, i) => {
+    result[facet] = values[i].map(({ value, count }) => ({ _id: value, count }));
+  });
+  return result;
+};
+
+// Obtener facets disponibles: primero los conteos precalculados y, si no
+// están disponibles, la agregación sobre toda la colección
 const getFacets = async () => {
   try {
     const db = mongoose.connection.db;
+    try {
+      const precomputed = await getPrecomputedFacets(db);
+      if (precomputed) {
+        return precomputed;
+      }
+    } catch (error) {
+      console.error('Error leyendo facet_counts, se usa la agregación:', error);
+    }
     console.log("Conexion a DB:", db);
     const pipeline = [
       {
@@ -97,22 +294,22 @@ const getFacets = async () => {
             { $unwind: "$entities" },
             { $group: { _id: "$entities.label", count: { $sum: 1 } } },
             { $sort: { count: -1 } },
-            { $limit: 20 }
+            { $limit: FACET_LIMITS.entities }
           ],
           "category": [
             { $group: { _id: "$category", count: { $sum: 1 } } },
             { $sort: { count: -1 } },
-            { $limit: 20 }
+            { $limit: FACET_LIMITS.category }
           ],
           "type": [
             { $group: { _id: "$type", count: { $sum: 1 } } },
             { $sort: { count: -1 } },
-            { $limit: 10 }
+            { $limit: FACET_LIMITS.type }
           ],
           "author_name": [
             { $group: { _id: "$author_name", count: { $sum: 1 } } },
             { $sort: { count: -1 } },
-            { $limit: 20 }
+            { $limit: FACET_LIMITS.author_name }
           ]
         }
       }
@@ -126,6 +323,28 @@ const getFacets = async () => {
   }
 };
 
+// Entidades más frecuentes de una etiqueta (documentos que las mencionan),
+// leídas de entity_counts con el índice (label, count)
+const getEntityFacets = async (label, limit = FACET_LIMITS.entities) => {
+  try {
+    const db = mongoose.connection.db;
+    const counts = await db.collection("entity_counts")
+      .find({ label, count: { $gt: 0 } })
+      .sort({ count: -1 })
+      .limit(limit)
+      .project({ _id: 0, text: 1, key: 1, count: 1 })
+      .toArray();
+    return counts.map(({ text, key, count }) => ({
+      _id: `${label}${ENTITY_VALUE_SEPARATOR}${key}`,
+      text,
+      count
+    }));
+  } catch (error) {
+    console.error('Error en getEntityFacets:', error);
+    throw error;
+  }
+};
+
 // Obtener documento por ID
 const getDocumentById = async (id) => {
   try {
@@ -151,5 +370,6 @@ const getDocumentById = async (id) => {
 module.exports = {
   searchDocuments,
   getFacets,
+  getEntityFacets,
   getDocumentById
 };
\ No newline at end of file
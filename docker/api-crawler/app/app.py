@@ -1,9 +1,17 @@
 import os
-import pika
 import json
 import requests
 import logging
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from common.splitio import SplitWriter, split_name
+from common.consumer import ConsumerRuntime, DiscardMessage, connection_parameters, CONSUMER_WORKERS
+from common.metrics import counter, histogram
+from common.httpcache import get_response_cache
+from checkpoint import SplitCheckpoint
 
 # Logger configuration
 logging.basicConfig(
@@ -13,20 +21,200 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Environment variables
-RABBITMQ_HOST = os.getenv("RABBITMQ_HOST")
-RABBITMQ_USER = os.getenv("RABBITMQ_USER")
-RABBITMQ_PASS = os.getenv("RABBITMQ_PASS")
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE")
 BIORXIV_API_URL = os.getenv("BIORXIV_API_URL")
 RAW_FOLDER = "/mnt/raw"
 RABBITMQ_DONE_QUEUE = os.getenv("RABBITMQ_QUEUE_DOWNLOAD")
 
+# Configuración de la descarga concurrente
+CRAWLER_CONCURRENCY = int(os.getenv("CRAWLER_CONCURRENCY", "4"))  # Páginas en vuelo simultáneamente
+CRAWLER_RATE_LIMIT = float(os.getenv("CRAWLER_RATE_LIMIT", "2"))  # Solicitudes por segundo (0 = sin límite)
+CRAWLER_RATE_BURST = int(os.getenv("CRAWLER_RATE_BURST", str(CRAWLER_CONCURRENCY)))
+CRAWLER_TIMEOUT = float(os.getenv("CRAWLER_TIMEOUT", "30"))  # Timeout por solicitud en segundos
+FETCH_WINDOW = max(1, CRAWLER_CONCURRENCY) * 2  # Páginas pedidas por adelantado
+MAX_RETRIES = 3
+RETRY_WAIT = 5
+PAGE_ATTEMPTS = 5  # Entregas del split en las que se reintenta una página antes de darla por perdida
+
+# División de splits lentos
+CRAWLER_STRAGGLER_SECONDS = float(os.getenv("CRAWLER_STRAGGLER_SECONDS", "300"))  # 0 = no dividir
+CRAWLER_STRAGGLER_MIN_PAGES = int(os.getenv("CRAWLER_STRAGGLER_MIN_PAGES", "20"))  # Páginas mínimas del split nuevo
+STRAGGLER_RECHECK = 15  # Segundos entre consultas a la cola mientras no haya workers libres
+
+# Métricas del crawler
+PAGES = counter("biorxiv_crawler_pages_total", "API pages processed, by result", ["result"])
+ARTICLES = counter("biorxiv_crawler_articles_total", "Articles saved to the raw splits")
+HTTP_SECONDS = histogram("biorxiv_crawler_http_request_seconds", "Latency of the bioRxiv API requests", ["status"])
+SPLIT_SECONDS = histogram("biorxiv_crawler_split_seconds", "Time to download and assemble one split")
+STRAGGLERS = counter("biorxiv_crawler_straggler_splits_total", "Slow splits whose remaining pages were handed to a new split")
+
+# Runtime de consumo (se asigna en main); permite publicar desde los workers
+runtime = None
+
+class TokenBucket:
+    """
+    Limitador de tasa tipo token bucket compartido entre hilos.
+    Se recargan `rate` tokens por segundo hasta un máximo de `capacity`;
+    cada solicitud consume un token y espera si no hay disponibles.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+rate_limiter = TokenBucket(CRAWLER_RATE_LIMIT, CRAWLER_RATE_BURST)
+
+def get_http_session():
+    """
+    Crea una sesión HTTP con un pool de conexiones keep-alive
+    dimensionado para la concurrencia configurada (por split en curso).
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, CRAWLER_CONCURRENCY) * max(1, CONSUMER_WORKERS))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http_session = get_http_session()
+
+# Caché de respuestas en el volumen compartido (None si está deshabilitada)
+response_cache = get_response_cache()
+
+def fetch_page(url, page_num):
+    """
+    Descarga una página de la API respetando el limitador de tasa.
+    Con la caché de respuestas cada página se pide de forma condicional
+    (un 304 evita volver a transferirla), nunca se sirve sin consultar.
+    Reintenta hasta MAX_RETRIES veces ante errores de conexión.
+    Devuelve el JSON de la página o None si no se pudo obtener.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt > 0:
+            logger.info(f"Retrying page {page_num} (attempt {attempt}/{MAX_RETRIES})")
+            time.sleep(RETRY_WAIT)  # Esperar más tiempo antes de reintentar
+        rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            if response_cache is not None:
+                response = response_cache.get(http_session, url, timeout=CRAWLER_TIMEOUT)
+            else:
+                response = http_session.get(url, timeout=CRAWLER_TIMEOUT)
+            HTTP_SECONDS.observe(time.perf_counter() - start, status=response.status_code)
+            response.raise_for_status()  # Lanza una excepción si hay error HTTP
+            return response.json()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            HTTP_SECONDS.observe(time.perf_counter() - start, status="error")
+            logger.error(f"Error requesting page {page_num}: {e}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error requesting page {page_num}: {e}")
+            return None
+        except ValueError as e:
+            logger.error(f"Invalid JSON in page {page_num}: {e}")
+            if response_cache is not None:
+                response_cache.discard(url)  # Copia dañada: el reintento del split la descarga de nuevo
+            return None
+    logger.error(f"Giving up on page {page_num} after {MAX_RETRIES} retries")
+    return None
+
+def fetch_pages_in_order(base_url, start_page, last_page):
+    """
+    Descarga las páginas desde start_page hasta last_page() con hasta
+    CRAWLER_CONCURRENCY solicitudes en vuelo y las entrega en orden de página
+    como (page_num, data). last_page se consulta en cada vuelta porque el split
+    puede acortarse mientras se descarga; nunca se piden más de FETCH_WINDOW
+    páginas por delante de la última entregada.
+    El consumidor puede detener la iteración para cancelar las páginas pendientes.
+    """
+    pending = deque()
+    next_page = start_page
+    with ThreadPoolExecutor(max_workers=max(1, CRAWLER_CONCURRENCY)) as executor:
+        try:
+            while pending or next_page <= last_page():
+                # Mantener la ventana llena sin adelantarse demasiado al consumidor
+                while next_page <= last_page() and len(pending) < FETCH_WINDOW:
+                    url = f"{base_url}{next_page}"
+                    logger.info(f"Requesting page {next_page} from: {url}")
+                    pending.append((next_page, executor.submit(fetch_page, url, next_page)))
+                    next_page += 1
+                page_num, future = pending.popleft()
+                yield page_num, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def split_straggler(jobId, splitNumber, pageSize, sinceDate, checkpoint, page_num):
+    """
+    Divide un split lento: si la cola de splits está vacía (los workers que
+    terminen quedarían ociosos) y quedan suficientes páginas, publica un split
+    nuevo con la segunda mitad de las páginas restantes y acorta este.
+    El split nuevo toma el número splitNumber + módulo y ambos duplican el
+    módulo, así los números no se repiten dentro del job.
+    Devuelve True si se dividió.
+    """
+    modulus = checkpoint.modulus
+    if not modulus or runtime is None:
+        return False
+    end_page = checkpoint.end_page
+    # Las páginas ya pedidas (ventana de descarga) se quedan en este split
+    cut_page = max(page_num + FETCH_WINDOW + 1, page_num + 1 + (end_page - page_num) // 2)
+    if end_page - cut_page + 1 < CRAWLER_STRAGGLER_MIN_PAGES:
+        return False
+    status = runtime.queue_status()
+    if status is None or status[0] > 0:
+        return False
+    child = {
+        "jobId": jobId,
+        "pageSize": pageSize,
+        "sleep": 0,
+        "splitNumber": splitNumber + modulus,
+        "splitModulus": modulus * 2,
+        "startPage": cut_page,
+        "endPage": end_page
+    }
+    if sinceDate:
+        child["sinceDate"] = sinceDate
+    # Primero se publica el split nuevo y, solo cuando el broker lo confirma, se
+    # acorta este: si el proceso se cae en medio o el broker no confirma, el
+    # checkpoint conserva el rango completo y no se pierden páginas (a lo sumo
+    # se descargan dos veces, y la deduplicación descarta la copia)
+    if not runtime.publish_confirmed(RABBITMQ_QUEUE, child):
+        return False
+    checkpoint.cut(cut_page - 1, modulus * 2)
+    STRAGGLERS.inc()
+    logger.info(f"Split {splitNumber} is slow: pages {cut_page} to {end_page} moved to split {child['splitNumber']}")
+    return True
+
 # Ensure all required environment variables are set
-def download_and_save(jobId, splitNumber, pageSize):
+def download_and_save(jobId, splitNumber, pageSize, sinceDate=None, startPage=None, endPage=None, modulus=None):
     """
     Descarga artículos para un split específico.
     Cada split comprende pageSize páginas de la API.
-    Combina todos los artículos en un solo archivo JSON.
+    Las páginas se descargan de forma concurrente y cada una se guarda como
+    checkpoint en /mnt/raw/.partial; si el split se reintenta continúa desde
+    la última página completada. Al terminar se ensamblan, en orden de página,
+    en un solo archivo NDJSON (un artículo por línea).
+    Si se recibe sinceDate (job incremental) solo se guardan los artículos
+    con rel_date >= sinceDate y la descarga se detiene en la primera página
+    que contiene artículos anteriores, ya que la API entrega primero los más recientes.
+    startPage/endPage (splits creados al dividir un split lento) reemplazan el
+    rango calculado; con modulus el split puede dividirse si tarda más de
+    CRAWLER_STRAGGLER_SECONDS.
     """
     # Obtener la URL base sin el número de página
     base_url = BIORXIV_API_URL
@@ -35,102 +223,99 @@ def download_and_save(jobId, splitNumber, pageSize):
     
     # Calcular el rango de páginas para este split
     pages_per_split = pageSize  # pageSize representa páginas por split (100)
-    start_page = splitNumber * pages_per_split
-    end_page = start_page + pages_per_split - 1
-    
-    logger.info(f"Processing split {splitNumber}: API pages {start_page} to {end_page}")
+    start_page = splitNumber * pages_per_split if startPage is None else startPage
+    end_page = start_page + pages_per_split - 1 if endPage is None else endPage
     
-    # Estructura para combinar todos los artículos del split
-    combined_data = {
-        "messages": [],
-        "collection": []
-    }
-    
-    articles_downloaded = 0
-    pages_processed = 0
+    name = split_name(jobId, splitNumber)
+    checkpoint = SplitCheckpoint(RAW_FOLDER, name, start_page, end_page, modulus)
+    if checkpoint.finished:
+        logger.info(f"Split {splitNumber}: all pages already downloaded, assembling file")
+    elif checkpoint.next_page > start_page:
+        logger.info(f"Resuming split {splitNumber} at page {checkpoint.next_page} "
+                    f"({checkpoint.articles} articles from {checkpoint.pages_processed} pages already saved)")
+    else:
+        logger.info(f"Processing split {splitNumber}: API pages {start_page} to {end_page}")
     
-    for page_num in range(start_page, end_page + 1):
-        # Construir la URL para esta página
-        url = f"{base_url}{page_num}"
-        logger.info(f"Requesting page {page_num} from: {url}")
-        
-        try:
-            response = requests.get(url)
-            response.raise_for_status()  # Lanza una excepción si hay error HTTP
-            data = response.json()
+    if not checkpoint.finished:
+        next_check = checkpoint.started_at + CRAWLER_STRAGGLER_SECONDS
+        for page_num, data in fetch_pages_in_order(base_url, checkpoint.next_page, lambda: checkpoint.end_page):
+            articles = []
+            messages = None
+            stop = False
             
-            if not isinstance(data, dict) or "messages" not in data or "collection" not in data:
-                logger.warning(f"Page {page_num} response is not in the expected format.")
-                continue
-                
-            # Verificar si hay artículos en esta página
-            articles_in_page = len(data.get("collection", []))
-            if articles_in_page == 0:
-                logger.warning(f"No articles found on page {page_num}")
-                # Si no hay artículos, podemos haber llegado al final de la colección
-                if page_num > start_page + 10:  # Si ya procesamos algunas páginas, terminamos
-                    logger.info(f"Reached end of collection at page {page_num}")
-                    break
+            result = "ok"
+            try:
+                if data is None:
+                    result = "error"  # Error ya registrado en fetch_page
+                elif not isinstance(data, dict) or "messages" not in data or "collection" not in data:
+                    result = "invalid"
+                    logger.warning(f"Page {page_num} response is not in the expected format.")
+                elif len(data.get("collection", [])) == 0:
+                    result = "empty"
+                    logger.warning(f"No articles found on page {page_num}")
+                    # Si no hay artículos, podemos haber llegado al final de la colección
+                    if page_num > start_page + 10:  # Si ya procesamos algunas páginas, terminamos
+                        logger.info(f"Reached end of collection at page {page_num}")
+                        stop = True
                 else:
-                    continue
-            
-            # Guardar los mensajes de la primera página (contiene metadatos importantes)
-            if not combined_data["messages"] and "messages" in data:
-                combined_data["messages"] = data["messages"].copy()
-            
-            # Añadir artículos a la colección combinada
-            combined_data["collection"].extend(data.get("collection", []))
-            articles_downloaded += articles_in_page
-            pages_processed += 1
+                    # Los mensajes de la primera página contienen metadatos importantes
+                    messages = data["messages"].copy()
+                    articles = data.get("collection", [])
+                    if sinceDate:
+                        # Crawl incremental: descartar los artículos ya ingeridos
+                        new_articles = [a for a in articles if (a.get("rel_date") or "") >= sinceDate]
+                        if len(new_articles) < len(articles):
+                            logger.info(f"Reached articles older than {sinceDate} at page {page_num}, stopping split {splitNumber}")
+                            stop = True
+                        articles = new_articles
+            except Exception as e:
+                result = "error"
+                logger.error(f"Unexpected error processing page {page_num}: {e}")
+                articles = []
             
-            logger.info(f"Added {articles_in_page} articles from page {page_num}, total so far: {articles_downloaded}")
-            
-            # Esperar brevemente entre solicitudes para no sobrecargar la API
-            time.sleep(0.5)
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error requesting page {page_num}: {e}")
-            # Intentar hasta 3 veces si hay error de conexión
-            if "Connection" in str(e) and page_num < end_page:
-                for retry in range(3):
-                    logger.info(f"Retrying page {page_num} (attempt {retry+1}/3)")
-                    time.sleep(5)  # Esperar más tiempo antes de reintentar
-                    try:
-                        response = requests.get(url)
-                        response.raise_for_status()
-                        data = response.json()
-                        
-                        if "collection" in data:
-                            combined_data["collection"].extend(data.get("collection", []))
-                            articles_downloaded += len(data.get("collection", []))
-                            pages_processed += 1
-                            logger.info(f"Retry successful for page {page_num}")
-                            break
-                    except:
-                        logger.error(f"Retry {retry+1} failed for page {page_num}")
-        except Exception as e:
-            logger.error(f"Unexpected error processing page {page_num}: {e}")
+            PAGES.inc(result=result)
+            if result == "error":
+                # La página no se marca como completada: el split se reencola y la
+                # próxima entrega continúa desde ella, hasta PAGE_ATTEMPTS veces
+                attempts = checkpoint.page_failed(page_num)
+                if attempts < PAGE_ATTEMPTS:
+                    raise RuntimeError(f"Page {page_num} of split {splitNumber} failed "
+                                       f"(attempt {attempts}/{PAGE_ATTEMPTS}), requeueing the split")
+                logger.error(f"Giving up on page {page_num} of split {splitNumber} after {attempts} attempts")
+                checkpoint.skip_page(page_num)
+                continue
+            # Guardar la página y el progreso antes de pasar a la siguiente
+            checkpoint.save_page(page_num, articles, messages, finished=stop)
+            ARTICLES.inc(len(articles))
+            if articles:
+                logger.info(f"Added {len(articles)} articles from page {page_num}, total so far: {checkpoint.articles}")
+            if stop:
+                break
+            if CRAWLER_STRAGGLER_SECONDS and time.time() >= next_check:
+                split = split_straggler(jobId, splitNumber, pageSize, sinceDate, checkpoint, page_num)
+                next_check = time.time() + (CRAWLER_STRAGGLER_SECONDS if split else STRAGGLER_RECHECK)
+        checkpoint.finish()
+    
+    articles_downloaded = checkpoint.articles
+    pages_processed = checkpoint.pages_processed
     
-    # Si hemos descargado artículos, guardar el archivo combinado
-    if articles_downloaded > 0:
-        # Actualizar el conteo en messages
-        if combined_data["messages"]:
-            # Actualizar el contador para reflejar el número real de artículos
-            for i, msg in enumerate(combined_data["messages"]):
-                if "count" in msg:
-                    combined_data["messages"][i]["count"] = len(combined_data["collection"])
-        
-        # Guardar el archivo combinado para todo el split
-        combined_filename = f"{jobId}_{splitNumber}.json"
-        combined_filepath = os.path.join(RAW_FOLDER, combined_filename)
-        
-        with open(combined_filepath, "w", encoding="utf-8") as f:
-            json.dump(combined_data, f, ensure_ascii=False, indent=2)
-        
+    # Ensamblar el archivo del split a partir de las páginas (se descarta si no hubo artículos).
+    # El trace registra desde que se empezó a descargar el split (aunque haya sido reanudado)
+    writer = SplitWriter(RAW_FOLDER, name, checkpoint.messages)
+    with writer:
+        writer.write_many(checkpoint.iter_articles())
+        writer.trace["crawl"] = {
+            "start": checkpoint.started_at,
+            "end": time.time(),
+            "pages": pages_processed,
+            "articles": articles_downloaded
+        }
+    SPLIT_SECONDS.observe(time.time() - checkpoint.started_at)
+    combined_filepath = writer.path if writer.count else None
+    if combined_filepath:
         logger.info(f"Split {splitNumber}: Saved combined file with {articles_downloaded} articles from {pages_processed} pages")
     else:
         logger.warning(f"No articles were downloaded for split {splitNumber}")
-        combined_filepath = None
     
     # Crear el archivo de resumen (mantenemos esto para compatibilidad)
     summary_filename = f"{jobId}_summary_{splitNumber}.json"
@@ -141,141 +326,64 @@ def download_and_save(jobId, splitNumber, pageSize):
             "jobId": jobId,
             "splitNumber": splitNumber,
             "startPage": start_page,
-            "endPage": end_page if pages_processed == 0 else start_page + pages_processed - 1,
+            "endPage": checkpoint.end_page if pages_processed == 0 else start_page + pages_processed - 1,
             "pagesProcessed": pages_processed,
-            "totalArticlesDownloaded": articles_downloaded
+            "totalArticlesDownloaded": articles_downloaded,
+            "skippedPages": checkpoint.skipped_pages
         }
         json.dump(summary, f, ensure_ascii=False, indent=2)
     
     logger.info(f"Split {splitNumber} completed: Downloaded {articles_downloaded} articles across {pages_processed} pages")
     
+    # El split quedó completo, ya no se necesitan las páginas parciales
+    checkpoint.remove()
+    
     # Devolver la ruta del archivo combinado o None si no se descargó nada
     return combined_filepath or summary_filepath
 
-def get_rabbitmq_connection(purpose="consume", retry_count=3, heartbeat=30):
+def process_split(msg):
     """
-    Establece una conexión con RabbitMQ para un propósito específico.
-    
-    Args:
-        purpose: 'consume' o 'publish' 
-        retry_count
-        heartbeat: intervalo de heartbeat en segundos
-    
-    Returns:
-        Tuple (connection, channel) o (None, None) si falla
+    Descarga el split del mensaje. Devuelve el mensaje de finalización, que el
+    runtime publica por la conexión de consumo antes de confirmar (ACK) el split.
     """
-    for attempt in range(retry_count):
-        try:
-            # Ajustar parámetros según el propósito
-            if purpose == "publish":
-                # Para publicar: conexión más ligera, timeout corto
-                connection_params = pika.ConnectionParameters(
-                    host=RABBITMQ_HOST,
-                    credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
-                    heartbeat=heartbeat,
-                    blocked_connection_timeout=30,
-                    connection_attempts=2
-                )
-            else:
-                # Para consumir: timeout más largo, más reintentos
-                connection_params = pika.ConnectionParameters(
-                    host=RABBITMQ_HOST,
-                    credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
-                    heartbeat=heartbeat,
-                    blocked_connection_timeout=60,
-                    connection_attempts=5
-                )
-                
-            # Establecer conexión
-            connection = pika.BlockingConnection(connection_params)
-            channel = connection.channel()
-            
-            # Declarar colas según el propósito
-            if purpose == "consume":
-                channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-                channel.queue_declare(queue=RABBITMQ_DONE_QUEUE, durable=True)
-                channel.basic_qos(prefetch_count=1)
-            elif purpose == "publish":
-                channel.queue_declare(queue=RABBITMQ_DONE_QUEUE, durable=True)
-                
-            logger.info(f"Connected to RabbitMQ for {purpose}")
-            return connection, channel
-            
-        except Exception as e:
-            wait_time = min(2 ** attempt, 30)
-            logger.error(f"Error connecting to RabbitMQ (attempt {attempt+1}/{retry_count}): {e}")
-            if attempt < retry_count - 1:
-                logger.info(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            
-    logger.critical(f"Failed to connect to RabbitMQ after {retry_count} attempts")
-    return None, None
-
-# Callback function to process messages from RabbitMQ
-def callback(ch, method, properties, body):
-    # ACK temprano para evitar reprocesamiento
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    if not isinstance(msg, dict):
+        raise DiscardMessage(f"expected a JSON object, got {type(msg).__name__}")
+    missing = [key for key in ("jobId", "splitNumber", "pageSize") if key not in msg]
+    if missing:
+        # Mensaje inválido: no tiene sentido reintentarlo
+        raise DiscardMessage(f"missing {', '.join(missing)}")
+    logger.info(f"Received: {msg}")
+    jobId = msg["jobId"]
+    splitNumber = msg["splitNumber"]
+    pageSize = msg["pageSize"]
     
-    try:
-        msg = json.loads(body)
-        logger.info(f"Received: {msg}")
-        jobId = msg["jobId"]
-        splitNumber = msg["splitNumber"]
-        pageSize = msg["pageSize"]
-        
-        # Desconectar antes de la descarga larga
-        ch.connection.close()
-        logger.info("Closed RabbitMQ connection before download")
-        
-        # Descargar y guardar (sin conexión activa)
-        filepath = download_and_save(jobId, splitNumber, pageSize)
-        logger.info(f"Saved in {filepath}")
-        
-        # Mensaje de finalización
-        done_msg = {
-            "jobId": jobId,
-            "pageSize": pageSize,
-            "sleep": msg.get("sleep", 0),
-            "splitNumber": splitNumber,
-            "status": "DOWNLOADED"
-        }
-        
-        # Crear nueva conexión para publicar
-        publish_conn, publish_ch = get_rabbitmq_connection(purpose="publish")
-        if publish_ch:
-            publish_ch.basic_publish(
-                exchange='',
-                routing_key=RABBITMQ_DONE_QUEUE,
-                body=json.dumps(done_msg),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            logger.info(f"Published completion message for split {splitNumber}")
-            publish_conn.close()
-        else:
-            logger.error("Failed to publish completion message - couldn't connect to RabbitMQ")
-        
-    except Exception as e:
-        logger.error(f"Error in callback: {e}")
+    # Descargar y guardar; si falla el runtime reencola el mensaje y el
+    # reintento continúa desde el último checkpoint
+    filepath = download_and_save(jobId, splitNumber, pageSize, msg.get("sinceDate"),
+                                 msg.get("startPage"), msg.get("endPage"), msg.get("splitModulus"))
+    logger.info(f"Saved in {filepath}")
+    
+    # Mensaje de finalización
+    done_msg = {
+        "jobId": jobId,
+        "pageSize": pageSize,
+        "sleep": msg.get("sleep", 0),
+        "splitNumber": splitNumber,
+        "status": "DOWNLOADED"
+    }
+    logger.info(f"Publishing completion message for split {splitNumber}")
+    return [(RABBITMQ_DONE_QUEUE, done_msg)]
 
 def main():
-    while True:
-        # Obtener conexión para consumir
-        connection, channel = get_rabbitmq_connection(purpose="consume")
-        
-        if not channel:
-            logger.error("Failed to get RabbitMQ connection, retrying in 10 seconds...")
-            time.sleep(10)
-            continue
-            
-        try:
-            channel.basic_consume(queue=RABBITMQ_QUEUE, on_message_callback=callback)
-            logger.info("Waiting for messages...")
-            channel.start_consuming()
-        except Exception as e:
-            logger.error(f"Error consuming messages: {e}")
-            
-        # Si llegamos aquí, hubo un error. Esperar antes de reconectar
-        time.sleep(5)
+    global runtime
+    # Una sola conexión persistente; CONSUMER_WORKERS splits se descargan en paralelo
+    runtime = ConsumerRuntime(
+        connection_parameters(),
+        RABBITMQ_QUEUE,
+        process_split,
+        declare=[RABBITMQ_DONE_QUEUE]
+    )
+    runtime.run()
 
 if __name__ == "__main__":
     os.makedirs(RAW_FOLDER, exist_ok=True)
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Carpeta (dentro de /mnt/raw) con las páginas ya descargadas de los splits en curso
+PARTIAL_FOLDER = ".partial"
+
+def write_atomic(path, content):
+    """Escribe un archivo completo o no lo escribe (temporal + rename)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+class SplitCheckpoint:
+    """
+    Progreso de la descarga de un split, guardado en /mnt/raw/.partial/<split>/.
+    Cada página procesada se escribe en page_<n>.ndjson y progress.json registra
+    la siguiente página a descargar, de modo que un split reentregado o
+    reiniciado continúa desde la última página completada.
+    Si el split se dividió (ver cut), endPage es el nuevo final y
+    originalEndPage el del mensaje, que es el que se usa para reanudar.
+    """
+    def __init__(self, folder, name, start_page, end_page, modulus=None):
+        self.folder = os.path.join(folder, PARTIAL_FOLDER, name)
+        self.progress_path = os.path.join(self.folder, "progress.json")
+        os.makedirs(self.folder, exist_ok=True)
+        self.progress = self._load(start_page, end_page, modulus)
+
+    def _load(self, start_page, end_page, modulus):
+        if os.path.exists(self.progress_path):
+            try:
+                with open(self.progress_path, "r", encoding="utf-8") as f:
+                    progress = json.load(f)
+                # Solo se reutiliza si corresponde al mismo rango de páginas
+                original_end = progress.get("originalEndPage", progress.get("endPage"))
+                if progress.get("startPage") == start_page and original_end == end_page:
+                    return progress
+                logger.warning(f"Discarding checkpoint in {self.folder}: page range changed")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Discarding unreadable checkpoint {self.progress_path}: {e}")
+        return {
+            "startPage": start_page,
+            "endPage": end_page,
+            "originalEndPage": end_page,
+            "splitModulus": modulus,
+            "nextPage": start_page,
+            "pages": [],
+            "pagesProcessed": 0,
+            "articles": 0,
+            "messages": [],
+            "finished": False,
+            "failures": {},
+            "skippedPages": [],
+            "startedAt": time.time()
+        }
+
+    @property
+    def next_page(self):
+        return self.progress["nextPage"]
+
+    @property
+    def end_page(self):
+        return self.progress["endPage"]
+
+    @property
+    def modulus(self):
+        """Separación entre los números de split del mismo job (None si no se puede dividir)."""
+        return self.progress.get("splitModulus")
+
+    @property
+    def started_at(self):
+        """Momento (epoch) en que se empezó a descargar el split."""
+        return self.progress.get("startedAt", time.time())
+
+    @property
+    def finished(self):
+        return self.progress["finished"]
+
+    @property
+    def messages(self):
+        return self.progress["messages"]
+
+    @property
+    def pages_processed(self):
+        return self.progress["pagesProcessed"]
+
+    @property
+    def articles(self):
+        return self.progress["articles"]
+
+    @property
+    def skipped_pages(self):
+        """Páginas que se dieron por perdidas tras agotar los intentos."""
+        return self.progress.get("skippedPages", [])
+
+    def _page_path(self, page_num):
+        return os.path.join(self.folder, f"page_{page_num}.ndjson")
+
+    def _save(self):
+        write_atomic(self.progress_path, json.dumps(self.progress, ensure_ascii=False))
+
+    def save_page(self, page_num, articles, messages=None, finished=False):
+        """
+        Registra una página como completada. Una lista vacía marca la página
+        como procesada sin artículos (vacía o inválida).
+        """
+        if articles:
+            lines = "".join(json.dumps(article, ensure_ascii=False) + "\n" for article in articles)
+            write_atomic(self._page_path(page_num), lines)
+            self.progress["pages"].append(page_num)
+            self.progress["pagesProcessed"] += 1
+            self.progress["articles"] += len(articles)
+            if messages and not self.progress["messages"]:
+                self.progress["messages"] = messages
+        self.progress["nextPage"] = page_num + 1
+        self.progress["finished"] = finished or self.progress["nextPage"] > self.progress["endPage"]
+        self._save()
+
+    def page_failed(self, page_num):
+        """
+        Registra un intento fallido de la página sin avanzar el progreso (la
+        próxima entrega del split vuelve a empezar en ella). Devuelve el número
+        de intentos fallidos de esa página.
+        """
+        failures = self.progress.setdefault("failures", {})
+        failures[str(page_num)] = failures.get(str(page_num), 0) + 1
+        self._save()
+        return failures[str(page_num)]
+
+    def skip_page(self, page_num):
+        """Da la página por perdida y avanza a la siguiente."""
+        self.progress.setdefault("skippedPages", []).append(page_num)
+        self.save_page(page_num, [])
+
+    def cut(self, end_page, modulus):
+        """Acorta el split hasta end_page; el resto lo descarga otro split."""
+        self.progress["endPage"] = end_page
+        self.progress["splitModulus"] = modulus
+        self.progress["finished"] = self.progress["nextPage"] > end_page
+        self._save()
+
+    def finish(self):
+        self.progress["finished"] = True
+        self._save()
+
+    def iter_articles(self):
+        """Itera los artículos de las páginas completadas, en orden de página."""
+        for page_num in self.progress["pages"]:
+            with open(self._page_path(page_num), "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def remove(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,91 @@
+import os
+import json
+from checkpoint import PARTIAL_FOLDER, SplitCheckpoint
+
+def articles(page, count=2):
+    return [{"rel_doi": f"10.1101/{page}.{i}"} for i in range(count)]
+
+def test_resume_from_last_page(tmp_path):
+    folder = str(tmp_path)
+    checkpoint = SplitCheckpoint(folder, "job_0", 0, 4, modulus=3)
+    checkpoint.save_page(0, articles(0), messages=[{"count": 100}])
+    checkpoint.save_page(1, [])
+
+    # Un split reentregado continúa en la página 2 con lo ya descargado
+    resumed = SplitCheckpoint(folder, "job_0", 0, 4, modulus=3)
+    assert resumed.next_page == 2
+    assert resumed.pages_processed == 1
+    assert resumed.articles == 2
+    assert resumed.messages == [{"count": 100}]
+    assert resumed.modulus == 3
+    assert not resumed.finished
+    resumed.save_page(2, articles(2))
+    resumed.save_page(3, articles(3), finished=True)
+    assert resumed.finished
+    assert list(resumed.iter_articles()) == articles(0) + articles(2) + articles(3)
+
+    resumed.remove()
+    assert not os.path.exists(os.path.join(folder, PARTIAL_FOLDER, "job_0"))
+
+def test_finishes_after_end_page(tmp_path):
+    checkpoint = SplitCheckpoint(str(tmp_path), "job_0", 5, 6)
+    checkpoint.save_page(5, articles(5))
+    assert not checkpoint.finished
+    checkpoint.save_page(6, articles(6))
+    assert checkpoint.finished
+
+def test_changed_range_discards_progress(tmp_path):
+    folder = str(tmp_path)
+    SplitCheckpoint(folder, "job_0", 0, 4).save_page(0, articles(0))
+    checkpoint = SplitCheckpoint(folder, "job_0", 0, 9)
+    assert checkpoint.next_page == 0
+    assert checkpoint.articles == 0
+
+def test_unreadable_progress_starts_over(tmp_path):
+    folder = str(tmp_path)
+    checkpoint = SplitCheckpoint(folder, "job_0", 0, 4)
+    checkpoint.save_page(0, articles(0))
+    with open(checkpoint.progress_path, "w", encoding="utf-8") as f:
+        f.write("{")
+    assert SplitCheckpoint(folder, "job_0", 0, 4).next_page == 0
+
+def test_cut_keeps_original_range_for_resume(tmp_path):
+    folder = str(tmp_path)
+    checkpoint = SplitCheckpoint(folder, "job_0", 0, 9, modulus=2)
+    checkpoint.save_page(0, articles(0))
+    checkpoint.cut(4, 4)
+    assert checkpoint.end_page == 4
+    assert checkpoint.modulus == 4
+    assert not checkpoint.finished
+
+    # El mensaje reentregado trae el rango original: se reanuda con el rango acortado
+    resumed = SplitCheckpoint(folder, "job_0", 0, 9, modulus=2)
+    assert resumed.end_page == 4
+    assert resumed.modulus == 4
+    assert resumed.next_page == 1
+    for page in range(1, 5):
+        resumed.save_page(page, articles(page))
+    assert resumed.finished
+
+def test_cut_before_next_page_finishes(tmp_path):
+    checkpoint = SplitCheckpoint(str(tmp_path), "job_0", 0, 9)
+    for page in range(3):
+        checkpoint.save_page(page, articles(page))
+    checkpoint.cut(2, 2)
+    assert checkpoint.finished
+
+def test_page_failed_and_skip(tmp_path):
+    folder = str(tmp_path)
+    checkpoint = SplitCheckpoint(folder, "job_0", 0, 2)
+    checkpoint.save_page(0, articles(0))
+    assert checkpoint.page_failed(1) == 1
+    # Los intentos fallidos se conservan entre entregas y no avanzan el progreso
+    resumed = SplitCheckpoint(folder, "job_0", 0, 2)
+    assert resumed.next_page == 1
+    assert resumed.page_failed(1) == 2
+    resumed.skip_page(1)
+    assert resumed.skipped_pages == [1]
+    assert resumed.next_page == 2
+    assert resumed.pages_processed == 1
+    with open(resumed.progress_path, encoding="utf-8") as f:
+        assert json.load(f)["failures"] == {"1": 2}
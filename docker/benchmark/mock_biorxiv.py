@@ -0,0 +1,158 @@
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from datetime import date, timedelta
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Vocabulary of the synthetic abstracts: plain words mixed with names, places,
+# organizations and dates so the NER stage has realistic work to do
+WORDS = [
+    "the", "patients", "infection", "viral", "load", "was", "measured", "in", "samples",
+    "from", "cohort", "and", "compared", "with", "controls", "we", "observed", "a",
+    "significant", "increase", "of", "antibodies", "after", "vaccination", "protein",
+    "spike", "binding", "affinity", "model", "predicts", "transmission", "rates",
+]
+ENTITIES = [
+    "SARS-CoV-2", "COVID-19", "Wuhan", "China", "Italy", "New York", "Harvard University",
+    "the World Health Organization", "Pfizer", "Moderna", "John Smith", "Maria Garcia",
+    "March 2020", "2021", "three weeks", "45%", "1,200 patients", "the United States",
+]
+FIRST_NAMES = ["John", "Maria", "Wei", "Ana", "Pierre", "Yuki", "Olga", "Ahmed", "Sara", "Luis"]
+LAST_NAMES = ["Smith", "Garcia", "Li", "Pérez", "Dupont", "Tanaka", "Ivanova", "Hassan", "Rossi", "Müller"]
+INSTITUTIONS = [
+    "Harvard University", "Dept. of Biology, Stanford University", "Institut Pasteur; CNRS",
+    "University of Oxford", "Karolinska Institutet", "Universidad de Costa Rica",
+]
+CATEGORIES = ["epidemiology", "infectious diseases", "immunology", "public and global health", "bioinformatics"]
+
+class SyntheticCollection:
+    """
+    Deterministic bioRxiv-like collection: article i is always the same for a
+    given seed. Articles are ordered newest first, like the real API.
+    """
+    def __init__(self, total, page_size=30, words_per_abstract=180, articles_per_day=50,
+                 newest=date(2024, 1, 1), seed=42):
+        self.total = total
+        self.page_size = page_size
+        self.words_per_abstract = words_per_abstract
+        self.articles_per_day = max(1, articles_per_day)
+        self.newest = newest
+        self.seed = seed
+
+    def article(self, i):
+        rng = random.Random(self.seed * 1000003 + i)
+        tokens = []
+        while len(tokens) < self.words_per_abstract:
+            tokens.append(rng.choice(ENTITIES) if rng.random() < 0.1 else rng.choice(WORDS))
+            if rng.random() < 0.07:
+                tokens[-1] += "."
+        authors = [
+            {"author_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+             "author_inst": rng.choice(INSTITUTIONS)}
+            for _ in range(rng.randint(1, 6))
+        ]
+        return {
+            "rel_title": " ".join(rng.choice(WORDS) for _ in range(10)).capitalize(),
+            "rel_doi": f"10.1101/2024.synthetic.{i}",
+            "rel_link": f"https://www.biorxiv.org/content/10.1101/2024.synthetic.{i}",
+            "rel_abs": " ".join(tokens),
+            "rel_num_authors": len(authors),
+            "rel_authors": authors,
+            "rel_date": (self.newest - timedelta(days=i // self.articles_per_day)).isoformat(),
+            "rel_site": rng.choice(["bioRxiv", "medRxiv"]),
+            "category": rng.choice(CATEGORIES),
+            "type": "new results",
+        }
+
+    def page(self, page_num):
+        """Response of the API for one page (pages past the end are empty)."""
+        start = page_num * self.page_size
+        end = min(self.total, start + self.page_size)
+        collection = [self.article(i) for i in range(start, end)]
+        return {
+            "messages": [{"status": "ok", "total": self.total, "count": len(collection), "cursor": page_num}],
+            "collection": collection,
+        }
+
+def make_handler(collection, latency_ms, jitter_ms, error_rate):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # The crawler requests <base>/<page number>
+            tail = urlparse(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+            try:
+                page_num = int(tail)
+            except ValueError:
+                self.send_error(404)
+                return
+            delay = max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms)) / 1000
+            time.sleep(delay)
+            if error_rate and random.random() < error_rate:
+                self.send_error(503)
+                return
+            body = json.dumps(collection.page(page_num)).encode("utf-8")
+            # Pages are deterministic, so a hash of the body is a valid ETag
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+class MockBiorxivServer:
+    """Local stand-in for the bioRxiv API, served from a background thread."""
+    def __init__(self, collection, host="127.0.0.1", port=0, latency_ms=0, jitter_ms=0, error_rate=0.0):
+        self.collection = collection
+        self.httpd = ThreadingHTTPServer((host, port), make_handler(collection, latency_ms, jitter_ms, error_rate))
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/covid19/0"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-biorxiv", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic bioRxiv API locally")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pages", type=int, default=100, help="Pages with articles")
+    parser.add_argument("--page-size", type=int, default=30, help="Articles per page")
+    parser.add_argument("--latency-ms", type=float, default=200, help="Mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="Uniform jitter around the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    collection = SyntheticCollection(args.pages * args.page_size, args.page_size)
+    server = MockBiorxivServer(collection, port=args.port, latency_ms=args.latency_ms,
+                               jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    print(f"Serving {collection.total} articles at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
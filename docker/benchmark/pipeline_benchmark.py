@@ -0,0 +1,391 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import importlib.util
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCKER_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, DOCKER_DIR)
+
+from common import splitio
+from common.splitio import find_split, iter_articles, split_name
+from mock_biorxiv import MockBiorxivServer, SyntheticCollection
+
+JOB_ID = "benchmark"
+STAGES = ["crawl", "ner", "spark"]
+
+# How this benchmark differs from the deployed pipeline (shown in --help)
+DEVIATIONS = """\
+deviations from the deployed pipeline:
+  - No RabbitMQ: each stage calls its split handler directly (download_and_save,
+    process_file, ingest_files) and the splits are handed over through the raw
+    and augmented folders of the workdir. ConsumerRuntime (prefetch, acks,
+    publisher confirms) and the controller's queue flow control are not measured.
+  - The Spark stage needs a real MongoDB at --mongo-uri: the executors write
+    with pymongo from their own worker processes, so an in-process stand-in
+    such as mongomock would not be shared with them. The stage stops with an
+    error if the server cannot be reached.
+  - bioRxiv is replaced by the local mock API (mock_biorxiv.py).
+"""
+
+# Nearest-rank percentile of a list of latencies
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+# Resident memory (KB) of a process and all its descendants, read from /proc.
+# Spark runs most of its work in a JVM child process, so the tree is measured.
+def tree_rss_kb(root_pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+class RssSampler:
+    """Samples the RSS of this process tree in the background and keeps the peak."""
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if os.path.isdir("/proc"):
+                self.peak_kb = max(self.peak_kb, tree_rss_kb(os.getpid()))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        # Fallback when /proc is not available: peak of this process only
+        self.peak_kb = max(self.peak_kb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+# Loads the app.py of a service the same way its image runs it: with its own
+# folder and the shared modules on the path and the given environment
+def load_service(service, env):
+    os.environ.update({key: str(value) for key, value in env.items()})
+    app_dir = os.path.join(DOCKER_DIR, service, "app")
+    sys.path.insert(0, app_dir)
+    spec = importlib.util.spec_from_file_location("app", os.path.join(app_dir, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def count_articles(folder, splits):
+    total = 0
+    for split in range(splits):
+        path = find_split(folder, split_name(JOB_ID, split))
+        if path:
+            total += sum(1 for _ in iter_articles(path))
+    return total
+
+def folder_size_mb(folder):
+    """Size of the split files (data and metadata) directly inside a folder."""
+    total = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+    return total / 1024 / 1024
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+# --- Stages (each one runs in its own process so its peak RSS is its own) ---
+
+def stage_crawl(config):
+    app = load_service("api-crawler", {
+        "CRAWLER_CONCURRENCY": config["crawler_concurrency"],
+        "CRAWLER_RATE_LIMIT": config["crawler_rate_limit"],
+        "CRAWLER_TIMEOUT": 30,
+        "HTTP_CACHE_DIR": config["http_cache_dir"],
+    })
+    app.RAW_FOLDER = config["raw_folder"]
+    app.BIORXIV_API_URL = config["api_url"]
+    splitio.SPLIT_FORMAT = config["split_format"]  # splitio is already imported, the variable would be ignored
+    latencies = [timed(app.download_and_save, JOB_ID, split, config["pages_per_split"])
+                 for split in range(config["splits"])]
+    return {"latencies": latencies, "articles": count_articles(config["raw_folder"], config["splits"])}
+
+def stage_ner(config):
+    start = time.perf_counter()
+    app = load_service("spacy-entity-extractor", {
+        "NER_BATCH_SIZE": config["ner_batch_size"],
+        "NER_N_PROCESS": config["ner_n_process"],
+        "ENTITY_CACHE_PATH": config["entity_cache_path"],
+        "DEDUP_INDEX_PATH": config["dedup_index_path"],
+        "SPACY_TRIMMED_PATH": config["spacy_trimmed_path"],
+    })
+    phases = app.startup()
+    startup = time.perf_counter() - start
+    app.RAW_FOLDER = config["raw_folder"]
+    app.AUGMENTED_FOLDER = config["augmented_folder"]
+    splitio.SPLIT_FORMAT = config["split_format"]
+    latencies = [timed(app.process_file, split_name(JOB_ID, split)) for split in range(config["splits"])]
+    return {"latencies": latencies, "startup": startup, "startup_phases": phases,
+            "articles": count_articles(config["augmented_folder"], config["splits"])}
+
+def stage_spark(config):
+    start = time.perf_counter()
+    app = load_service("spark-job-processor", {
+        "MONGO_URI": config["mongo_uri"],
+        "SPARK_PROCESSING_MODE": config["spark_mode"],
+        "DEDUP_INDEX_PATH": config["dedup_index_path"],
+        "SEARCH_INDEX_DIR": config["search_index_dir"],
+    })
+    from pyspark.sql import SparkSession
+    from pymongo.errors import PyMongoError
+    import mongo_writer
+    # Local session without the Mongo connector package (documents are written with pymongo)
+    spark = SparkSession.builder.appName("PipelineBenchmark").master(config["spark_master"]).getOrCreate()
+    app.add_py_files(spark)
+    startup = time.perf_counter() - start
+    app.AUGMENTED_FOLDER = config["augmented_folder"]
+
+    database = mongo_writer.get_mongo_client().get_database()
+    try:
+        database.command("ping")
+    except PyMongoError as e:
+        spark.stop()
+        raise SystemExit(f"The Spark stage needs a MongoDB server at {config['mongo_uri']}: {e}")
+    for name in ("documents", "processed_splits", "crawl_state", "facet_counts", "entity_postings",
+                 "entity_counts"):
+        database.drop_collection(name)
+    if config["search_index_dir"]:
+        shutil.rmtree(config["search_index_dir"], ignore_errors=True)
+    try:
+        filenames = app.pending_files()
+        if config["spark_mode"] == "per-file":
+            latencies = [timed(app.ingest_files, spark, [filename]) for filename in filenames]
+        else:
+            latencies = [timed(app.ingest_files, spark, filenames)]
+        saved = database.documents.count_documents({})
+    finally:
+        mongo_writer.close_mongo_client()
+        spark.stop()
+    result = {"latencies": latencies, "startup": startup, "documents": saved,
+              "articles": count_articles(config["augmented_folder"], config["splits"])}
+    if config["search_index_dir"]:
+        result["search"] = measure_search_index(config["search_index_dir"], config["search_queries"])
+    return result
+
+# Query latency of the local search index built by the Spark stage
+def measure_search_index(folder, count):
+    from common import searchindex
+    index = searchindex.SearchIndex(folder)
+    try:
+        latencies = searchindex.measure_queries(index, searchindex.sample_queries(index, count))
+        stats = index.stats()
+    finally:
+        index.close()
+    return {**stats, "queries": len(latencies),
+            "p50_ms": (percentile(latencies, 50) or 0) * 1000, "p99_ms": (percentile(latencies, 99) or 0) * 1000}
+
+STAGE_FUNCTIONS = {"crawl": stage_crawl, "ner": stage_ner, "spark": stage_spark}
+
+def run_stage_child(stage, config_path, result_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        result = STAGE_FUNCTIONS[stage](config)
+        result["seconds"] = time.perf_counter() - start
+    result["peak_rss_mb"] = sampler.peak_kb / 1024
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+def run_stage(stage, config_path, workdir):
+    result_path = os.path.join(workdir, f"result_{stage}.json")
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+                                "--config", config_path, "--result", result_path])
+    if completed.returncode != 0 or not os.path.exists(result_path):
+        return {"error": f"exit code {completed.returncode}"}
+    with open(result_path) as f:
+        return json.load(f)
+
+def summarize(stage, result):
+    latencies = result.get("latencies", [])
+    # Throughput over the split calls only (model / session startup excluded)
+    busy = sum(latencies)
+    return {
+        "stage": stage,
+        "splits": len(latencies),
+        "articles": result.get("articles", 0),
+        "seconds": busy,
+        "startup": result.get("startup", 0.0),
+        "articles_per_sec": result.get("articles", 0) / busy if busy else 0.0,
+        "p50_ms": (percentile(latencies, 50) or 0) * 1000,
+        "p99_ms": (percentile(latencies, 99) or 0) * 1000,
+        "peak_rss_mb": result.get("peak_rss_mb", 0.0),
+        "documents": result.get("documents"),
+        "search": result.get("search"),
+        "startup_phases": result.get("startup_phases"),
+        "error": result.get("error"),
+    }
+
+def print_report(rows):
+    print(f"\n{'stage':<8}{'splits':>8}{'articles':>10}{'seconds':>10}{'startup s':>11}"
+          f"{'articles/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}")
+    for row in rows:
+        if row["error"]:
+            print(f"{row['stage']:<8} failed: {row['error']}")
+            continue
+        print(f"{row['stage']:<8}{row['splits']:>8}{row['articles']:>10}{row['seconds']:>10.2f}"
+              f"{row['startup']:>11.2f}{row['articles_per_sec']:>12.1f}{row['p50_ms']:>10.0f}"
+              f"{row['p99_ms']:>10.0f}{row['peak_rss_mb']:>13.0f}")
+        if row["documents"] is not None and row["documents"] != row["articles"]:
+            print(f"{'':<8}warning: {row['documents']} documents in Mongo for {row['articles']} articles")
+        if row["startup_phases"]:
+            phases = row["startup_phases"]
+            print(f"{'':<8}startup: model load {phases['load']:.2f} s, warm-up {phases['warmup']:.2f} s")
+        if row["search"]:
+            search = row["search"]
+            print(f"{'':<8}search index: {search['documents']} documents, {search['segments']} segments, "
+                  f"{search['terms']} terms; {search['queries']} queries p50 {search['p50_ms']:.2f} ms, "
+                  f"p99 {search['p99_ms']:.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the crawl, NER and Spark stages",
+                                     epilog=DEVIATIONS, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma separated stages to run, in pipeline order")
+    parser.add_argument("--pages", type=int, default=40, help="Pages served by the mock API")
+    parser.add_argument("--page-size", type=int, default=30, help="Articles per page")
+    parser.add_argument("--pages-per-split", type=int, default=10, help="Pages per split (the pageSize of the jobs)")
+    parser.add_argument("--latency-ms", type=float, default=100, help="Mean latency of the mock API")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Latency jitter of the mock API")
+    parser.add_argument("--mock-port", type=int, default=0,
+                        help="Port of the mock API (fixed so --http-cache entries match between runs)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock API requests failing with 503")
+    parser.add_argument("--crawler-concurrency", type=int, default=4)
+    parser.add_argument("--crawler-rate-limit", type=float, default=0, help="Requests per second (0 = unlimited)")
+    parser.add_argument("--ner-batch-size", type=int, default=64)
+    parser.add_argument("--ner-n-process", type=int, default=1)
+    parser.add_argument("--ner-trimmed", action="store_true",
+                        help="Load the NER-only pipeline serialized into the workdir, as the extractor image does")
+    parser.add_argument("--entity-cache", action="store_true", help="Enable the entity cache (cold, inside the workdir)")
+    parser.add_argument("--http-cache", action="store_true",
+                        help="Enable the HTTP response cache inside the workdir (kept between runs with --workdir)")
+    parser.add_argument("--split-format", choices=["ndjson", "zstd", "parquet"], default="ndjson",
+                        help="Format of the raw and augmented splits")
+    parser.add_argument("--dedup-index", action="store_true",
+                        help="Enable the rel_doi dedup index (inside the workdir, kept between runs with --workdir)")
+    parser.add_argument("--search-index", action="store_true",
+                        help="Build the local BM25 index in the Spark stage and measure its query latency")
+    parser.add_argument("--search-queries", type=int, default=200, help="Queries sampled for --search-index")
+    parser.add_argument("--spark-mode", choices=["batch", "per-file"], default="batch")
+    parser.add_argument("--spark-master", default="local[*]")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/biorxiv_benchmark",
+                        help="Real MongoDB server used by the Spark stage; its documents, processed_splits, "
+                             "crawl_state and derived collections are dropped")
+    parser.add_argument("--workdir", help="Folder for the raw and augmented splits (default: temporary)")
+    parser.add_argument("--output", help="Write the summary as JSON to this file")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage_child(args.run_stage, args.config, args.result)
+        return
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix="biorxiv-benchmark-")
+    raw_folder = os.path.join(workdir, "raw")
+    augmented_folder = os.path.join(workdir, "augmented")
+    # Each stage starts from the output of the previous one, so the selected
+    # stage and the ones after it start from empty folders
+    for stage, folder in (("crawl", raw_folder), ("ner", augmented_folder)):
+        if stage in stages:
+            shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+
+    collection = SyntheticCollection(args.pages * args.page_size, args.page_size)
+    server = MockBiorxivServer(collection, port=args.mock_port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                               error_rate=args.error_rate).start()
+    config = {
+        "api_url": server.url,
+        "raw_folder": raw_folder,
+        "augmented_folder": augmented_folder,
+        "splits": math.ceil(args.pages / args.pages_per_split),
+        "pages_per_split": args.pages_per_split,
+        "crawler_concurrency": args.crawler_concurrency,
+        "crawler_rate_limit": args.crawler_rate_limit,
+        "ner_batch_size": args.ner_batch_size,
+        "ner_n_process": args.ner_n_process,
+        "spacy_trimmed_path": os.path.join(workdir, "model-ner") if args.ner_trimmed else "",
+        "entity_cache_path": os.path.join(workdir, "entity_cache.sqlite3") if args.entity_cache else "",
+        "http_cache_dir": os.path.join(workdir, "http-cache") if args.http_cache else "",
+        "split_format": args.split_format,
+        "dedup_index_path": os.path.join(workdir, "dedup_index.sqlite3") if args.dedup_index else "",
+        "search_index_dir": os.path.join(workdir, "search-index") if args.search_index else "",
+        "search_queries": args.search_queries,
+        "spark_mode": args.spark_mode,
+        "spark_master": args.spark_master,
+        "mongo_uri": args.mongo_uri,
+    }
+    if args.ner_trimmed and "ner" in stages and not os.path.isdir(config["spacy_trimmed_path"]):
+        subprocess.run([sys.executable, os.path.join(DOCKER_DIR, "spacy-entity-extractor", "app", "ner.py"),
+                        "--save", config["spacy_trimmed_path"]], check=True)
+    if args.entity_cache and "ner" in stages and os.path.exists(config["entity_cache_path"]):
+        os.remove(config["entity_cache_path"])
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    print(f"Benchmark workdir: {workdir}")
+    print(f"Mock API at {server.url}: {collection.total} articles, {args.pages} pages, "
+          f"{config['splits']} splits, {args.latency_ms:.0f}±{args.jitter_ms:.0f} ms latency")
+    rows = []
+    try:
+        for stage in stages:
+            print(f"Running stage {stage}...")
+            rows.append(summarize(stage, run_stage(stage, config_path, workdir)))
+    finally:
+        server.stop()
+
+    print_report(rows)
+    disk = {"raw_mb": folder_size_mb(raw_folder), "augmented_mb": folder_size_mb(augmented_folder)}
+    print(f"\nSplits on disk ({args.split_format}): raw {disk['raw_mb']:.1f} MB, augmented {disk['augmented_mb']:.1f} MB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "stages": rows, "disk": disk}, f, indent=2)
+    sys.exit(1 if any(row["error"] for row in rows) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,27 @@
 # $1 is the username
 
 # Current directory is ~/Documents/Repositorios Bases II/Repositorio Grupal/2025-01-IC4302-PO/PO/docker
-# Navigate to the api directory
-cd controller
-docker build -t $1/controller .
+# All images are built with the docker/ folder as context so they can copy the shared common/ modules
+cd "$(dirname "$0")"
+
+# Build the controller image
+docker build -f controller/Dockerfile -t $1/controller .
 docker push $1/controller
 
 
-# Navigate to the api-crowler directory
-cd ../api-crawler
-cd api-crawler
-docker build -t $1/api-crawler .
+# Build the api-crawler image
+docker build -f api-crawler/Dockerfile -t $1/api-crawler .
 docker push $1/api-crawler
 
 
-# # # # Navigate back and then to spacy-entity-extractor
-cd ../spacy-entity-extractor
-docker build -t $1/spacy-entity-extractor .
+# Build the spacy-entity-extractor image
+docker build -f spacy-entity-extractor/Dockerfile -t $1/spacy-entity-extractor .
 docker push $1/spacy-entity-extractor
 
-# # # Navegar a UI y construir la imagen
-cd ../spark-job-processor
-docker build -t $1/spark-job-processor .
+# Build the spark-job-processor image
+docker build -f spark-job-processor/Dockerfile -t $1/spark-job-processor .
 docker push $1/spark-job-processor
 
 
 # View running containers
-docker ps
\ No newline at end of file
+docker ps
@@ -0,0 +1 @@
+# Módulos compartidos por los servicios del pipeline (se copian en cada imagen)
@@ -0,0 +1,160 @@
+import os
+import time
+import logging
+import argparse
+import pymongo
+from collections import defaultdict
+from common.splitio import SPLIT_FORMAT, FORMAT_EXTENSIONS, LEGACY_EXTENSION, SplitWriter, iter_articles, list_splits, \
+    meta_path_for, parse_split_name, read_meta, strip_extension, write_meta
+
+logger = logging.getLogger(__name__)
+
+# Carpeta (dentro de la de splits) donde quedan los archivos compactados
+ARCHIVE_FOLDER = "archive"
+
+# MongoDB con la colección processed_splits del spark-job-processor
+MONGO_URI = os.getenv("MONGO_URI")
+PROCESSED_QUERY_CHUNK = 1000  # Nombres por consulta $in
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def old_splits(folder, min_age_seconds):
+    """Splits de la carpeta sin modificar hace al menos min_age_seconds, agrupados por jobId."""
+    now = time.time()
+    jobs = defaultdict(list)
+    for filename in list_splits(folder):
+        path = os.path.join(folder, filename)
+        try:
+            jobId, splitNumber = parse_split_name(filename)
+            if now - os.path.getmtime(path) < min_age_seconds:
+                continue
+        except (ValueError, OSError):
+            continue
+        jobs[jobId].append((splitNumber, path))
+    return {jobId: [path for _, path in sorted(paths)] for jobId, paths in jobs.items()}
+
+def ingested_splits(names, mongo_uri=MONGO_URI):
+    """
+    Nombres base (sin extensión) de los splits cuyo archivo aumentado ya
+    está registrado en processed_splits, es decir, que el spark-job-processor
+    ingirió. Vale para /mnt/raw y /mnt/augmented porque el split aumentado
+    conserva el nombre del split crudo.
+    """
+    names = sorted(set(names))
+    extensions = list(FORMAT_EXTENSIONS.values()) + [LEGACY_EXTENSION]
+    client = pymongo.MongoClient(mongo_uri)
+    try:
+        collection = client.get_database().processed_splits
+        ingested = set()
+        for i in range(0, len(names), PROCESSED_QUERY_CHUNK):
+            ids = [name + ext for name in names[i:i + PROCESSED_QUERY_CHUNK] for ext in extensions]
+            ingested.update(strip_extension(doc["_id"]) for doc in collection.find({"_id": {"$in": ids}}, {"_id": 1}))
+        return ingested
+    finally:
+        client.close()
+
+def only_ingested(jobs, ingested):
+    """
+    Deja en cada job solo los splits ya ingeridos; los demás pueden tener
+    todavía un mensaje pendiente que apunta a su ruta, así que no se tocan.
+    """
+    kept = {}
+    for jobId, paths in jobs.items():
+        pending = [path for path in paths if strip_extension(os.path.basename(path)) not in ingested]
+        if pending:
+            logger.info(f"Skipping {len(pending)} splits of job {jobId} not ingested yet: "
+                        f"{[os.path.basename(path) for path in pending]}")
+        ready = [path for path in paths if strip_extension(os.path.basename(path)) in ingested]
+        if ready:
+            kept[jobId] = ready
+    return kept
+
+def compact_job(folder, jobId, paths, split_format):
+    """
+    Une los splits de un job en un solo archivo de archive/ y elimina los
+    originales. El .meta.json del archivo guarda los metadatos de cada split.
+    Devuelve la ruta del archivo compactado (None si no tenía artículos).
+    """
+    archive = os.path.join(folder, ARCHIVE_FOLDER)
+    os.makedirs(archive, exist_ok=True)
+    splits_meta = {strip_extension(os.path.basename(path)): read_meta(path) for path in paths}
+    # El sufijo numérico mantiene el formato <jobId>_<n> de los nombres de split
+    writer = SplitWriter(archive, f"{jobId}_{int(time.time())}", split_format=split_format)
+    with writer:
+        for path in paths:
+            writer.write_many(iter_articles(path))
+    if writer.count:
+        meta = read_meta(writer.path)
+        meta["splits"] = splits_meta
+        write_meta(writer.path, meta)
+    for path in paths:
+        remove_quietly(path)
+        remove_quietly(meta_path_for(path))
+        try:
+            _, splitNumber = parse_split_name(path)
+            remove_quietly(os.path.join(folder, f"{jobId}_summary_{splitNumber}.json"))
+        except ValueError:
+            pass
+    logger.info(f"Compacted {len(paths)} splits of job {jobId} ({writer.count} articles) into "
+                f"{writer.path if writer.count else 'nothing (no articles)'}")
+    return writer.path if writer.count else None
+
+def expire_archives(folder, retention_seconds):
+    """Elimina los archivos compactados más antiguos que retention_seconds."""
+    archive = os.path.join(folder, ARCHIVE_FOLDER)
+    if not os.path.isdir(archive):
+        return 0
+    now = time.time()
+    removed = 0
+    for filename in list_splits(archive):
+        path = os.path.join(archive, filename)
+        if now - os.path.getmtime(path) >= retention_seconds:
+            remove_quietly(path)
+            remove_quietly(meta_path_for(path))
+            removed += 1
+    if removed:
+        logger.info(f"Removed {removed} archived files older than {retention_seconds / 86400:.0f} days")
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge old splits that the Spark processor already ingested (processed_splits in MongoDB) "
+                    "into one compressed file per job and expire old archives")
+    parser.add_argument("folders", nargs="+", help="Split folders, e.g. /mnt/raw /mnt/augmented")
+    parser.add_argument("--min-age-hours", type=float, default=24,
+                        help="Only compact splits not modified for this long")
+    parser.add_argument("--format", dest="split_format", choices=sorted(FORMAT_EXTENSIONS),
+                        default="parquet" if SPLIT_FORMAT == "parquet" else "zstd",
+                        help="Format of the compacted files")
+    parser.add_argument("--retention-days", type=float, default=0,
+                        help="Delete compacted files older than this (0 keeps them)")
+    parser.add_argument("--mongo-uri", default=MONGO_URI,
+                        help="MongoDB holding processed_splits (default MONGO_URI); splits not recorded there are skipped")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what would be compacted")
+    args = parser.parse_args()
+    if not args.mongo_uri:
+        parser.error("MONGO_URI or --mongo-uri is required to know which splits were already ingested")
+
+    for folder in args.folders:
+        jobs = old_splits(folder, args.min_age_hours * 3600)
+        names = [strip_extension(os.path.basename(path)) for paths in jobs.values() for path in paths]
+        jobs = only_ingested(jobs, ingested_splits(names, args.mongo_uri) if names else set())
+        logger.info(f"{folder}: {sum(len(paths) for paths in jobs.values())} splits from {len(jobs)} jobs to compact")
+        for jobId, paths in sorted(jobs.items()):
+            if args.dry_run:
+                logger.info(f"Would compact {len(paths)} splits of job {jobId}")
+                continue
+            compact_job(folder, jobId, paths, args.split_format)
+        if args.retention_days and not args.dry_run:
+            expire_archives(folder, args.retention_days * 86400)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
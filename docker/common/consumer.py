@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import pika
+from common.metrics import counter, gauge, histogram, set_ready, start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Configuración del runtime de consumo
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "1"))  # Mensajes procesados en paralelo
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "0"))  # Ventana de prefetch (0 = CONSUMER_WORKERS)
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "thread")  # "thread" o "process"
+CONSUMER_MEMORY_INTERVAL = float(os.getenv("CONSUMER_MEMORY_INTERVAL", "15"))  # Segundos entre mediciones de memoria
+
+# Métricas comunes a todos los consumidores
+MESSAGES = counter("biorxiv_consumer_messages_total", "Messages handled by the consumer runtime", ["queue", "result"])
+HANDLER_SECONDS = histogram("biorxiv_consumer_handler_seconds", "Time spent handling one message", ["queue"])
+QUEUE_LAG = histogram("biorxiv_consumer_queue_lag_seconds",
+                      "Time between a message being published and a worker starting it", ["queue"])
+IN_FLIGHT = gauge("biorxiv_consumer_in_flight", "Messages being handled", ["queue"])
+WORKER_MEMORY = gauge("biorxiv_consumer_worker_memory_bytes",
+                      "Resident (rss) and proportional (pss) memory of the consumer and its worker processes",
+                      ["queue", "worker", "kind"])
+
+def process_memory(pid="self"):
+    """
+    Memoria de un proceso en bytes según /proc: {"rss": ..., "pss": ...}.
+    PSS reparte las páginas compartidas (por ejemplo, las heredadas con fork
+    y no modificadas) entre los procesos que las usan. None si no se pudo leer.
+    """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    memory[key.lower()] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        memory["rss"] = int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            return None
+    return memory or None
+
+class DiscardMessage(Exception):
+    """El mensaje es inválido: se confirma (ACK) y se descarta sin reintentar."""
+
+class ConsumerRuntime:
+    """
+    Runtime de consumo compartido por los servicios del pipeline.
+
+    Una sola conexión persistente con RabbitMQ vive en el hilo que llama a run()
+    (hilo de I/O): recibe los mensajes, atiende los heartbeats y ejecuta los
+    ACK/NACK y publicaciones que le piden los workers mediante
+    add_callback_threadsafe. N workers procesan los mensajes en paralelo, como
+    hilos o delegando a un pool de procesos (mode="process", el handler debe
+    poder importarse desde el módulo). El ACK se envía solo cuando el handler
+    terminó; si falla el mensaje se reencola.
+
+    El handler recibe el cuerpo del mensaje ya decodificado (JSON) y puede
+    devolver una lista de (cola, mensaje) a publicar antes del ACK.
+    Con SIGTERM/SIGINT se deja de consumir, se terminan los mensajes en curso,
+    se reencolan los que no empezaron y se cierra la conexión.
+    /ready (readinessProbe) responde OK mientras hay conexión y se está
+    consumiendo; en modo process los workers se crean antes de conectar.
+    """
+    def __init__(self, parameters, queue_name, handler, declare=(), workers=CONSUMER_WORKERS,
+                 prefetch=CONSUMER_PREFETCH, mode=CONSUMER_MODE):
+        self.parameters = parameters
+        self.queue_name = queue_name
+        self.handler = handler
+        self.declare = [queue_name] + [q for q in declare if q != queue_name]
+        self.workers = max(1, workers)
+        self.prefetch = prefetch or self.workers
+        self.mode = mode
+        self._work = queue.Queue()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._generation = 0
+        self._connection = None
+        self._channel = None
+        self._confirm_channel = None  # Canal con publisher confirms (se abre al usarlo)
+        self._threads = []
+        self._pool = None
+
+    # --- Hilo de I/O ---
+
+    def run(self):
+        """Consume hasta recibir una señal de parada, reconectando si la conexión se cae."""
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        start_metrics_server()
+        if self.mode == "process":
+            # fork: los procesos heredan lo cargado por el padre (copy-on-write)
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            self._start_processes()
+        threading.Thread(target=self._sample_memory, name="consumer-memory", daemon=True).start()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"consumer-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Consumer runtime started: {self.workers} {self.mode} workers, prefetch {self.prefetch}")
+
+        attempt = 0
+        while not self._stopping.is_set():
+            try:
+                self._connect()
+                set_ready()
+                attempt = 0
+                logger.info(f"Waiting for messages on {self.queue_name}...")
+                while not self._stopping.is_set():
+                    self._connection.process_data_events(time_limit=1)
+                self._shutdown()
+            except pika.exceptions.AMQPError as e:
+                set_ready(False)
+                wait_time = min(2 ** attempt, 30)
+                attempt += 1
+                logger.error(f"RabbitMQ connection error: {e!r}, reconnecting in {wait_time} seconds")
+                self._discard_connection()
+                self._stopping.wait(wait_time)
+        self._stop_workers()
+        logger.info("Consumer runtime stopped")
+
+    def stop(self):
+        set_ready(False)
+        self._stopping.set()
+
+    def _on_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}, shutting down gracefully")
+        self.stop()
+
+    def _start_processes(self):
+        """
+        Crea los procesos del pool antes de consumir (el pool los crea a
+        demanda), para que el primer mensaje no espere el fork y la memoria
+        de cada worker se pueda medir desde el inicio.
+        """
+        for future in [self._pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        pids = self._worker_pids()
+        logger.info(f"Started {len(pids)} worker processes: {pids}")
+
+    def _worker_pids(self):
+        """PIDs de los procesos del pool (vacío en modo thread)."""
+        processes = getattr(self._pool, "_processes", None) or {}
+        return sorted(processes)
+
+    def _sample_memory(self):
+        """Publica y registra en el log la memoria del proceso principal y de cada worker."""
+        logged = False
+        while not self._stopping.is_set():
+            workers = [("main", "self")] + [(f"process-{i}", pid) for i, pid in enumerate(self._worker_pids())]
+            report = []
+            for worker, pid in workers:
+                memory = process_memory(pid)
+                if memory is None:
+                    continue
+                for kind, value in memory.items():
+                    WORKER_MEMORY.set(value, queue=self.queue_name, worker=worker, kind=kind)
+                report.append(f"{worker} " + ", ".join(f"{kind} {value / 1024 / 1024:.0f} MB"
+                                                      for kind, value in sorted(memory.items())))
+            if report and not logged:
+                logger.info(f"Worker memory: {'; '.join(report)}")
+                logged = True
+            self._stopping.wait(CONSUMER_MEMORY_INTERVAL)
+
+    def _connect(self):
+        self._connection = pika.BlockingConnection(self.parameters)
+        self._channel = self._connection.channel()
+        self._confirm_channel = None
+        for name in self.declare:
+            self._channel.queue_declare(queue=name, durable=True)
+        self._channel.basic_qos(prefetch_count=self.prefetch)
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self._channel.basic_consume(queue=self.queue_name,
+                                    on_message_callback=partial(self._on_message, generation))
+        logger.info(f"Connected to RabbitMQ, consuming {self.queue_name}")
+
+    def _on_message(self, generation, channel, method, properties, body):
+        self._work.put((generation, method.delivery_tag, body, properties.timestamp))
+
+    def _shutdown(self):
+        """Cierre ordenado: no aceptar más mensajes, terminar los que están en curso."""
+        try:
+            self._channel.stop_consuming()
+        except pika.exceptions.AMQPError as e:
+            logger.warning(f"Error cancelling consumer: {e!r}")
+        # Reencolar los mensajes recibidos que ningún worker empezó
+        requeued = 0
+        while True:
+            try:
+                item = self._work.get_nowait()
+            except queue.Empty:
+                break
+            self._channel.basic_nack(delivery_tag=item[1], requeue=True)
+            requeued += 1
+        if requeued:
+            logger.info(f"Requeued {requeued} prefetched messages")
+        # Seguir atendiendo la conexión hasta que los workers confirmen lo que tienen en curso
+        while self._in_flight_count():
+            self._connection.process_data_events(time_limit=0.5)
+        self._connection.process_data_events(time_limit=0)
+        self._connection.close()
+        self._connection = None
+
+    def _discard_connection(self):
+        connection = self._connection
+        self._connection = None
+        with self._lock:
+            self._generation += 1  # Los tags de la conexión anterior ya no son válidos
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _stop_workers(self):
+        for _ in self._threads:
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join(timeout=30)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    # --- Workers ---
+
+    def _in_flight_count(self):
+        with self._lock:
+            return self._in_flight
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            generation, delivery_tag, body, published_at = item
+            with self._lock:
+                if generation != self._generation:
+                    continue  # La conexión se perdió, el broker reentregará el mensaje
+                self._in_flight += 1
+            if self._stopping.is_set():
+                # Apagado en curso: no empezar mensajes nuevos, se reencolan
+                self._complete(generation, delivery_tag, [], ack=False)
+                with self._lock:
+                    self._in_flight -= 1
+                continue
+            if published_at:
+                QUEUE_LAG.observe(max(0.0, time.time() - published_at), queue=self.queue_name)
+            IN_FLIGHT.inc(queue=self.queue_name)
+            start = time.perf_counter()
+            try:
+                outgoing = self._handle(body)
+                self._complete(generation, delivery_tag, outgoing or [], ack=True)
+                MESSAGES.inc(queue=self.queue_name, result="ack")
+            except DiscardMessage as e:
+                logger.error(f"Discarding message {body!r}: {e}")
+                self._complete(generation, delivery_tag, [], ack=True)
+                MESSAGES.inc(queue=self.queue_name, result="discard")
+            except Exception as e:
+                logger.error(f"Error processing message, requeueing: {e!r}")
+                self._complete(generation, delivery_tag, [], ack=False)
+                MESSAGES.inc(queue=self.queue_name, result="requeue")
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start, queue=self.queue_name)
+                IN_FLIGHT.dec(queue=self.queue_name)
+                with self._lock:
+                    self._in_flight -= 1
+
+    # --- Operaciones de los handlers (desde cualquier hilo) ---
+
+    def publish(self, routing_key, message):
+        """
+        Publica un mensaje por la conexión de consumo sin esperar al ACK del
+        mensaje en curso. Devuelve False si no hay conexión.
+        """
+        connection = self._connection
+        if connection is None:
+            return False
+        def callback():
+            if self._channel is not None and self._channel.is_open:
+                self._channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=json.dumps(message),
+                    properties=pika.BasicProperties(delivery_mode=2, timestamp=int(time.time()))
+                )
+        try:
+            connection.add_callback_threadsafe(callback)
+            return True
+        except Exception as e:
+            logger.error(f"Could not schedule publish to {routing_key}: {e!r}")
+            return False
+
+    def publish_confirmed(self, routing_key, message, timeout=30):
+        """
+        Publica un mensaje y espera la confirmación del broker (publisher
+        confirms en un canal aparte, para no frenar los ACK del canal de
+        consumo). Devuelve True solo si el broker lo aceptó; False si no hay
+        conexión, lo rechazó o no respondió a tiempo.
+        """
+        connection = self._connection
+        if connection is None:
+            return False
+        done = threading.Event()
+        result = {}
+        def callback():
+            try:
+                if self._confirm_channel is None or not self._confirm_channel.is_open:
+                    self._confirm_channel = self._connection.channel()
+                    self._confirm_channel.confirm_delivery()
+                self._confirm_channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=json.dumps(message),
+                    properties=pika.BasicProperties(delivery_mode=2, timestamp=int(time.time())),
+                    mandatory=True
+                )
+                result["ok"] = True
+            except pika.exceptions.AMQPError as e:
+                logger.error(f"Publish to {routing_key} was not confirmed: {e!r}")
+            finally:
+                done.set()
+        try:
+            connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            logger.error(f"Could not schedule publish to {routing_key}: {e!r}")
+            return False
+        if not done.wait(timeout):
+            logger.error(f"Timed out waiting for the broker to confirm a publish to {routing_key}")
+            return False
+        return result.get("ok", False)
+
+    def queue_status(self, queue=None, timeout=10):
+        """
+        Consulta pasiva de una cola (por defecto la consumida): devuelve
+        (mensajes listos, consumidores) o None si no se pudo obtener.
+        """
+        connection = self._connection
+        if connection is None:
+            return None
+        done = threading.Event()
+        result = {}
+        def callback():
+            try:
+                frame = self._channel.queue_declare(queue=queue or self.queue_name, passive=True)
+                result["status"] = (frame.method.message_count, frame.method.consumer_count)
+            except pika.exceptions.AMQPError as e:
+                logger.warning(f"Could not query queue {queue or self.queue_name}: {e!r}")
+            finally:
+                done.set()
+        try:
+            connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            logger.error(f"Could not schedule queue query: {e!r}")
+            return None
+        done.wait(timeout)
+        return result.get("status")
+
+    def _handle(self, body):
+        try:
+            msg = json.loads(body)
+        except ValueError as e:
+            raise DiscardMessage(f"invalid JSON: {e}")
+        if self._pool is not None:
+            return self._pool.submit(self.handler, msg).result()
+        return self.handler(msg)
+
+    def _complete(self, generation, delivery_tag, outgoing, ack):
+        """Pide al hilo de I/O publicar los mensajes de salida y luego confirmar."""
+        def callback():
+            if generation != self._generation or self._channel is None or not self._channel.is_open:
+                return
+            for routing_key, message in outgoing:
+                self._channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=json.dumps(message),
+                    properties=pika.BasicProperties(delivery_mode=2, timestamp=int(time.time()))
+                )
+            if ack:
+                self._channel.basic_ack(delivery_tag=delivery_tag)
+            else:
+                self._channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        connection = self._connection
+        if connection is None:
+            return
+        try:
+            connection.add_callback_threadsafe(callback)
+        except Exception as e:
+            logger.error(f"Could not schedule ack for message {delivery_tag}: {e!r}")
+
+# Parámetros de conexión a partir de las variables de entorno comunes
+def connection_parameters(heartbeat=30):
+    return pika.ConnectionParameters(
+        host=os.getenv("RABBITMQ_HOST"),
+        credentials=pika.PlainCredentials(os.getenv("RABBITMQ_USER"), os.getenv("RABBITMQ_PASS")),
+        heartbeat=heartbeat,
+        blocked_connection_timeout=60,
+        connection_attempts=5
+    )
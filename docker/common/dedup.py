@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from common.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Índice de deduplicación (una ruta vacía lo deshabilita). Para volver a
+# procesar todo, por ejemplo después de vaciar la colección documents, basta
+# con borrar el archivo
+DEDUP_INDEX_PATH = os.getenv("DEDUP_INDEX_PATH", "/mnt/augmented/.dedup_index.sqlite3")
+
+# Registros descartados por ser idénticos a uno ya procesado, por etapa ("ner" o "spark")
+SKIPPED = counter("biorxiv_dedup_skipped_total", "Records skipped because an identical copy was already processed", ["stage"])
+
+def record_key(record):
+    """Clave de un artículo: rel_doi y, si viene, su versión. None si no tiene DOI."""
+    doi = record.get("rel_doi")
+    if not doi:
+        return None
+    version = record.get("version")
+    return f"{doi}v{version}" if version else doi
+
+def fingerprint(record, exclude=()):
+    """Huella del contenido de un registro (sin los campos de exclude)."""
+    content = {key: value for key, value in record.items() if key not in exclude}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+class DedupIndex:
+    """
+    Índice persistente (DOI/versión -> huella del contenido) de los registros
+    que una etapa ya procesó, guardado en SQLite en el volumen compartido.
+    seen() indica si un registro es idéntico a uno ya procesado; los nuevos o
+    modificados quedan pendientes y se guardan con commit() una vez que la
+    etapa terminó su trabajo (o se descartan con discard() si falló), de modo
+    que un fallo nunca deja marcado un registro que no se procesó.
+    Con commit(split) los registros quedan preparados a nombre del split y
+    solo cuentan como procesados cuando la etapa siguiente lo confirma con
+    confirm_splits() (el extractor los prepara y el spark-job-processor los
+    confirma al ingerir el split), así un split que se pierde antes de
+    ingerirse se vuelve a procesar en el próximo crawl.
+    Cada etapa usa su propio espacio de claves. Igual que la caché de
+    entidades, usa el journal por defecto (WAL no es seguro en NFS) y las
+    conexiones no se comparten entre hilos ni procesos.
+    """
+    def __init__(self, path, stage, exclude=()):
+        self.path = path
+        self.stage = stage
+        self.exclude = tuple(exclude)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed ("
+            " stage TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (stage, key))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS staged ("
+            " stage TEXT NOT NULL,"
+            " split TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (stage, split, key))"
+        )
+        self.conn.commit()
+        self.pending = {}
+        self.skipped = 0
+
+    def seen(self, record):
+        """True si ya se procesó una copia idéntica del registro (antes o en el lote en curso)."""
+        key = record_key(record)
+        if key is None:
+            return False
+        digest = fingerprint(record, self.exclude)
+        if self.pending.get(key) == digest:
+            self.skipped += 1
+            return True
+        row = self.conn.execute("SELECT fingerprint FROM processed WHERE stage = ? AND key = ?",
+                                (self.stage, key)).fetchone()
+        if row is not None and row[0] == digest:
+            self.skipped += 1
+            return True
+        self.pending[key] = digest
+        return False
+
+    def commit(self, split=None):
+        """
+        Registra como procesados los registros nuevos o modificados del lote.
+        Con split solo quedan preparados hasta que se confirme ese split.
+        """
+        if not self.pending:
+            return
+        now = time.time()
+        with self.conn:
+            if split is None:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO processed (stage, key, fingerprint, updated) VALUES (?, ?, ?, ?)",
+                    [(self.stage, key, digest, now) for key, digest in self.pending.items()]
+                )
+            else:
+                # Un reproceso del split reemplaza lo que había preparado antes
+                self.conn.execute("DELETE FROM staged WHERE stage = ? AND split = ?", (self.stage, split))
+                self.conn.executemany(
+                    "INSERT INTO staged (stage, split, key, fingerprint, updated) VALUES (?, ?, ?, ?, ?)",
+                    [(self.stage, split, key, digest, now) for key, digest in self.pending.items()]
+                )
+        self.pending.clear()
+
+    def confirm(self, splits):
+        """Pasa a procesados los registros preparados de los splits. Devuelve cuántos."""
+        splits = list(splits)
+        now = time.time()
+        with self.conn:
+            confirmed = 0
+            for split in splits:
+                confirmed += self.conn.execute(
+                    "INSERT OR REPLACE INTO processed (stage, key, fingerprint, updated)"
+                    " SELECT stage, key, fingerprint, ? FROM staged WHERE stage = ? AND split = ?",
+                    (now, self.stage, split)
+                ).rowcount
+                self.conn.execute("DELETE FROM staged WHERE stage = ? AND split = ?", (self.stage, split))
+        return confirmed
+
+    def discard(self):
+        """Olvida los registros pendientes (el lote no llegó a procesarse)."""
+        self.pending.clear()
+
+    def close(self):
+        self.conn.close()
+
+def confirm_splits(stage, splits, path=DEDUP_INDEX_PATH):
+    """
+    Confirma los registros que una etapa preparó para esos splits (nombres
+    sin extensión). Los errores se registran y no interrumpen al llamador:
+    en el peor caso los artículos se vuelven a procesar.
+    """
+    if not path or not splits:
+        return 0
+    index = None
+    try:
+        index = DedupIndex(path, stage)
+        return index.confirm(splits)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Could not confirm {len(splits)} splits in the dedup index {path}: {e}")
+        return 0
+    finally:
+        if index is not None:
+            index.close()
+
+def open_dedup_index(stage, exclude=(), path=DEDUP_INDEX_PATH):
+    """Índice configurado por el entorno, o None si está deshabilitado o no se pudo abrir."""
+    if not path:
+        return None
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return DedupIndex(path, stage, exclude)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Dedup index disabled, could not open {path}: {e}")
+        return None
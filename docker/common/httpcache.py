@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from common.metrics import counter
+
+logger = logging.getLogger(__name__)
+
+# Configuración de la caché de respuestas HTTP (en el volumen compartido)
+HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", "/mnt/raw/.http-cache")  # Vacío = sin caché
+HTTP_CACHE_MAX_MB = float(os.getenv("HTTP_CACHE_MAX_MB", "1024"))  # Tamaño máximo; se descartan las menos usadas
+
+# Resultado de cada consulta a la caché:
+#   revalidated: el servidor respondió 304 y se usó la copia guardada
+#   miss: no había copia (o cambió) y se guardó la respuesta nueva
+LOOKUPS = counter("biorxiv_http_cache_requests_total", "HTTP requests served through the response cache", ["result"])
+
+class CachedResponse:
+    """Respuesta servida desde la caché, con la interfaz de requests que usan los servicios."""
+    def __init__(self, url, content, headers):
+        self.url = url
+        self.status_code = 200
+        self.ok = True
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+class ResponseCache:
+    """
+    Caché de respuestas GET en disco, compartida entre procesos y pods.
+
+    Cada URL se guarda en <sha1>.entry: una línea JSON con la URL, los
+    validadores (ETag/Last-Modified) y el momento en que se guardó, seguida
+    del cuerpo de la respuesta. Cada uso hace una solicitud condicional si
+    hay validadores (un 304 devuelve la copia sin volver a transferirla) o
+    una normal si no los hay; nunca se sirve una copia sin consultar al
+    servidor, porque la API lista primero los artículos más recientes y el
+    contenido de cada página se desplaza con cada preprint nuevo.
+    La fecha de modificación del archivo registra el último uso y, cuando la
+    carpeta supera max_bytes, se eliminan las entradas usadas hace más tiempo.
+    """
+    def __init__(self, folder=HTTP_CACHE_DIR, max_bytes=int(HTTP_CACHE_MAX_MB * 1024 * 1024)):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None  # Estimación del tamaño de la carpeta, se recalcula al podar
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".entry")
+
+    def _read(self, url):
+        try:
+            with open(self._path(url), "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        if header.get("url") != url:
+            return None, None
+        return header, body
+
+    def _write(self, url, header, body):
+        path = self._path(url)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(header).encode("utf-8") + b"\n")
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache response for {url}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._grow(len(body))
+
+    def _touch(self, url):
+        try:
+            os.utime(self._path(url))
+        except OSError:
+            pass
+
+    def discard(self, url):
+        """Elimina la copia de la URL (por ejemplo, si resultó inválida)."""
+        try:
+            os.remove(self._path(url))
+        except OSError:
+            pass
+
+    def get(self, session, url, **kwargs):
+        """
+        GET condicional a través de la caché con la sesión dada. Devuelve la
+        respuesta de requests o un CachedResponse (304); solo se guardan las
+        respuestas 200.
+        """
+        header, body = self._read(url)
+        request_headers = dict(kwargs.pop("headers", None) or {})
+        if header is not None:
+            if header.get("etag"):
+                request_headers["If-None-Match"] = header["etag"]
+            if header.get("lastModified"):
+                request_headers["If-Modified-Since"] = header["lastModified"]
+        response = session.get(url, headers=request_headers, **kwargs)
+
+        if response.status_code == 304 and header is not None:
+            self._touch(url)
+            LOOKUPS.inc(result="revalidated")
+            return CachedResponse(url, body, header.get("headers", {}))
+        if response.status_code == 200:
+            self._write(url, {
+                "url": url,
+                "storedAt": time.time(),
+                "etag": response.headers.get("ETag"),
+                "lastModified": response.headers.get("Last-Modified"),
+                "headers": {"Content-Type": response.headers.get("Content-Type", "")}
+            }, response.content)
+        LOOKUPS.inc(result="miss")
+        return response
+
+    # --- Límite de tamaño ---
+
+    def _grow(self, nbytes):
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            self._size += nbytes
+            over = self.max_bytes and self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _disk_usage(self):
+        total = 0
+        for entry in os.scandir(self.folder):
+            try:
+                total += entry.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def evict(self):
+        """Elimina las entradas usadas hace más tiempo hasta bajar al 90% de max_bytes."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Otro proceso la eliminó
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size = sum(nbytes for _, nbytes, _ in entries)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _, nbytes, path in sorted(entries):
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+                size -= nbytes
+            self._size = size
+        if removed:
+            logger.info(f"Evicted {removed} cached responses, cache size {size / 1024 / 1024:.1f} MB")
+
+def get_response_cache():
+    """Caché configurada por las variables de entorno, o None si HTTP_CACHE_DIR está vacío."""
+    if not HTTP_CACHE_DIR:
+        return None
+    try:
+        return ResponseCache()
+    except OSError as e:
+        logger.warning(f"HTTP response cache disabled, cannot use {HTTP_CACHE_DIR}: {e}")
+        return None
@@ -0,0 +1,184 @@
+import time
+import logging
+import threading
+import pika
+
+logger = logging.getLogger(__name__)
+
+class PublishError(Exception):
+    """The connection or channel failed before every message was confirmed."""
+
+class ConfirmedPublisher:
+    """
+    Publicador de larga duración con publisher confirms.
+    Usa una SelectConnection cuyo ioloop corre en un hilo propio (que también
+    atiende los heartbeats). publish_batch envía todos los mensajes del lote
+    sin esperar entre ellos y luego espera las confirmaciones del broker,
+    así el costo es un round-trip por lote y no uno por mensaje.
+    """
+    def __init__(self, parameters, queues=()):
+        self.parameters = parameters
+        self.queues = list(queues)
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._cond = threading.Condition()
+        self._delivery_tag = 0
+        self._pending = {}  # delivery_tag -> (routing_key, body)
+        self._nacked = []
+        self._published_all = True
+        self._error = None
+
+    # --- Ciclo de vida (hilo del llamador) ---
+
+    def start(self, timeout=30):
+        self._connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed
+        )
+        self._thread = threading.Thread(target=self._connection.ioloop.start, name="rabbitmq-publisher", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout) or self._error:
+            self.close()
+            raise PublishError(f"Could not open publisher channel: {self._error or 'timeout'}")
+        logger.info("Publisher connected with confirms enabled")
+        return self
+
+    @property
+    def is_open(self):
+        return self._ready.is_set() and self._error is None
+
+    def close(self):
+        connection = self._connection
+        if connection is None:
+            return
+        try:
+            if connection.is_open:
+                connection.ioloop.add_callback_threadsafe(connection.close)
+            else:
+                connection.ioloop.add_callback_threadsafe(connection.ioloop.stop)
+        except Exception as e:
+            logger.debug(f"Error scheduling publisher close: {e}")
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        self._connection = None
+
+    def publish_batch(self, routing_key, bodies, properties=None, timeout=60):
+        """
+        Publica los mensajes en orden y espera a que el broker confirme todos.
+        Devuelve la lista de cuerpos rechazados (nack) para que el llamador los
+        reintente; lanza PublishError si la conexión falla antes de confirmar.
+        """
+        if not bodies:
+            return []
+        if not self.is_open:
+            raise PublishError(f"Publisher is not connected: {self._error}")
+        # El timestamp permite a los consumidores medir el tiempo en cola
+        properties = properties or pika.BasicProperties(delivery_mode=2, timestamp=int(time.time()))
+        with self._cond:
+            self._nacked = []
+            self._published_all = False
+        self._connection.ioloop.add_callback_threadsafe(
+            lambda: self._publish(routing_key, list(bodies), properties)
+        )
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Esperar a que se publique el lote completo y se confirme todo lo pendiente
+            self._cond.wait_for(lambda: self._error is not None or self._published_all, timeout)
+            while self._error is None and self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PublishError(f"Timed out waiting for {len(self._pending)} confirms")
+                self._cond.wait(remaining)
+            if self._error is not None:
+                raise PublishError(f"Connection lost with {len(self._pending)} unconfirmed messages: {self._error}")
+            nacked = self._nacked
+            self._nacked = []
+        return [body for _, body in nacked]
+
+    def queue_status(self, queue, timeout=10):
+        """
+        Consulta pasiva de una cola (no la crea): devuelve
+        (mensajes listos, consumidores) o None si no se pudo obtener.
+        """
+        if not self.is_open:
+            return None
+        done = threading.Event()
+        result = {}
+        def on_declare_ok(frame):
+            result["status"] = (frame.method.message_count, frame.method.consumer_count)
+            done.set()
+        self._connection.ioloop.add_callback_threadsafe(
+            lambda: self._channel.queue_declare(queue=queue, passive=True, callback=on_declare_ok)
+        )
+        if not done.wait(timeout):
+            logger.warning(f"Timed out querying queue {queue}")
+            return None
+        return result["status"]
+
+    # --- Callbacks del ioloop ---
+
+    def _publish(self, routing_key, bodies, properties):
+        try:
+            for body in bodies:
+                self._channel.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+                self._delivery_tag += 1
+                with self._cond:
+                    self._pending[self._delivery_tag] = (routing_key, body)
+        except Exception as e:
+            self._fail(e)
+        with self._cond:
+            self._published_all = True
+            self._cond.notify_all()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        self._fail(error)
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self._fail(reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        self._declare_queues(list(self.queues))
+
+    def _declare_queues(self, queues):
+        if not queues:
+            self._channel.confirm_delivery(self._on_delivery_confirmation, callback=lambda _: self._ready.set())
+            return
+        queue = queues.pop(0)
+        self._channel.queue_declare(queue=queue, durable=True, callback=lambda _: self._declare_queues(queues))
+
+    def _on_channel_closed(self, channel, reason):
+        self._fail(reason)
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self._cond:
+            if method.multiple:
+                tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag]
+            for tag in tags:
+                message = self._pending.pop(tag, None)
+                if message is not None and not acked:
+                    self._nacked.append(message)
+            self._cond.notify_all()
+
+    def _fail(self, error):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+        self._ready.set()
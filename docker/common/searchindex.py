@@ -0,0 +1,490 @@
+import os
+import re
+import json
+import math
+import mmap
+import time
+import heapq
+import random
+import shutil
+import logging
+import argparse
+from itertools import accumulate
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Índice invertido local (BM25) sobre rel_title y rel_abs, alternativo a Atlas
+# Search. Lo construye el spark-job-processor a medida que guarda los splits
+# (una ruta vacía lo deshabilita)
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", "/mnt/augmented/.search-index")
+# Cantidad de segmentos de un mismo nivel que se fusionan en uno
+SEARCH_INDEX_MERGE_FACTOR = int(os.getenv("SEARCH_INDEX_MERGE_FACTOR", "8"))
+
+# Parámetros de BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TEXT_FIELDS = ("rel_title", "rel_abs")
+# Facets por los que se puede filtrar (en entities, las etiquetas de las entidades)
+FACET_FIELDS = ("category", "type", "entities")
+# Columnas de la tabla de documentos de cada segmento
+DOC_COLUMNS = ("rel_doi", "seq", "length", "rel_title", "category", "type", "entities")
+
+MANIFEST = "manifest.json"
+SEGMENT_PREFIX = "seg_"
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Formato en disco (carpeta SEARCH_INDEX_DIR):
+#   manifest.json          -> {"generation": N, "segments": [{"name": ..., "docs": ...}]}
+#   seg_<n>/docs.json      -> columnas DOC_COLUMNS; el doc id es la posición en la lista
+#   seg_<n>/terms.json     -> {término: [df, offset, bytes]} dentro de postings.bin
+#   seg_<n>/postings.bin   -> por término, pares (delta de doc id, frecuencia) en varint
+# Los segmentos no se modifican: cada grupo de splits agrega uno nuevo y los
+# segmentos pequeños se fusionan en uno mayor. Cada documento guarda el número
+# de generación (seq) del segmento donde se agregó; si un rel_doi aparece en
+# varios segmentos solo cuenta el de seq mayor (la versión más reciente).
+
+def tokenize(text):
+    """Términos de un texto: palabras en minúsculas."""
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+def document_entry(record):
+    """Entrada de índice de un artículo (términos y facets), o None si no tiene DOI."""
+    doi = record.get("rel_doi")
+    if not doi:
+        return None
+    tokens = []
+    for field in TEXT_FIELDS:
+        tokens.extend(tokenize(record.get(field)))
+    labels = sorted({entity["label"] for entity in record.get("entities") or [] if entity and entity["label"]})
+    return {
+        "rel_doi": doi,
+        "rel_title": record.get("rel_title") or "",
+        "length": len(tokens),
+        "terms": dict(Counter(tokens)),
+        "category": record.get("category"),
+        "type": record.get("type"),
+        "entities": labels,
+    }
+
+def index_entries(rows, file_column=None):
+    """
+    Para mapPartitions en los executors de Spark: entradas de índice de las
+    filas de una partición, como pares (archivo de origen, entrada).
+    """
+    for row in rows:
+        record = row.asDict(recursive=True)
+        entry = document_entry(record)
+        if entry is not None:
+            yield record.get(file_column) if file_column else None, entry
+
+# --- Postings comprimidos ---
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encode_postings(pairs):
+    """Codifica una lista de (doc id, frecuencia) ordenada por doc id."""
+    out = bytearray()
+    previous = 0
+    for doc_id, tf in pairs:
+        _write_varint(out, doc_id - previous)
+        _write_varint(out, tf)
+        previous = doc_id
+    return bytes(out)
+
+def decode_postings(data):
+    """Inverso de encode_postings: lista de (doc id, frecuencia)."""
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return list(zip(accumulate(values[0::2]), values[1::2]))
+
+# --- Segmentos ---
+
+def write_segment(folder, name, columns, postings):
+    """
+    Escribe un segmento a partir de sus columnas de documentos y de los
+    postings (pares término, lista de (doc id, frecuencia)) ordenados por
+    término. Se escribe en una carpeta temporal que se renombra al terminar.
+    """
+    path = os.path.join(folder, name)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    terms = {}
+    offset = 0
+    with open(os.path.join(tmp_path, "postings.bin"), "wb") as f:
+        for term, pairs in postings:
+            data = encode_postings(pairs)
+            f.write(data)
+            terms[term] = [len(pairs), offset, len(data)]
+            offset += len(data)
+    with open(os.path.join(tmp_path, "terms.json"), "w", encoding="utf-8") as f:
+        json.dump(terms, f, ensure_ascii=False)
+    with open(os.path.join(tmp_path, "docs.json"), "w", encoding="utf-8") as f:
+        json.dump(columns, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def read_doc_columns(folder, name, columns=DOC_COLUMNS):
+    with open(os.path.join(folder, name, "docs.json"), "r", encoding="utf-8") as f:
+        docs = json.load(f)
+    return {column: docs[column] for column in columns}
+
+class Segment:
+    """Segmento abierto para lectura; postings.bin se accede con mmap."""
+    def __init__(self, folder, name):
+        self.name = name
+        self.docs = read_doc_columns(folder, name)
+        with open(os.path.join(folder, name, "terms.json"), "r", encoding="utf-8") as f:
+            self.terms = json.load(f)
+        self._file = open(os.path.join(folder, name, "postings.bin"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def __len__(self):
+        return len(self.docs["rel_doi"])
+
+    def doc_freq(self, term):
+        entry = self.terms.get(term)
+        return entry[0] if entry else 0
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return []
+        _, offset, length = entry
+        return decode_postings(self._mmap[offset:offset + length])
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"generation": 0, "segments": []}
+
+def write_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def latest_versions(folder, names):
+    """rel_doi -> seq de su versión más reciente entre los segmentos dados."""
+    latest = {}
+    for name in names:
+        docs = read_doc_columns(folder, name, ("rel_doi", "seq"))
+        for doi, seq in zip(docs["rel_doi"], docs["seq"]):
+            if seq > latest.get(doi, -1):
+                latest[doi] = seq
+    return latest
+
+class IndexWriter:
+    """
+    Agrega segmentos al índice y fusiona los del mismo nivel (los niveles
+    son potencias de merge_factor en cantidad de documentos), de modo que la
+    cantidad de segmentos crece de forma logarítmica con el tamaño del índice.
+    El manifiesto se reemplaza de forma atómica, así que los lectores siempre
+    ven un conjunto completo de segmentos. Debe haber un solo escritor (el
+    driver del spark-job-processor).
+    """
+    def __init__(self, folder=SEARCH_INDEX_DIR, merge_factor=SEARCH_INDEX_MERGE_FACTOR):
+        self.folder = folder
+        self.merge_factor = max(2, merge_factor)
+        os.makedirs(folder, exist_ok=True)
+        self.manifest = read_manifest(folder)
+        self._remove_orphans()
+
+    def _remove_orphans(self):
+        """Elimina los segmentos que no están en el manifiesto (escrituras o fusiones interrumpidas)."""
+        listed = {segment["name"] for segment in self.manifest["segments"]}
+        for name in os.listdir(self.folder):
+            if name.startswith(SEGMENT_PREFIX) and name not in listed:
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def _next_generation(self):
+        self.manifest["generation"] += 1
+        return self.manifest["generation"]
+
+    def add(self, entries):
+        """Agrega las entradas (de document_entry) como un segmento nuevo. Devuelve su nombre."""
+        # Dentro del lote, la última versión de cada DOI reemplaza a las anteriores
+        entries = list({entry["rel_doi"]: entry for entry in entries}.values())
+        if not entries:
+            return None
+        seq = self._next_generation()
+        name = f"{SEGMENT_PREFIX}{seq}"
+        columns = {column: [] for column in DOC_COLUMNS}
+        postings = {}
+        for doc_id, entry in enumerate(entries):
+            for column in DOC_COLUMNS:
+                columns[column].append(seq if column == "seq" else entry[column])
+            for term, tf in entry["terms"].items():
+                postings.setdefault(term, []).append((doc_id, tf))
+        write_segment(self.folder, name, columns, sorted(postings.items()))
+        self.manifest["segments"].append({"name": name, "docs": len(entries)})
+        write_manifest(self.folder, self.manifest)
+        logger.info(f"Search index: added segment {name} with {len(entries)} documents")
+        self.maybe_merge()
+        return name
+
+    def _level(self, docs):
+        return int(math.log(max(docs, 1), self.merge_factor))
+
+    def maybe_merge(self):
+        """Fusiona segmentos mientras algún nivel tenga merge_factor o más."""
+        while True:
+            levels = {}
+            for segment in self.manifest["segments"]:
+                levels.setdefault(self._level(segment["docs"]), []).append(segment["name"])
+            full = [names for _, names in sorted(levels.items()) if len(names) >= self.merge_factor]
+            if not full:
+                return
+            self.merge(full[0])
+
+    def merge(self, names):
+        """
+        Fusiona los segmentos dados en uno. Se descartan los documentos
+        reemplazados por una versión más reciente en cualquier segmento.
+        """
+        start = time.time()
+        all_names = [segment["name"] for segment in self.manifest["segments"]]
+        latest = latest_versions(self.folder, all_names)
+        segments = [Segment(self.folder, name) for name in names]
+        try:
+            columns = {column: [] for column in DOC_COLUMNS}
+            remaps = []
+            for segment in segments:
+                remap = {}
+                for doc_id, (doi, seq) in enumerate(zip(segment.docs["rel_doi"], segment.docs["seq"])):
+                    if latest.get(doi) != seq:
+                        continue
+                    remap[doc_id] = len(columns["rel_doi"])
+                    for column in DOC_COLUMNS:
+                        columns[column].append(segment.docs[column][doc_id])
+                remaps.append(remap)
+
+            def merged_postings():
+                for term in sorted(set().union(*(segment.terms for segment in segments))):
+                    pairs = []
+                    for segment, remap in zip(segments, remaps):
+                        pairs.extend((remap[doc_id], tf) for doc_id, tf in segment.postings(term) if doc_id in remap)
+                    if pairs:
+                        yield term, sorted(pairs)
+
+            name = f"{SEGMENT_PREFIX}{self._next_generation()}"
+            write_segment(self.folder, name, columns, merged_postings())
+        finally:
+            for segment in segments:
+                segment.close()
+
+        merged = set(names)
+        position = min(all_names.index(merged_name) for merged_name in names)
+        kept = [segment for segment in self.manifest["segments"] if segment["name"] not in merged]
+        kept.insert(position, {"name": name, "docs": len(columns["rel_doi"])})
+        self.manifest["segments"] = kept
+        write_manifest(self.folder, self.manifest)
+        for merged_name in names:
+            shutil.rmtree(os.path.join(self.folder, merged_name), ignore_errors=True)
+        logger.info(f"Search index: merged {len(names)} segments into {name} "
+                    f"({len(columns['rel_doi'])} documents, {time.time() - start:.2f} s)")
+        return name
+
+class SearchIndex:
+    """
+    Lector del índice: devuelve los k documentos con mayor puntaje BM25 para
+    una consulta, filtrados por facets. La frecuencia de documento de cada
+    término incluye las versiones reemplazadas que aún no se fusionaron (como
+    en Lucene), lo que solo afecta levemente el idf.
+    """
+    def __init__(self, folder=SEARCH_INDEX_DIR):
+        self.folder = folder
+        self.segments = []
+        self.live = []
+        self.total_docs = 0
+        self.avg_length = 0.0
+        self._manifest_mtime = None
+        self.refresh()
+
+    def refresh(self):
+        """Vuelve a abrir los segmentos si el manifiesto cambió. Devuelve True si cambió."""
+        try:
+            mtime = os.stat(os.path.join(self.folder, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._manifest_mtime:
+            return False
+        manifest = read_manifest(self.folder)
+        opened = {segment.name: segment for segment in self.segments}
+        segments = []
+        for entry in manifest["segments"]:
+            segment = opened.pop(entry["name"], None)
+            segments.append(segment if segment is not None else Segment(self.folder, entry["name"]))
+        for segment in opened.values():
+            segment.close()
+
+        latest = {}
+        for segment in segments:
+            for doi, seq in zip(segment.docs["rel_doi"], segment.docs["seq"]):
+                latest[doi] = max(seq, latest.get(doi, -1))
+        self.live = [[latest[doi] == seq for doi, seq in zip(segment.docs["rel_doi"], segment.docs["seq"])]
+                     for segment in segments]
+        self.segments = segments
+        self.total_docs = sum(sum(live) for live in self.live)
+        total_length = sum(length for segment, live in zip(segments, self.live)
+                           for length, alive in zip(segment.docs["length"], live) if alive)
+        self.avg_length = total_length / self.total_docs if self.total_docs else 0.0
+        self._manifest_mtime = mtime
+        return True
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def _matches(self, segment, doc_id, facets):
+        for field, values in facets.items():
+            value = segment.docs[field][doc_id]
+            if field == "entities":
+                if not values.intersection(value):
+                    return False
+            elif value not in values:
+                return False
+        return True
+
+    def search(self, query, k=10, facets=None):
+        """
+        Top k de la consulta como lista de {"rel_doi", "rel_title", "category",
+        "type", "score"}. facets es {campo: [valores]} con la misma semántica
+        que la API (un valor cualquiera de cada campo, todos los campos).
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.total_docs:
+            return []
+        facets = {field: set(values) for field, values in (facets or {}).items() if values}
+        unknown = set(facets) - set(FACET_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown facet fields {sorted(unknown)}, expected some of {FACET_FIELDS}")
+
+        scores = {}
+        for term in terms:
+            df = sum(segment.doc_freq(term) for segment in self.segments)
+            if not df:
+                continue
+            idf = math.log(1 + (self.total_docs - df + 0.5) / (df + 0.5))
+            for segment_id, (segment, live) in enumerate(zip(self.segments, self.live)):
+                lengths = segment.docs["length"]
+                for doc_id, tf in segment.postings(term):
+                    if not live[doc_id]:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / self.avg_length)
+                    key = (segment_id, doc_id)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        if facets:
+            candidates = ((key, score) for key, score in scores.items()
+                          if self._matches(self.segments[key[0]], key[1], facets))
+        else:
+            candidates = scores.items()
+        results = []
+        for (segment_id, doc_id), score in heapq.nlargest(k, candidates, key=lambda item: item[1]):
+            docs = self.segments[segment_id].docs
+            results.append({
+                "rel_doi": docs["rel_doi"][doc_id],
+                "rel_title": docs["rel_title"][doc_id],
+                "category": docs["category"][doc_id],
+                "type": docs["type"][doc_id],
+                "score": score,
+            })
+        return results
+
+    def stats(self):
+        return {
+            "documents": self.total_docs,
+            "segments": len(self.segments),
+            "terms": len(set().union(*(segment.terms for segment in self.segments))) if self.segments else 0,
+            "avg_length": self.avg_length,
+        }
+
+# --- Medición de latencia ---
+
+def sample_queries(index, count, terms_per_query=2, seed=0):
+    """Consultas de prueba con palabras de títulos de documentos del índice."""
+    rng = random.Random(seed)
+    titles = [title for segment in index.segments for title in segment.docs["rel_title"] if title]
+    queries = []
+    for _ in range(count if titles else 0):
+        words = [word for word in tokenize(rng.choice(titles)) if len(word) > 3] or tokenize(rng.choice(titles))
+        if words:
+            queries.append(" ".join(rng.sample(words, min(terms_per_query, len(words)))))
+    return queries
+
+def measure_queries(index, queries, k=10):
+    """Latencia (segundos) de cada consulta."""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, k)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the local BM25 search index built by the spark-job-processor")
+    parser.add_argument("--index", default=SEARCH_INDEX_DIR, help="Index folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+    search = commands.add_parser("search", help="Print the top k documents of a query")
+    search.add_argument("query")
+    search.add_argument("--k", type=int, default=10)
+    for field in FACET_FIELDS:
+        search.add_argument(f"--{field}", action="append", help=f"Only documents with this {field} (repeatable)")
+    commands.add_parser("stats", help="Print the size of the index")
+    bench = commands.add_parser("bench", help="Measure query latency with queries sampled from the index")
+    bench.add_argument("--queries", type=int, default=200)
+    bench.add_argument("--k", type=int, default=10)
+    bench.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index = SearchIndex(args.index)
+    try:
+        if args.command == "search":
+            facets = {field: getattr(args, field) for field in FACET_FIELDS if getattr(args, field)}
+            for result in index.search(args.query, args.k, facets):
+                print(json.dumps(result, ensure_ascii=False))
+        elif args.command == "stats":
+            print(json.dumps(index.stats()))
+        else:
+            latencies = measure_queries(index, sample_queries(index, args.queries, seed=args.seed), args.k)
+            stats = index.stats()
+            print(f"{stats['documents']} documents in {stats['segments']} segments, {stats['terms']} terms: "
+                  f"{len(latencies)} queries, p50 {(percentile(latencies, 50) or 0) * 1000:.2f} ms, "
+                  f"p99 {(percentile(latencies, 99) or 0) * 1000:.2f} ms")
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    main()
@@ -0,0 +1,286 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Formato de los splits en /mnt/raw y /mnt/augmented:
+#   <jobId>_<splitNumber>.ndjson     -> un artículo por línea
+#   <jobId>_<splitNumber>.meta.json  -> {"messages": [...], "count": N, "trace": {...}}
+# "trace" guarda los tiempos de cada etapa que procesó el split
+# ({"crawl": {"start": ..., "end": ...}, "ner": {...}}, en segundos epoch).
+# Con SPLIT_FORMAT los datos pueden escribirse también como NDJSON comprimido
+# con zstd (.ndjson.zst) o como Parquet (.parquet, con las columnas de
+# ARTICLE_FIELDS); el .meta.json es el mismo en los tres formatos y los
+# lectores reconocen el formato por la extensión.
+# Los splits antiguos (<jobId>_<splitNumber>.json con "messages" y "collection")
+# se siguen pudiendo leer.
+SPLIT_FORMAT = os.getenv("SPLIT_FORMAT", "ndjson")  # "ndjson", "zstd" o "parquet"
+SPLIT_ZSTD_LEVEL = int(os.getenv("SPLIT_ZSTD_LEVEL", "3"))  # Nivel de compresión de zstd (1-22)
+SPLIT_EXTENSION = ".ndjson"
+ZSTD_EXTENSION = ".ndjson.zst"
+PARQUET_EXTENSION = ".parquet"
+META_EXTENSION = ".meta.json"
+LEGACY_EXTENSION = ".json"
+FORMAT_EXTENSIONS = {"ndjson": SPLIT_EXTENSION, "zstd": ZSTD_EXTENSION, "parquet": PARQUET_EXTENSION}
+
+# Campos de los artículos que se guardan en Parquet (los que usan el extractor
+# y el spark-job-processor, más version, que forma parte de la clave de
+# deduplicación); los demás campos de la API se descartan
+ARTICLE_FIELDS = ("rel_title", "rel_doi", "rel_link", "rel_abs", "rel_num_authors", "rel_authors",
+                  "rel_date", "rel_site", "category", "type", "entities", "version")
+PARQUET_ROW_GROUP_SIZE = 1024
+
+def split_name(jobId, splitNumber):
+    """Nombre base de un split, sin extensión."""
+    return f"{jobId}_{splitNumber}"
+
+def parse_split_name(filename):
+    """Devuelve (jobId, splitNumber) a partir del nombre de un archivo de split."""
+    jobId, splitNumber = strip_extension(os.path.basename(filename)).rsplit("_", 1)
+    return jobId, int(splitNumber)
+
+def strip_extension(filename):
+    """Devuelve el nombre base de un archivo de split (en cualquier formato)."""
+    for ext in (ZSTD_EXTENSION, SPLIT_EXTENSION, PARQUET_EXTENSION, META_EXTENSION, LEGACY_EXTENSION):
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+def detect_format(path):
+    """Formato de un archivo de split según su extensión ("ndjson", "zstd", "parquet" o "legacy")."""
+    for split_format, ext in FORMAT_EXTENSIONS.items():
+        if path.endswith(ext):
+            return split_format
+    return "legacy"
+
+def find_split(folder, name):
+    """
+    Busca el archivo de datos de un split en la carpeta.
+    Prefiere los formatos actuales y recurre al JSON antiguo si no existen.
+    Devuelve la ruta o None si no hay ninguno.
+    """
+    for ext in (SPLIT_EXTENSION, ZSTD_EXTENSION, PARQUET_EXTENSION, LEGACY_EXTENSION):
+        path = os.path.join(folder, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def list_splits(folder):
+    """Lista los archivos de datos de splits (en cualquier formato) de una carpeta."""
+    files = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.startswith("."):
+            continue
+        if filename.endswith(tuple(FORMAT_EXTENSIONS.values())):
+            files.append(filename)
+        elif filename.endswith(LEGACY_EXTENSION) and not filename.endswith(META_EXTENSION) \
+                and "_summary_" not in filename:
+            files.append(filename)
+    return files
+
+def is_legacy(path):
+    return detect_format(path) == "legacy"
+
+def meta_path_for(path):
+    """Ruta del .meta.json de un split a partir de su archivo de datos."""
+    return os.path.join(os.path.dirname(path), strip_extension(os.path.basename(path)) + META_EXTENSION)
+
+def read_meta(path):
+    """Lee el archivo .meta.json de un split a partir de su archivo de datos."""
+    if is_legacy(path):
+        return {}
+    meta_path = meta_path_for(path)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def read_messages(path):
+    """Lee los `messages` de un split a partir de su archivo de datos."""
+    if is_legacy(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("messages", [])
+    return read_meta(path).get("messages", [])
+
+def read_trace(path):
+    """Lee los tiempos por etapa registrados para un split."""
+    return read_meta(path).get("trace", {})
+
+# --- Formatos comprimidos (dependencias opcionales, se importan al usarlos) ---
+
+def open_text(path, mode, split_format):
+    """Abre un archivo NDJSON, comprimido con zstd si el formato lo indica."""
+    if split_format == "zstd":
+        import zstandard
+        if "w" in mode:
+            return zstandard.open(path, "wt", cctx=zstandard.ZstdCompressor(level=SPLIT_ZSTD_LEVEL), encoding="utf-8")
+        return zstandard.open(path, "rt", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def arrow_schema():
+    """Esquema Arrow de los artículos (article_schema de Spark más version, que Spark ignora)."""
+    import pyarrow as pa
+    return pa.schema([
+        ("rel_title", pa.string()),
+        ("rel_doi", pa.string()),
+        ("rel_link", pa.string()),
+        ("rel_abs", pa.string()),
+        ("rel_num_authors", pa.int64()),
+        ("rel_authors", pa.list_(pa.struct([("author_name", pa.string()), ("author_inst", pa.string())]))),
+        ("rel_date", pa.string()),
+        ("rel_site", pa.string()),
+        ("category", pa.string()),
+        ("type", pa.string()),
+        ("entities", pa.list_(pa.struct([("text", pa.string()), ("label", pa.string())]))),
+        ("version", pa.string()),
+    ])
+
+def _text(value):
+    return None if value is None else str(value)
+
+def _struct_list(items, fields):
+    if not isinstance(items, list):
+        return None
+    return [{field: _text(item.get(field)) for field in fields} for item in items if isinstance(item, dict)]
+
+def parquet_row(article):
+    """Adapta un artículo al esquema Arrow (tipos fijos, solo ARTICLE_FIELDS)."""
+    row = {field: _text(article.get(field)) for field in ARTICLE_FIELDS}
+    try:
+        row["rel_num_authors"] = int(article["rel_num_authors"])
+    except (KeyError, TypeError, ValueError):
+        row["rel_num_authors"] = None
+    row["rel_authors"] = _struct_list(article.get("rel_authors"), ("author_name", "author_inst"))
+    row["entities"] = _struct_list(article.get("entities"), ("text", "label"))
+    return row
+
+def iter_articles(path):
+    """
+    Itera los artículos de un split.
+    Los archivos NDJSON (comprimidos o no) se leen línea por línea, los
+    Parquet por grupos de filas y los JSON antiguos se cargan completos
+    por compatibilidad.
+    """
+    split_format = detect_format(path)
+    if split_format == "legacy":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        yield from data.get("collection", [])
+        return
+    if split_format == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=PARQUET_ROW_GROUP_SIZE):
+            yield from batch.to_pylist()
+        return
+    with open_text(path, "r", split_format) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                logger.error(f"Invalid line {line_number} in {path}: {e}")
+
+def write_meta(path, meta):
+    with open(meta_path_for(path), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+class SplitWriter:
+    """
+    Escribe un split de forma incremental en el formato indicado
+    (SPLIT_FORMAT por defecto): NDJSON o NDJSON con zstd se escriben un
+    artículo por línea; Parquet escribe un grupo de filas cada
+    PARQUET_ROW_GROUP_SIZE artículos, así ningún formato guarda el split
+    completo en memoria.
+    Los datos se escriben en un archivo temporal que se renombra al cerrar,
+    de modo que los lectores nunca ven un split a medio escribir.
+    Si no se escribió ningún artículo no se deja ningún archivo.
+    `trace` se guarda en el .meta.json y puede completarse antes de cerrar.
+    """
+    def __init__(self, folder, name, messages=None, trace=None, split_format=None):
+        self.split_format = split_format or SPLIT_FORMAT
+        if self.split_format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unknown split format {self.split_format!r}, expected one of {sorted(FORMAT_EXTENSIONS)}")
+        self.path = os.path.join(folder, name + FORMAT_EXTENSIONS[self.split_format])
+        self.tmp_path = self.path + ".tmp"
+        self.messages = messages or []
+        self.trace = dict(trace or {})
+        self.count = 0
+        self.rows = [] if self.split_format == "parquet" else None
+        self.file = None if self.rows is not None else open_text(self.tmp_path, "w", self.split_format)
+        self.parquet_writer = None  # Se abre con el primer grupo de filas
+
+    def write(self, article):
+        if self.rows is not None:
+            self.rows.append(parquet_row(article))
+            if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+                self._flush_rows()
+        else:
+            self.file.write(json.dumps(article, ensure_ascii=False))
+            self.file.write("\n")
+        self.count += 1
+
+    def write_many(self, articles):
+        for article in articles:
+            self.write(article)
+
+    def _flush_rows(self):
+        """Escribe las filas acumuladas como un grupo de filas del archivo Parquet."""
+        if not self.rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = arrow_schema()
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.tmp_path, schema, compression="zstd")
+        self.parquet_writer.write_table(pa.Table.from_pylist(self.rows, schema=schema),
+                                        row_group_size=PARQUET_ROW_GROUP_SIZE)
+        self.rows = []
+
+    def _finish_data(self):
+        if self.file is not None:
+            self.file.close()
+        elif self.rows is not None:
+            self._flush_rows()
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+                self.parquet_writer = None
+
+    def close(self):
+        """Publica el split. Devuelve su ruta o None si quedó vacío."""
+        self._finish_data()
+        if self.count == 0:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            return None
+        # Actualizar el contador para reflejar el número real de artículos
+        messages = [dict(msg) for msg in self.messages]
+        for msg in messages:
+            if "count" in msg:
+                msg["count"] = self.count
+        write_meta(self.path, {"messages": messages, "count": self.count, "trace": self.trace})
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Descarta el split sin publicarlo."""
+        if self.file is not None:
+            self.file.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        self.rows = []
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
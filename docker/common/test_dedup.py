@@ -0,0 +1,85 @@
+import os
+from common.dedup import DedupIndex, confirm_splits, open_dedup_index, record_key
+
+ARTICLE = {"rel_doi": "10.1101/1", "version": "2", "rel_title": "Título", "entities": []}
+
+def test_record_key():
+    assert record_key(ARTICLE) == "10.1101/1v2"
+    assert record_key({"rel_doi": "10.1101/1"}) == "10.1101/1"
+    assert record_key({"rel_title": "sin DOI"}) is None
+
+def test_seen_after_commit(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    index = DedupIndex(path, "spark")
+    assert not index.seen(ARTICLE)
+    # La copia idéntica del mismo lote ya cuenta como vista
+    assert index.seen(dict(ARTICLE))
+    index.commit()
+    index.close()
+
+    index = DedupIndex(path, "spark")
+    assert index.seen(dict(ARTICLE))
+    # Un cambio de contenido, una versión nueva o un registro sin DOI no se descartan
+    assert not index.seen(dict(ARTICLE, rel_title="Título corregido"))
+    assert not index.seen(dict(ARTICLE, version="3"))
+    assert not index.seen({"rel_title": "sin DOI"})
+    assert index.skipped == 1
+    index.close()
+
+def test_stages_are_independent(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    index = DedupIndex(path, "spark")
+    index.seen(ARTICLE)
+    index.commit()
+    index.close()
+    assert not DedupIndex(path, "ner").seen(ARTICLE)
+
+def test_excluded_fields(tmp_path):
+    index = DedupIndex(str(tmp_path / "dedup.sqlite3"), "ner", exclude=("entities",))
+    index.seen(ARTICLE)
+    index.commit()
+    assert index.seen(dict(ARTICLE, entities=[{"text": "X", "label": "ORG"}]))
+
+def test_discard(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    index = DedupIndex(path, "spark")
+    index.seen(ARTICLE)
+    index.discard()
+    index.commit()
+    index.close()
+    assert not DedupIndex(path, "spark").seen(ARTICLE)
+
+def test_staged_until_confirmed(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    index = DedupIndex(path, "ner")
+    index.seen(ARTICLE)
+    index.commit("job_0")
+    index.close()
+    # Preparado pero sin confirmar: el split puede perderse, se vuelve a procesar
+    assert not DedupIndex(path, "ner").seen(ARTICLE)
+
+    assert confirm_splits("ner", ["job_1"], path) == 0
+    assert confirm_splits("ner", ["job_0"], path) == 1
+    assert DedupIndex(path, "ner").seen(ARTICLE)
+    # Confirmar otra vez no encuentra nada preparado
+    assert DedupIndex(path, "ner").confirm(["job_0"]) == 0
+
+def test_recommit_replaces_staged(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    index = DedupIndex(path, "ner")
+    index.seen(ARTICLE)
+    index.commit("job_0")
+    index.seen(dict(ARTICLE, rel_doi="10.1101/2"))
+    index.commit("job_0")
+    assert index.confirm(["job_0"]) == 1
+    assert not index.seen(ARTICLE)
+
+def test_disabled_or_unusable_index(tmp_path):
+    assert open_dedup_index("spark", path="") is None
+    assert confirm_splits("ner", ["job_0"], "") == 0
+    assert confirm_splits("ner", [], str(tmp_path / "dedup.sqlite3")) == 0
+    # Una carpeta en lugar del archivo: se registra el error y no se interrumpe al llamador
+    folder = tmp_path / "folder"
+    os.makedirs(folder)
+    assert open_dedup_index("spark", path=str(folder)) is None
+    assert confirm_splits("ner", ["job_0"], str(folder)) == 0
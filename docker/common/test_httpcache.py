@@ -0,0 +1,94 @@
+import os
+from common.httpcache import CachedResponse, ResponseCache
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+class FakeSession:
+    """Servidor simulado: responde 304 si el ETag enviado coincide con el actual."""
+    def __init__(self, content, etag='"v1"'):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        if self.etag and (headers or {}).get("If-None-Match") == self.etag:
+            return FakeResponse(304)
+        response_headers = {"Content-Type": "application/json"}
+        if self.etag:
+            response_headers["ETag"] = self.etag
+        return FakeResponse(200, self.content, response_headers)
+
+URL = "https://api.biorxiv.org/details/biorxiv/2024-01-01/2024-12-31/0"
+
+def test_revalidates_with_etag(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = FakeSession(b'{"collection": [1]}')
+    first = cache.get(session, URL, timeout=5)
+    assert first.status_code == 200
+    assert session.requests[0] == {}
+
+    # Siempre se consulta al servidor; el 304 devuelve la copia guardada
+    second = cache.get(session, URL, timeout=5)
+    assert isinstance(second, CachedResponse)
+    assert second.json() == {"collection": [1]}
+    assert session.requests[1] == {"If-None-Match": '"v1"'}
+
+def test_changed_content_replaces_entry(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = FakeSession(b'{"collection": [1]}')
+    cache.get(session, URL)
+    session.content, session.etag = b'{"collection": [2]}', '"v2"'
+    assert cache.get(session, URL).content == b'{"collection": [2]}'
+    assert cache.get(session, URL).json() == {"collection": [2]}
+
+def test_without_validators_never_serves_the_copy(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = FakeSession(b"{}", etag=None)
+    cache.get(session, URL)
+    response = cache.get(session, URL)
+    assert not isinstance(response, CachedResponse)
+    assert session.requests == [{}, {}]
+
+def test_errors_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+
+    class FailingSession(FakeSession):
+        def get(self, url, headers=None, **kwargs):
+            self.requests.append(dict(headers or {}))
+            return FakeResponse(503)
+
+    session = FailingSession(b"")
+    assert cache.get(session, URL).status_code == 503
+    assert os.listdir(tmp_path) == []
+
+def test_discard_and_unreadable_entry(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    session = FakeSession(b"{}")
+    cache.get(session, URL)
+    cache.discard(URL)
+    cache.get(session, URL)
+    assert session.requests[-1] == {}
+    # Una entrada dañada se trata como si no existiera
+    with open(cache._path(URL), "wb") as f:
+        f.write(b"no es json\n")
+    assert cache.get(session, URL).status_code == 200
+    assert session.requests[-1] == {}
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=3000)
+    session = FakeSession(b"x" * 1000)
+    urls = [f"{URL}?page={i}" for i in range(2)]
+    for i, url in enumerate(urls):
+        cache.get(session, url)
+        os.utime(cache._path(url), (1000 + i, 1000 + i))
+    # La primera se usa de nuevo (304), así que la menos usada pasa a ser la segunda
+    cache.get(session, urls[0])
+    cache.get(session, f"{URL}?page=2")
+    assert os.path.exists(cache._path(urls[0]))
+    assert not os.path.exists(cache._path(urls[1]))
+    assert cache._disk_usage() <= 3000 * 0.9
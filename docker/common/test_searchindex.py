@@ -0,0 +1,102 @@
+import os
+import math
+import pytest
+from common.searchindex import BM25_B, BM25_K1, IndexWriter, SearchIndex, decode_postings, document_entry, \
+    encode_postings, read_manifest
+
+def entry(doi, title, abstract="", category="Genetics", labels=()):
+    return document_entry({"rel_doi": doi, "rel_title": title, "rel_abs": abstract, "category": category,
+                           "type": "new results", "entities": [{"text": label, "label": label} for label in labels]})
+
+def test_postings_round_trip():
+    pairs = [(0, 1), (3, 200), (130, 2), (100000, 1)]
+    assert decode_postings(encode_postings(pairs)) == pairs
+    assert decode_postings(b"") == []
+
+def test_document_entry():
+    assert document_entry({"rel_title": "sin DOI"}) is None
+    doc = entry("a", "Virus del Zika", "El virus", labels=("ORG", "GPE", "ORG"))
+    assert doc["terms"] == {"virus": 2, "del": 1, "zika": 1, "el": 1}
+    assert doc["length"] == 5
+    assert doc["entities"] == ["GPE", "ORG"]
+
+def test_bm25_ranking(tmp_path):
+    writer = IndexWriter(str(tmp_path), merge_factor=8)
+    writer.add([entry("a", "virus virus zika"), entry("b", "virus dengue dengue dengue"), entry("c", "bacteria")])
+    index = SearchIndex(str(tmp_path))
+    results = index.search("virus")
+    assert [result["rel_doi"] for result in results] == ["a", "b"]
+    # Puntaje de "a" calculado a mano: tf 2, largo 3, 2 de 3 documentos contienen el término
+    avg_length = (3 + 4 + 1) / 3
+    idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * 3 / avg_length)
+    assert results[0]["score"] == pytest.approx(idf * 2 * (BM25_K1 + 1) / (2 + norm))
+    assert index.search("virus", k=1) == results[:1]
+    assert index.search("inexistente") == []
+    assert index.search("") == []
+    index.close()
+
+def test_facet_filters(tmp_path):
+    writer = IndexWriter(str(tmp_path))
+    writer.add([entry("a", "virus", category="Genetics", labels=("ORG",)),
+                entry("b", "virus", category="Zoology", labels=("GPE",))])
+    index = SearchIndex(str(tmp_path))
+    assert [r["rel_doi"] for r in index.search("virus", facets={"category": ["Zoology"]})] == ["b"]
+    assert [r["rel_doi"] for r in index.search("virus", facets={"entities": ["ORG", "PERSON"]})] == ["a"]
+    assert index.search("virus", facets={"category": ["Genetics"], "entities": ["GPE"]}) == []
+    with pytest.raises(ValueError):
+        index.search("virus", facets={"rel_doi": ["a"]})
+    index.close()
+
+def test_newer_version_shadows_older(tmp_path):
+    writer = IndexWriter(str(tmp_path), merge_factor=8)
+    writer.add([entry("a", "virus zika"), entry("b", "virus")])
+    index = SearchIndex(str(tmp_path))
+    assert index.stats()["documents"] == 2
+    # La versión nueva de "a" está en otro segmento y ya no menciona el término
+    writer.add([entry("a", "bacteria")])
+    assert index.refresh()
+    assert not index.refresh()
+    assert [r["rel_doi"] for r in index.search("zika virus")] == ["b"]
+    assert [r["rel_doi"] for r in index.search("bacteria")] == ["a"]
+    assert index.stats()["documents"] == 2
+    assert index.stats()["segments"] == 2
+    index.close()
+
+def test_last_version_in_a_batch_wins(tmp_path):
+    writer = IndexWriter(str(tmp_path))
+    writer.add([entry("a", "virus"), entry("a", "bacteria")])
+    index = SearchIndex(str(tmp_path))
+    assert index.search("virus") == []
+    assert index.stats()["documents"] == 1
+    index.close()
+    assert writer.add([]) is None
+
+def test_merge_drops_replaced_documents(tmp_path):
+    folder = str(tmp_path)
+    writer = IndexWriter(folder, merge_factor=2)
+    writer.add([entry("a", "virus zika")])
+    # Niveles distintos (1 y 2 documentos): no se fusionan
+    writer.add([entry("a", "bacteria"), entry("b", "virus")])
+    assert [segment["docs"] for segment in read_manifest(folder)["segments"]] == [1, 2]
+    # Dos segmentos de 1 documento se fusionan, y la versión vieja de "a" se descarta
+    writer.add([entry("c", "virus")])
+    assert [segment["docs"] for segment in read_manifest(folder)["segments"]] == [1, 2]
+    # Cascada: 1 + 1 -> 2, y luego 2 + 2 -> 4
+    writer.add([entry("d", "virus")])
+    manifest = read_manifest(folder)
+    assert [segment["docs"] for segment in manifest["segments"]] == [4]
+    assert [name for name in os.listdir(folder) if name.startswith("seg_")] == [manifest["segments"][0]["name"]]
+    index = SearchIndex(folder)
+    assert sorted(r["rel_doi"] for r in index.search("virus")) == ["b", "c", "d"]
+    assert [r["rel_doi"] for r in index.search("bacteria")] == ["a"]
+    index.close()
+
+def test_writer_removes_orphan_segments(tmp_path):
+    folder = str(tmp_path)
+    IndexWriter(folder).add([entry("a", "virus")])
+    # Segmento de una escritura interrumpida, que no llegó al manifiesto
+    os.makedirs(os.path.join(folder, "seg_99"))
+    IndexWriter(folder)
+    assert not os.path.exists(os.path.join(folder, "seg_99"))
+    assert os.path.exists(os.path.join(folder, "seg_1"))
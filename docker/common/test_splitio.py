@@ -0,0 +1,84 @@
+import os
+import json
+import pytest
+from common import splitio
+from common.splitio import SplitWriter, find_split, iter_articles, list_splits, parse_split_name, read_messages, \
+    read_meta, read_trace
+
+ARTICLES = [
+    {"rel_title": "Título uno", "rel_doi": "10.1101/1", "rel_link": "https://x/1", "rel_abs": "Resumen",
+     "rel_num_authors": 2, "rel_authors": [{"author_name": "Ana Pérez", "author_inst": "UCR"},
+                                          {"author_name": "Li Wei", "author_inst": None}],
+     "rel_date": "2024-01-02", "rel_site": "bioRxiv", "category": "genetics", "type": "new results",
+     "entities": [{"text": "UCR", "label": "ORG"}], "version": "2"},
+    {"rel_title": "Título dos", "rel_doi": "10.1101/2", "rel_link": "https://x/2", "rel_abs": "",
+     "rel_num_authors": 1, "rel_authors": [], "rel_date": "2024-01-03", "rel_site": "medRxiv",
+     "category": "epidemiology", "type": "new results", "entities": [], "version": "1"},
+]
+
+# Dependencias opcionales de cada formato comprimido
+FORMAT_DEPENDENCIES = {"zstd": "zstandard", "parquet": "pyarrow"}
+
+def write_split(folder, split_format, articles=ARTICLES):
+    messages = [{"jobId": "job", "splitNumber": 0, "count": 0}]
+    with SplitWriter(str(folder), "job_0", messages, trace={"crawl": {"start": 1.0, "end": 2.0}},
+                     split_format=split_format) as writer:
+        writer.write_many(articles)
+    return writer.path
+
+@pytest.mark.parametrize("split_format", ["ndjson", "zstd", "parquet"])
+def test_round_trip(tmp_path, split_format):
+    if split_format in FORMAT_DEPENDENCIES:
+        pytest.importorskip(FORMAT_DEPENDENCIES[split_format])
+    path = write_split(tmp_path, split_format)
+    assert path.endswith(splitio.FORMAT_EXTENSIONS[split_format])
+    assert splitio.detect_format(path) == split_format
+    # Parquet guarda solo ARTICLE_FIELDS con tipos fijos
+    expected = [splitio.parquet_row(article) for article in ARTICLES] if split_format == "parquet" else ARTICLES
+    assert list(iter_articles(path)) == expected
+    assert find_split(str(tmp_path), "job_0") == path
+    assert list_splits(str(tmp_path)) == [os.path.basename(path)]
+    assert not os.path.exists(path + ".tmp")
+
+def test_meta_sidecar(tmp_path):
+    path = write_split(tmp_path, "ndjson")
+    meta = read_meta(path)
+    assert meta["count"] == len(ARTICLES)
+    # El count de los mensajes refleja los artículos escritos
+    assert read_messages(path) == [{"jobId": "job", "splitNumber": 0, "count": len(ARTICLES)}]
+    assert read_trace(path) == {"crawl": {"start": 1.0, "end": 2.0}}
+    assert splitio.meta_path_for(path) == os.path.join(str(tmp_path), "job_0.meta.json")
+    assert parse_split_name(path) == ("job", 0)
+
+def test_parquet_row_groups(tmp_path, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    monkeypatch.setattr(splitio, "PARQUET_ROW_GROUP_SIZE", 2)
+    articles = [dict(ARTICLES[1], rel_doi=f"10.1101/{i}") for i in range(5)]
+    path = write_split(tmp_path, "parquet", articles)
+    assert pq.ParquetFile(path).num_row_groups == 3
+    assert [row["rel_doi"] for row in iter_articles(path)] == [article["rel_doi"] for article in articles]
+
+def test_empty_split_leaves_no_file(tmp_path):
+    writer = SplitWriter(str(tmp_path), "job_0", split_format="ndjson")
+    assert writer.close() is None
+    assert os.listdir(tmp_path) == []
+
+def test_abort_discards_split(tmp_path):
+    with pytest.raises(RuntimeError):
+        with SplitWriter(str(tmp_path), "job_0", split_format="ndjson") as writer:
+            writer.write(ARTICLES[0])
+            raise RuntimeError("falla a mitad del split")
+    assert os.listdir(tmp_path) == []
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        SplitWriter(str(tmp_path), "job_0", split_format="csv")
+
+def test_legacy_split(tmp_path):
+    path = os.path.join(str(tmp_path), "job_1.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"messages": [{"count": 2}], "collection": ARTICLES}, f)
+    assert list_splits(str(tmp_path)) == ["job_1.json"]
+    assert list(iter_articles(path)) == ARTICLES
+    assert read_messages(path) == [{"count": 2}]
+    assert read_meta(path) == {}
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Los servicios importan los módulos compartidos como common.x (en las imágenes
+# docker/common se copia junto a cada app), así que los tests corren con docker/ en el path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
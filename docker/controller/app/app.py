@@ -5,6 +5,9 @@ import json
 import time
 import requests
 import logging
+from pymongo.errors import OperationFailure, PyMongoError
+from common.publisher import ConfirmedPublisher, PublishError
+from common.metrics import counter, gauge, histogram, start_metrics_server
 
 # Logger Configuration
 logging.basicConfig(
@@ -19,17 +22,60 @@ rabbitmq_host = os.getenv("RABBITMQ_HOST")
 rabbitmq_user = os.getenv("RABBITMQ_USER")
 rabbitmq_pass = os.getenv("RABBITMQ_PASS")
 rabbitmq_queue = os.getenv("RABBITMQ_QUEUE")
+rabbitmq_download_queue = os.getenv("RABBITMQ_QUEUE_DOWNLOAD")  # Cola del api-crawler al extractor (solo se consulta)
 bioRxiv_api_url = os.getenv('BIORXIV_API_URL')
+biorxiv_collection = os.getenv('BIORXIV_COLLECTION', 'covid19')  # Colección crawleada (clave del high-water mark)
+articles_per_page = int(os.getenv('BIORXIV_PAGE_ITEMS', '30'))  # Artículos por página de la API
+publish_batch_size = int(os.getenv('PUBLISH_BATCH_SIZE', '500'))  # Splits por lote confirmado
+job_poll_interval = float(os.getenv('JOB_POLL_INTERVAL', '3'))  # Segundos entre verificaciones sin change stream
+split_planner = os.getenv('SPLIT_PLANNER', 'adaptive')  # "adaptive" o "fixed" (pageSize del job)
+target_split_seconds = float(os.getenv('TARGET_SPLIT_SECONDS', '120'))  # Duración objetivo de cada split
+split_workers_per_consumer = int(os.getenv('SPLIT_WORKERS_PER_CONSUMER', '1'))  # Splits en paralelo por api-crawler
+flow_control = os.getenv('FLOW_CONTROL', 'queue')  # "queue" (según la profundidad de las colas) o "sleep" (sleep del job por lote)
+queued_splits_per_consumer = int(os.getenv('QUEUED_SPLITS_PER_CONSUMER', '2'))  # Mensajes en espera por consumidor de cada etapa
+flow_poll_interval = float(os.getenv('FLOW_POLL_INTERVAL', '5'))  # Segundos entre consultas a las colas mientras están llenas
+PUBLISH_RETRIES = 5
+PLANNER_HISTORY_JOBS = 5  # Jobs recientes usados para estimar el costo por página
+MIN_PAGES_PER_SPLIT = 10
+MAX_PAGES_PER_SPLIT = 5000
+
+# Tipos de job
+JOB_TYPE_FULL = "full"
+JOB_TYPE_INCREMENTAL = "incremental"
+
+# Estados del job. Los jobs nuevos no tienen status; una vez publicados se
+# conservan para que el spark-job-processor guarde en ellos el trace de cada split
+JOB_STATUS_PUBLISHED = "published"
+JOB_STATUS_EMPTY = "empty"
+PENDING_JOBS = {"status": {"$exists": False}}
+
+# Métricas del controller
+JOBS = counter("biorxiv_controller_jobs_total", "Jobs processed, by result", ["result"])
+SPLITS_PUBLISHED = counter("biorxiv_controller_splits_published_total", "Split messages confirmed by the broker")
+JOB_SECONDS = histogram("biorxiv_controller_job_seconds", "Time to plan and publish one job")
+QUEUE_DEPTH = gauge("biorxiv_controller_queue_depth", "Ready messages in each stage queue at the last flow-control check", ["stage"])
+FLOW_WAIT_SECONDS = counter("biorxiv_controller_flow_wait_seconds_total", "Time spent waiting for downstream queues to drain")
 
 # Connecting to MongoDB
 client = pymongo.MongoClient(mongo_uri)
 db = client.get_database()
 jobs_collection = db.jobs
+# Estado del crawl por colección: highWaterDate (fecha más reciente ingerida) y
+# lastTotal (total de artículos con que se planificaron los jobs ingeridos), ambos
+# los registra el spark-job-processor al ingerir; lastJobId lo registra el controller
+crawl_state_collection = db.crawl_state
+
+# Publicador de RabbitMQ de larga duración (se crea al publicar el primer job)
+publisher = None
 
 def get_total_articles_from_biorxiv():
-    """Obtiene el número total de artículos de COVID-19 desde bioRxiv"""
+    """
+    Obtiene el número total de artículos de COVID-19 desde bioRxiv.
+    Se pide siempre al servidor (sin caché): un total desactualizado haría
+    que un job incremental planifique menos artículos nuevos de los que hay.
+    """
     try:
-        response = requests.get(f"{bioRxiv_api_url}")
+        response = requests.get(f"{bioRxiv_api_url}", timeout=30)
         if response.status_code == 200:
             data = response.json()
             logger.info(f"API Response: {data}")  # Corregido: usa f-string para el logging
@@ -49,86 +95,358 @@ def get_total_articles_from_biorxiv():
         logger.error(f"Error calling bioRxiv API: {str(e)}")
         return 0
 
+def plan_incremental_splits(total_messages):
+    """
+    Calcula las páginas que recorre un job incremental.
+    La API entrega los artículos más recientes primero, por lo que los nuevos
+    desde el último crawl están en las primeras páginas. Devuelve
+    (páginas, since_date), o None si no hay estado previo y hay que hacer
+    un crawl completo.
+    """
+    state = crawl_state_collection.find_one({"_id": biorxiv_collection})
+    if not state or not state.get("highWaterDate") or state.get("lastTotal") is None:
+        logger.info(f"No high-water mark for {biorxiv_collection}, running a full crawl")
+        return None
+
+    since_date = state["highWaterDate"]
+    new_articles = total_messages - int(state["lastTotal"])
+    if new_articles <= 0:
+        logger.info(f"No new articles since the last crawl (total {total_messages}, high-water {since_date})")
+        return 0, since_date
+
+    # Páginas con artículos nuevos más una página de margen (los artículos nuevos
+    # desplazan a los anteriores entre páginas); el api-crawler se detiene en
+    # cuanto alcanza artículos ya ingeridos
+    new_pages = -(-new_articles // articles_per_page) + 1
+    logger.info(f"Incremental crawl: {new_articles} new articles since {since_date}, {new_pages} pages")
+    return new_pages, since_date
+
+def observed_page_cost():
+    """
+    Segundos por página observados en los últimos jobs, a partir de los traces
+    que el spark-job-processor guarda en cada job. Se usa la etapa más lenta
+    entre descarga y NER, que es la que limita el avance de los splits.
+    Devuelve None si todavía no hay historial.
+    """
+    crawl_seconds = ner_seconds = pages = 0
+    recent_jobs = jobs_collection.find({"trace": {"$exists": True}}, {"trace": 1}) \
+        .sort("publishedAt", pymongo.DESCENDING).limit(PLANNER_HISTORY_JOBS)
+    for job in recent_jobs:
+        for trace in job["trace"].values():
+            crawl = trace.get("crawl")
+            if not crawl or not crawl.get("pages"):
+                continue
+            pages += crawl["pages"]
+            crawl_seconds += crawl["end"] - crawl["start"]
+            ner = trace.get("ner")
+            if ner:
+                ner_seconds += ner["end"] - ner["start"]
+    if not pages:
+        return None
+    return max(crawl_seconds, ner_seconds) / pages
+
+def split_workers():
+    """Splits que se pueden descargar en paralelo: consumidores de la cola por workers de cada uno."""
+    try:
+        status = get_publisher().queue_status(rabbitmq_queue)
+    except PublishError as e:
+        logger.warning(f"Could not query {rabbitmq_queue}: {e}")
+        status = None
+    consumers = status[1] if status else 0
+    return max(1, consumers * split_workers_per_consumer)
+
+def plan_pages_per_split(total_pages, page_size):
+    """
+    Elige cuántas páginas tiene cada split (total_pages son páginas de la
+    API, no artículos). El planner adaptativo apunta a que
+    cada split dure target_split_seconds según el costo por página observado,
+    sin crear menos splits que workers disponibles. Sin historial (o con
+    SPLIT_PLANNER=fixed) se usa el pageSize del job.
+    Devuelve (páginas por split, planner usado).
+    """
+    if split_planner != "adaptive":
+        return page_size, "fixed"
+    page_cost = observed_page_cost()
+    if page_cost is None:
+        logger.info(f"No split timings recorded yet, using pageSize {page_size}")
+        return page_size, "fixed"
+    workers = split_workers()
+    pages = int(target_split_seconds / page_cost) if page_cost > 0 else MAX_PAGES_PER_SPLIT
+    # Al menos un split por worker para que ninguno quede ocioso
+    pages = min(pages, -(-total_pages // workers))
+    pages = max(MIN_PAGES_PER_SPLIT, min(MAX_PAGES_PER_SPLIT, pages))
+    logger.info(f"Adaptive plan: {page_cost:.3f} s/page observed, {workers} workers, "
+                f"{pages} pages per split (target {target_split_seconds:.0f} s)")
+    return pages, "adaptive"
+
+def get_publisher():
+    """Devuelve el publicador de larga duración, reconectándolo si se cerró."""
+    global publisher
+    if publisher is None or not publisher.is_open:
+        if publisher is not None:
+            publisher.close()
+        credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
+        parameters = pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials, heartbeat=30)
+        # La cola de descargas se declara para poder consultarla de forma pasiva
+        # aunque el api-crawler todavía no la haya creado
+        queues = [queue for _, queue in stage_queues()]
+        publisher = ConfirmedPublisher(parameters, queues=queues).start()
+    return publisher
+
+def stage_queues():
+    """Colas de las etapas que regulan la publicación: (etapa, cola)."""
+    stages = [("crawl", rabbitmq_queue)]
+    if rabbitmq_download_queue:
+        stages.append(("ner", rabbitmq_download_queue))
+    return stages
+
+def queue_capacity():
+    """
+    Consulta de forma pasiva la profundidad y los consumidores de la cola de
+    cada etapa. Cada etapa admite hasta queued_splits_per_consumer mensajes en
+    espera por consumidor (los que ya reservó cada consumidor no cuentan como
+    listos). Devuelve (splits que se pueden publicar, estado de las colas),
+    con 0 si alguna etapa superó su objetivo, o None si no se pudo consultar
+    el broker.
+    """
+    queues = {}
+    capacity = None
+    for stage, queue in stage_queues():
+        try:
+            status = get_publisher().queue_status(queue)
+        except PublishError as e:
+            logger.warning(f"Could not query {queue}: {e}")
+            status = None
+        if status is None:
+            return None
+        messages, consumers = status
+        target = max(1, consumers) * queued_splits_per_consumer
+        QUEUE_DEPTH.set(messages, stage=stage)
+        queues[stage] = {"messages": messages, "consumers": consumers, "target": target}
+        free = max(0, target - messages)
+        # Los splits se publican en la cola del api-crawler; las etapas siguientes
+        # solo detienen la publicación mientras están por encima de su objetivo
+        capacity = free if capacity is None else (capacity if free else 0)
+    return capacity, queues
+
+def record_progress(job_oid, published, total, queues=None, waiting=False):
+    """Guarda en el job el avance de la publicación y el último estado de las colas."""
+    progress = {
+        "published": published,
+        "total": total,
+        "percent": round(100 * published / total, 1) if total else 100.0,
+        "waiting": waiting,
+        "updatedAt": time.time()
+    }
+    if queues is not None:
+        progress["queues"] = queues
+    try:
+        jobs_collection.update_one({"_id": job_oid}, {"$set": {"progress": progress}})
+    except PyMongoError as e:
+        logger.warning(f"Could not record job progress: {e}")
+
+def wait_for_capacity(job_oid, published, total):
+    """
+    Espera hasta que las etapas siguientes tengan lugar para más splits.
+    Devuelve (splits que se pueden publicar, estado de las colas), o None si
+    no se puede consultar el broker (se vuelve al sleep del job).
+    """
+    waited = 0.0
+    while True:
+        result = queue_capacity()
+        if result is None or result[0] > 0:
+            if waited:
+                logger.info(f"Downstream queues drained after {waited:.0f} s, resuming publication")
+            return result
+        if not waited:
+            logger.info(f"Downstream queues full ({result[1]}), waiting before publishing more splits")
+            record_progress(job_oid, published, total, result[1], waiting=True)
+        time.sleep(flow_poll_interval)
+        waited += flow_poll_interval
+        FLOW_WAIT_SECONDS.inc(flow_poll_interval)
+
+def publish_splits(job_oid, messages, sleep_ms):
+    """
+    Publica los mensajes de los splits en lotes sobre el canal de larga duración.
+    Cada lote se envía sin esperas entre mensajes y se confirma completo
+    (publisher confirms); los mensajes rechazados o sin confirmar se reenvían.
+    Con FLOW_CONTROL=queue cada lote se limita a lo que admiten las colas de
+    las etapas siguientes y se espera a que se vacíen antes de publicar más;
+    si no se pueden consultar (o con FLOW_CONTROL=sleep) el sleep del job se
+    aplica una vez por lote. El avance queda en el campo progress del job.
+    """
+    global publisher
+    total = len(messages)
+    start = 0
+    while start < total:
+        size = publish_batch_size
+        capacity = wait_for_capacity(job_oid, start, total) if flow_control == "queue" else None
+        queues = None
+        if capacity is not None:
+            size, queues = min(size, capacity[0]), capacity[1]
+        end = min(start + size, total)
+        batch = [json.dumps(message) for message in messages[start:end]]
+        for attempt in range(PUBLISH_RETRIES):
+            try:
+                batch = get_publisher().publish_batch(rabbitmq_queue, batch)
+            except PublishError as e:
+                logger.error(f"Error publishing splits (attempt {attempt+1}/{PUBLISH_RETRIES}): {e}")
+                # Cerrar la conexión (también si sigue abierta tras un timeout) para no
+                # dejar su hilo vivo ni que entregue el lote que se va a reenviar
+                if publisher is not None:
+                    publisher.close()
+                publisher = None
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            if not batch:
+                break
+            logger.warning(f"{len(batch)} splits were rejected by the broker, retrying")
+        else:
+            raise RuntimeError(f"Could not publish splits {start+1}-{end} after {PUBLISH_RETRIES} attempts")
+        SPLITS_PUBLISHED.inc(end - start)
+        logger.info(f"Published splits {start+1}-{end}/{total}")
+        record_progress(job_oid, end, total, queues)
+        start = end
+        if capacity is None and sleep_ms:
+            time.sleep(sleep_ms / 1000)
+
+def job_notifications():
+    """
+    Generador que avanza cada vez que puede haber un job nuevo.
+    Usa un change stream sobre la colección de jobs (inserciones); si vence
+    job_poll_interval sin cambios también avanza, de modo que funciona como
+    polling. Si el servidor no soporta change streams se usa solo polling.
+    """
+    use_change_stream = True
+    while True:
+        if use_change_stream:
+            try:
+                with jobs_collection.watch(
+                    [{"$match": {"operationType": "insert"}}],
+                    max_await_time_ms=int(job_poll_interval * 1000)
+                ) as stream:
+                    logger.info("Watching jobs collection with a change stream")
+                    while stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            logger.info(f"New job inserted: {change.get('documentKey')}")
+                        yield
+            except OperationFailure as e:
+                logger.warning(f"Change streams not available ({e}), polling every {job_poll_interval} s")
+                use_change_stream = False
+            except PyMongoError as e:
+                logger.error(f"Change stream interrupted: {e}")
+        time.sleep(job_poll_interval)
+        yield
+
+def process_job(job_document):
+    """Planifica y publica los splits de un job. Devuelve True si terminó bien."""
+    logger.info(f"Processing Job: {job_document}")
+    start = time.time()
+
+    try:
+        # Extraer información del job según el formato requerido
+        # El jobId puede estar en el documento o usar el _id si no está presente
+        job_id = job_document.get("jobId", str(job_document["_id"]))
+        page_size = int(job_document.get("pageSize"))
+        sleep_ms = int(job_document.get("sleep"))
+        job_type = job_document.get("type", JOB_TYPE_FULL)
+
+        # Obtener el total de artículos (sin usar query)
+        total_messages = get_total_articles_from_biorxiv()
+        
+        if total_messages == 0:
+            logger.info("No articles found from bioRxiv API.")
+            # Marcamos el job como terminado y continuamos
+            jobs_collection.update_one(
+                {"_id": job_document["_id"]},
+                {"$set": {"jobId": job_id, "status": JOB_STATUS_EMPTY, "publishedAt": time.time()}}
+            )
+            JOBS.inc(result=JOB_STATUS_EMPTY)
+            return True
+
+        # Calculamos el tamaño y el número de splits; pageSize y pagesPerSplit son
+        # páginas de la API (articles_per_page artículos cada una), no artículos
+        # Un job incremental solo recorre las páginas con artículos nuevos, y el
+        # tamaño de sus splits se planifica sobre esas páginas, no sobre el corpus
+        total_pages = -(-total_messages // articles_per_page)
+        crawl_pages = total_pages
+        since_date = None
+        plan = plan_incremental_splits(total_messages) if job_type == JOB_TYPE_INCREMENTAL else None
+        if plan is not None:
+            crawl_pages, since_date = plan
+        pages_per_split, planner = plan_pages_per_split(crawl_pages, page_size)
+        num_splits = -(-crawl_pages // pages_per_split)
+        
+        logger.info(f"Total articles: {total_messages} ({total_pages} pages), Number of splits: {num_splits}")
+        
+        # Actualizamos con el número total de splits; el jobId queda en el documento
+        # para que las demás etapas lo encuentren
+        jobs_collection.update_one(
+            {"_id": job_document["_id"]},
+            {"$set": {"jobId": job_id, "splitNumber": num_splits, "totalArticles": total_messages, "startedAt": start,
+                      "pagesPerSplit": pages_per_split, "planner": planner}}
+        )
+
+        # Publicamos los splits con el formato exacto requerido
+        messages = []
+        for i in range(num_splits):
+            message = {
+                "jobId": job_id,
+                "pageSize": pages_per_split,
+                "sleep": sleep_ms,
+                "splitNumber": i,
+                # Permite al api-crawler numerar los splits que crea al dividir un split lento
+                "splitModulus": num_splits
+            }
+            if since_date:
+                # El api-crawler solo guarda artículos desde esta fecha, y el último
+                # split termina en la última página planificada
+                message["sinceDate"] = since_date
+                if i == num_splits - 1:
+                    message["endPage"] = crawl_pages - 1
+            messages.append(message)
+        publish_splits(job_document["_id"], messages, sleep_ms)
+
+        # El total planificado (totalArticles) pasa a lastTotal recién cuando el
+        # spark-job-processor ingiere los splits, junto con el high-water mark
+        crawl_state_collection.update_one(
+            {"_id": biorxiv_collection},
+            {"$set": {"lastJobId": job_id}},
+            upsert=True
+        )
+
+        # Marcar el job como publicado (se conserva para los traces de los splits)
+        jobs_collection.update_one(
+            {"_id": job_document["_id"]},
+            {"$set": {"status": JOB_STATUS_PUBLISHED, "publishedAt": time.time()}}
+        )
+        JOBS.inc(result=JOB_STATUS_PUBLISHED)
+        JOB_SECONDS.observe(time.time() - start)
+        logger.info(f"Job {job_id} processed successfully")
+        return True
+
+    except Exception as e:
+        JOBS.inc(result="error")
+        logger.error(f"Error when processing job: {str(e)}")
+        return False
+
 def watch_jobs():
     """Monitorea continuamente la colección de jobs en MongoDB"""
+    notifications = job_notifications()
     while True:
         # Buscamos cualquier job no procesado anteriormente
-        job_document = jobs_collection.find_one()
+        job_document = jobs_collection.find_one(PENDING_JOBS)
 
-        if job_document:
-            logger.info(f"Processing Job: {job_document}")
+        # Si el job terminó bien se busca el siguiente de inmediato
+        if job_document and process_job(job_document):
+            continue
 
-            try:
-                # Extraer información del job según el formato requerido
-                # El jobId puede estar en el documento o usar el _id si no está presente
-                job_id = job_document.get("jobId", str(job_document["_id"]))
-                page_size = int(job_document.get("pageSize"))
-                sleep_ms = int(job_document.get("sleep"))
-
-                # Obtener el total de artículos (sin usar query)
-                total_messages = get_total_articles_from_biorxiv()
-                
-                if total_messages == 0:
-                    logger.info("No articles found from bioRxiv API.")
-                    # Eliminamos el job y continuamos
-                    jobs_collection.delete_one({"_id": job_document["_id"]})
-                    continue
-
-                # Calculamos el número de splits
-                num_splits = total_messages // page_size
-                if total_messages % page_size > 0:
-                    num_splits += 1
-                
-                logger.info(f"Total articles: {total_messages}, Number of splits: {num_splits}")
-                
-                # Actualizamos con el número total de splits
-                jobs_collection.update_one(
-                    {"_id": job_document["_id"]},
-                    {"$set": {"splitNumber": num_splits, "totalArticles": total_messages}}
-                )
-                
-                # Conectamos a RabbitMQ
-                credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-                connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials)
-                )
-                channel = connection.channel()
-                channel.queue_declare(queue=rabbitmq_queue, durable=True)
-
-                # Publicamos los splits con el formato exacto requerido
-                for i in range(num_splits):
-                    message = {
-                        "jobId": job_id,
-                        "pageSize": page_size,
-                        "sleep": sleep_ms,
-                        "splitNumber": i
-                    }
-                    
-                    channel.basic_publish(
-                        exchange='',
-                        routing_key=rabbitmq_queue,
-                        body=json.dumps(message),
-                        properties=pika.BasicProperties(delivery_mode=2)
-                    )
-                    logger.info(f"Published split {i+1}/{num_splits}")
-                    time.sleep(sleep_ms / 1000)
-
-                # Eliminar el job una vez procesado
-                jobs_collection.delete_one({"_id": job_document["_id"]})
-                logger.info(f"Job {job_id} processed successfully")
-
-            except Exception as e:
-                logger.error(f"Error when processing job: {str(e)}")
-            finally:
-                try:
-                    if 'connection' in locals() and connection and connection.is_open:
-                        connection.close()
-                except Exception as e:
-                    logger.error(f"Error closing RabbitMQ connection: {str(e)}")
-
-        # Esperar antes de la próxima verificación
-        time.sleep(3)
+        # Esperar a un job nuevo (change stream) o al siguiente intervalo de polling
+        next(notifications)
 
 if __name__ == "__main__":
     logger.info("Controller started. Watching for jobs...")
-    watch_jobs()
\ No newline at end of file
+    start_metrics_server()
+    jobs_collection.create_index("jobId")
+    watch_jobs()
@@ -1,8 +1,14 @@
+import gc
 import os
-import json
-import pika
-import spacy
+import time
 import logging
+import threading
+from common.splitio import SplitWriter, find_split, iter_articles, read_messages, read_trace, split_name
+from common.consumer import CONSUMER_MODE, ConsumerRuntime, DiscardMessage, connection_parameters, process_memory
+from common.metrics import counter, gauge, histogram
+from common.dedup import SKIPPED, open_dedup_index
+from ner import extract_entities, load_pipeline, warm_up
+from entity_cache import open_entity_cache
 
 RAW_FOLDER = "/mnt/raw"
 AUGMENTED_FOLDER = "/mnt/augmented"
@@ -15,55 +21,180 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Environment variables for RabbitMQ
-RABBITMQ_HOST = os.getenv("RABBITMQ_HOST")
-RABBITMQ_USER = os.getenv("RABBITMQ_USER")
-RABBITMQ_PASS = os.getenv("RABBITMQ_PASS")
 RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE_DOWNLOAD")  # Queue where the api-crawler publishes the downloaded files
+RABBITMQ_AUGMENTED_QUEUE = os.getenv("RABBITMQ_QUEUE_AUGMENTED", "documentos_aumentados")  # Queue read by the Spark processor
 
-# Load the Spacy model
-nlp = spacy.load("en_core_web_sm")
+# Extractor metrics (with CONSUMER_MODE=process they are recorded in the worker
+# processes and only the consumer runtime metrics are exported)
+DOCUMENTS = counter("biorxiv_extractor_documents_total", "Articles written to the augmented splits")
+MODEL_SECONDS = counter("biorxiv_extractor_model_seconds_total", "Time spent waiting on nlp.pipe")
+MODEL_DOCUMENTS = counter("biorxiv_extractor_model_documents_total", "Abstracts run through spaCy (cache misses)")
+CACHE_LOOKUPS = counter("biorxiv_extractor_cache_lookups_total", "Entity cache lookups", ["result"])
+SPLIT_SECONDS = histogram("biorxiv_extractor_split_seconds", "Time to process one split")
+DOCS_PER_SECOND = gauge("biorxiv_extractor_docs_per_second", "Throughput of the last processed split")
+STARTUP_SECONDS = gauge("biorxiv_extractor_startup_seconds", "Time to become ready, by phase", ["phase"])
 
-# process_file function to read, process, and save the file
-def process_file(filename):
-    raw_path = os.path.join(RAW_FOLDER, filename)
-    augmented_path = os.path.join(AUGMENTED_FOLDER, filename)
-    if not os.path.exists(raw_path):
-        logger.warning(f"File not found: {raw_path}")
-        return
-    with open(raw_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    # Process each document in collection
-    for doc in data.get("collection", []):
-        text = doc.get("rel_abs", "")
-        spacy_doc = nlp(text)
-        entities = [{"text": ent.text, "label": ent.label_} for ent in spacy_doc.ents]
-        doc["entities"] = entities
+# Spacy model (only the components needed for NER), loaded by startup() or on first use
+nlp = None
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        nlp = load_pipeline()
+    return nlp
+
+# Loads the model and runs a warm-up batch before any message is consumed.
+# In process mode the model is loaded once here and the workers inherit it
+# on fork; gc.freeze() keeps the collector from writing to the inherited
+# objects, so their pages stay shared instead of being copied per worker.
+# Returns the duration of each phase in seconds.
+def startup():
+    start = time.perf_counter()
+    get_nlp()
+    loaded = time.perf_counter()
+    entities = warm_up(nlp)
+    warmed = time.perf_counter()
+    if CONSUMER_MODE == "process":
+        gc.freeze()
+    phases = {"load": loaded - start, "warmup": warmed - loaded, "total": warmed - start}
+    for phase, seconds in phases.items():
+        STARTUP_SECONDS.set(seconds, phase=phase)
+    memory = process_memory() or {}
+    logger.info(
+        f"Extractor ready in {phases['total']:.2f} s (model load {phases['load']:.2f} s, "
+        f"warm-up {phases['warmup']:.2f} s, {entities} entities), "
+        f"RSS {memory.get('rss', 0) / 1024 / 1024:.0f} MB"
+    )
+    return phases
+
+# Persistent cache of entities for abstracts already processed and index of
+# the articles already augmented (rel_doi/version -> content hash). sqlite
+# connections can't be shared between threads or across fork, so each
+# worker thread (or process) opens its own
+_local = threading.local()
+
+def _thread_state():
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.cache = open_entity_cache(get_nlp())
+        _local.dedup = open_dedup_index("ner", exclude=("entities",))
+    return _local
+
+def get_entity_cache():
+    return _thread_state().cache
+
+def get_dedup_index():
+    return _thread_state().dedup
+
+# process_file function to read, process, and save the file.
+# Returns the path of the augmented split or None if nothing was saved
+def process_file(name):
+    raw_path = find_split(RAW_FOLDER, name)
+    if raw_path is None:
+        logger.warning(f"File not found: {os.path.join(RAW_FOLDER, name)}")
+        return None
+    entity_cache = get_entity_cache()
+    if entity_cache is not None:
+        hits_before, misses_before = entity_cache.hits, entity_cache.misses
+    start = time.time()
+    model_stats = {}
+    # Articles identical to one already ingested (same rel_doi/version and
+    # content) are dropped before NER; the new ones are staged in the index
+    # under this split once the augmented split is saved, and only count as
+    # processed when the Spark processor confirms it ingested the split
+    articles = iter_articles(raw_path)
+    dedup = get_dedup_index()
+    if dedup is not None:
+        skipped_before = dedup.skipped
+        articles = (article for article in articles if not dedup.seen(article))
+    # Articles are streamed from the raw split into the augmented split,
+    # the stage timings of the raw split are carried over
+    writer = SplitWriter(AUGMENTED_FOLDER, name, read_messages(raw_path), read_trace(raw_path))
+    try:
+        with writer:
+            # Process the documents in collection in batches with nlp.pipe,
+            # only abstracts missing from the entity cache go through spaCy
+            for doc in extract_entities(get_nlp(), articles, cache=entity_cache, stats=model_stats):
+                writer.write(doc)
+            skipped = dedup.skipped - skipped_before if dedup is not None else 0
+            writer.trace["ner"] = {
+                "start": start,
+                "end": time.time(),
+                "documents": writer.count,
+                "skipped": skipped,
+                "modelSeconds": model_stats["model_seconds"]
+            }
+    except Exception:
+        if dedup is not None:
+            dedup.discard()
+        raise
+    if dedup is not None:
+        dedup.commit(split=name)
+        SKIPPED.inc(skipped, stage="ner")
+        if skipped:
+            logger.info(f"Skipped {skipped} articles of {name} already augmented")
+    elapsed = time.time() - start
+    DOCUMENTS.inc(writer.count)
+    MODEL_SECONDS.inc(model_stats["model_seconds"])
+    MODEL_DOCUMENTS.inc(model_stats["model_documents"])
+    SPLIT_SECONDS.observe(elapsed)
+    if writer.count and elapsed > 0:
+        DOCS_PER_SECOND.set(writer.count / elapsed)
+    if entity_cache is not None:
+        entity_cache.evict()
+        stats = entity_cache.stats()
+        CACHE_LOOKUPS.inc(entity_cache.hits - hits_before, result="hit")
+        CACHE_LOOKUPS.inc(entity_cache.misses - misses_before, result="miss")
+        logger.info(
+            f"Entity cache for {name}: {entity_cache.hits - hits_before} hits, "
+            f"{entity_cache.misses - misses_before} misses "
+            f"({stats['hit_rate']:.1%} hit rate since start)"
+        )
     # Save the enlarged file
-    with open(augmented_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    logger.info(f"Processed and saved in: {augmented_path}")
+    if writer.count:
+        logger.info(f"Processed and saved in: {writer.path}")
+        return writer.path
+    # Nothing new, but an augmented split saved by an earlier delivery that
+    # was not acked is announced again so the Spark processor ingests it
+    existing = find_split(AUGMENTED_FOLDER, name)
+    if existing is not None:
+        logger.info(f"No new articles in {raw_path}, announcing the existing {existing}")
+        return existing
+    logger.warning(f"No articles to process in: {raw_path}")
+    return None
 
-# callback function to process messages from RabbitMQ
-def callback(ch, method, properties, body):
-    msg = json.loads(body)
+# Handler run by the consumer runtime for each message; the message is acked
+# once it returns and requeued if it raises. The AUGMENTED message returned
+# is published before the ack so the Spark processor can ingest the split
+def process_message(msg):
     logger.info(f"Received: {msg}")
-    jobId = msg["jobId"]
-    splitNumber = msg["splitNumber"]
-    filename = f"{jobId}_{splitNumber}.json"
-    process_file(filename)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    try:
+        name = split_name(msg["jobId"], msg["splitNumber"])
+    except (KeyError, TypeError) as e:
+        raise DiscardMessage(f"missing {e}")
+    path = process_file(name)
+    if path is None:
+        return []
+    augmented_msg = {
+        "jobId": msg["jobId"],
+        "splitNumber": msg["splitNumber"],
+        "file": os.path.basename(path),
+        "status": "AUGMENTED"
+    }
+    return [(RABBITMQ_AUGMENTED_QUEUE, augmented_msg)]
 
 def main():
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
+    # The model is loaded and warmed up before the workers start (process
+    # workers inherit it) and before /ready reports the pod as ready
+    startup()
+    runtime = ConsumerRuntime(
+        connection_parameters(),
+        RABBITMQ_QUEUE,
+        process_message,
+        declare=[RABBITMQ_AUGMENTED_QUEUE]
     )
-    channel = connection.channel()
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=RABBITMQ_QUEUE, on_message_callback=callback)
     logger.info("Waiting for RAW file messages to process entities...")
-    channel.start_consuming()
+    runtime.run()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,83 @@
+import os
+import time
+import random
+import argparse
+
+import spacy
+from ner import SPACY_MODEL, doc_entities, extract_entities, load_pipeline
+
+# Vocabulary for the synthetic corpus: plain words mixed with names, places,
+# organizations, dates and numbers so the NER component has work to do
+WORDS = [
+    "the", "patients", "infection", "viral", "load", "was", "measured", "in", "samples",
+    "from", "cohort", "and", "compared", "with", "controls", "we", "observed", "a",
+    "significant", "increase", "of", "antibodies", "after", "vaccination", "protein",
+    "spike", "binding", "affinity", "model", "predicts", "transmission", "rates",
+]
+ENTITIES = [
+    "SARS-CoV-2", "COVID-19", "Wuhan", "China", "Italy", "New York", "Harvard University",
+    "the World Health Organization", "Pfizer", "Moderna", "John Smith", "Maria Garcia",
+    "March 2020", "2021", "three weeks", "45%", "1,200 patients", "the United States",
+]
+
+# Build a fixed synthetic corpus of abstracts (same seed -> same corpus)
+def synthetic_corpus(n_docs, seed=42, words_per_doc=180):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n_docs):
+        tokens = []
+        while len(tokens) < words_per_doc:
+            if rng.random() < 0.1:
+                tokens.append(rng.choice(ENTITIES))
+            else:
+                tokens.append(rng.choice(WORDS))
+            if rng.random() < 0.07:
+                tokens[-1] += "."
+        corpus.append({"rel_doi": f"10.1101/synthetic.{i}", "rel_abs": " ".join(tokens)})
+    return corpus
+
+# Baseline: one nlp() call per abstract on the full pipeline (previous behaviour)
+def run_baseline(corpus):
+    nlp = spacy.load(SPACY_MODEL)
+    start = time.perf_counter()
+    results = [doc_entities(nlp(doc["rel_abs"])) for doc in corpus]
+    return time.perf_counter() - start, results
+
+# Batched: nlp.pipe on the NER-only pipeline
+def run_batched(corpus, batch_size, n_process):
+    nlp = load_pipeline()
+    articles = [dict(doc) for doc in corpus]
+    start = time.perf_counter()
+    results = [doc["entities"] for doc in extract_entities(nlp, articles, batch_size, n_process)]
+    return time.perf_counter() - start, results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NER throughput per core count")
+    parser.add_argument("--docs", type=int, default=2000, help="Number of synthetic abstracts")
+    parser.add_argument("--batch-size", type=int, default=64, help="nlp.pipe batch size")
+    parser.add_argument("--processes", default=None,
+                        help="Comma separated n_process values (default: 1,2,4,... up to the CPU count)")
+    args = parser.parse_args()
+
+    if args.processes:
+        process_counts = [int(p) for p in args.processes.split(",")]
+    else:
+        cpus = os.cpu_count() or 1
+        process_counts = [1]
+        while process_counts[-1] * 2 <= cpus:
+            process_counts.append(process_counts[-1] * 2)
+
+    corpus = synthetic_corpus(args.docs)
+    print(f"Corpus: {len(corpus)} docs, model: {SPACY_MODEL}, batch size: {args.batch_size}")
+
+    elapsed, expected = run_baseline(corpus)
+    print(f"{'mode':<20}{'processes':>10}{'seconds':>10}{'docs/sec':>12}{'parity':>8}")
+    print(f"{'baseline nlp()':<20}{1:>10}{elapsed:>10.2f}{len(corpus) / elapsed:>12.1f}{'-':>8}")
+
+    for n_process in process_counts:
+        elapsed, results = run_batched(corpus, args.batch_size, n_process)
+        parity = "ok" if results == expected else "DIFF"
+        print(f"{'nlp.pipe':<20}{n_process:>10}{elapsed:>10.2f}{len(corpus) / elapsed:>12.1f}{parity:>8}")
+
+if __name__ == "__main__":
+    main()
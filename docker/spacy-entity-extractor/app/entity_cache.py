@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Entity cache configuration (an empty path disables the cache)
+ENTITY_CACHE_PATH = os.getenv("ENTITY_CACHE_PATH", "/mnt/augmented/.entity_cache.sqlite3")
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "1000000"))
+ENTITY_CACHE_COMMIT_EVERY = 500  # Pending writes before an intermediate commit
+
+# Identifier of the model that produced the entities: a new model or version
+# yields different keys, so stale entries are never served and age out by LRU
+def model_id(nlp):
+    meta = nlp.meta
+    return f"{meta.get('lang', '')}_{meta.get('name', '')}@{meta.get('version', '')}"
+
+class EntityCache:
+    """
+    Persistent NER cache keyed by sha256(model id + abstract text).
+    Entries store the entity list as JSON and the time of their last use;
+    once the table grows past max_entries the least recently used entries
+    are evicted. The database lives on the shared volume, so the default
+    rollback journal is used (WAL is not safe on NFS) with a long busy timeout.
+    """
+    def __init__(self, path, model, max_entries=ENTITY_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.model = model
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entities ("
+            " key TEXT PRIMARY KEY,"
+            " entities TEXT NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entities_last_access ON entities (last_access)")
+        self.conn.commit()
+        self.pending_puts = {}
+        self.pending_hits = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text):
+        digest = hashlib.sha256()
+        digest.update(self.model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, text):
+        """Returns the cached entity list for the text or None on a miss."""
+        key = self.key(text)
+        if key in self.pending_puts:
+            self.hits += 1
+            return json.loads(self.pending_puts[key])
+        row = self.conn.execute("SELECT entities FROM entities WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pending_hits.add(key)
+        return json.loads(row[0])
+
+    def put(self, text, entities):
+        self.pending_puts[self.key(text)] = json.dumps(entities, ensure_ascii=False)
+        if len(self.pending_puts) >= ENTITY_CACHE_COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Writes pending entries and refreshes the last access of hits."""
+        if not self.pending_puts and not self.pending_hits:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entities (key, entities, last_access) VALUES (?, ?, ?)",
+                [(key, entities, now) for key, entities in self.pending_puts.items()]
+            )
+            self.conn.executemany(
+                "UPDATE entities SET last_access = ? WHERE key = ?",
+                [(now, key) for key in self.pending_hits]
+            )
+        self.pending_puts.clear()
+        self.pending_hits.clear()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_entries."""
+        self.flush()
+        count = self.conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return 0
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM entities WHERE key IN "
+                "(SELECT key FROM entities ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+        self.evictions += excess
+        logger.info(f"Entity cache: evicted {excess} least recently used entries")
+        return excess
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# Open the cache configured by the environment, or None if it is disabled or unavailable
+def open_entity_cache(nlp, path=ENTITY_CACHE_PATH):
+    if not path:
+        return None
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        cache = EntityCache(path, model_id(nlp))
+        logger.info(f"Entity cache enabled at {path} for model {cache.model}")
+        return cache
+    except sqlite3.Error as e:
+        logger.error(f"Entity cache disabled, could not open {path}: {e}")
+        return None
@@ -0,0 +1,125 @@
+import os
+import time
+import logging
+import argparse
+from collections import deque
+
+import spacy
+
+logger = logging.getLogger(__name__)
+
+# NER configuration
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_sm")
+# NER-only copy of SPACY_MODEL serialized at image build (python ner.py --save ...);
+# loading it skips the components NER doesn't use. Falls back to SPACY_MODEL if missing
+SPACY_TRIMMED_PATH = os.getenv("SPACY_TRIMMED_PATH", "/app/model-ner")
+NER_BATCH_SIZE = int(os.getenv("NER_BATCH_SIZE", "64"))  # Documents per nlp.pipe batch
+NER_N_PROCESS = int(os.getenv("NER_N_PROCESS", "1"))  # Worker processes used by nlp.pipe
+
+# Components that must stay enabled for NER to produce the same entities:
+# the "ner" component itself plus any shared tok2vec it listens to
+def unused_components(nlp):
+    keep = {"ner"}
+    for name, pipe in nlp.pipeline:
+        if "ner" in getattr(pipe, "listening_components", []):
+            keep.add(name)
+    return [name for name in nlp.pipe_names if name not in keep]
+
+# Load the Spacy model with only the components NER needs: the trimmed copy
+# when it exists, otherwise the full model with the other components disabled
+def load_pipeline(model=SPACY_MODEL, trimmed_path=SPACY_TRIMMED_PATH):
+    if trimmed_path and os.path.isdir(trimmed_path):
+        meta = spacy.util.load_meta(os.path.join(trimmed_path, "meta.json"))
+        if meta.get("trimmed_from") == model:
+            nlp = spacy.load(trimmed_path)
+            logger.info(f"Loaded trimmed pipeline {trimmed_path}, components: {nlp.pipe_names}")
+            return nlp
+        logger.warning(f"Trimmed pipeline {trimmed_path} is not {model}, loading the full model")
+    nlp = spacy.load(model)
+    disabled = unused_components(nlp)
+    nlp.select_pipes(disable=disabled)
+    logger.info(f"Loaded {model}, active components: {nlp.pipe_names}, disabled: {disabled}")
+    return nlp
+
+# Serialize a copy of the model without the components NER doesn't use.
+# The meta (name and version) is kept, so entity cache keys don't change
+def save_trimmed_pipeline(path, model=SPACY_MODEL):
+    nlp = spacy.load(model)
+    removed = unused_components(nlp)
+    for name in removed:
+        nlp.remove_pipe(name)
+    nlp.meta["trimmed_from"] = model
+    nlp.to_disk(path)
+    logger.info(f"Saved {model} to {path} with components {nlp.pipe_names}, removed: {removed}")
+
+# Texts run through the pipeline before consuming, so the first split doesn't
+# pay for the lazy initialization of the model
+WARMUP_TEXTS = [
+    "SARS-CoV-2 infection was studied in 1,024 patients admitted to hospitals in Wuhan, China, in January 2020.",
+    "The World Health Organization and the National Institutes of Health funded a randomized trial of remdesivir.",
+    "Researchers at Harvard Medical School sequenced viral genomes from Boston and New York over six months.",
+]
+
+# Run a warm-up batch through the pipeline (the same nlp.pipe path as extract_entities)
+def warm_up(nlp, batch_size=NER_BATCH_SIZE):
+    docs = list(nlp.pipe(WARMUP_TEXTS * max(1, batch_size // len(WARMUP_TEXTS)), batch_size=batch_size))
+    return sum(len(doc.ents) for doc in docs)
+
+# Convert a processed spaCy doc into the entity list stored with each article
+def doc_entities(spacy_doc):
+    return [{"text": ent.text, "label": ent.label_} for ent in spacy_doc.ents]
+
+# Run NER over a stream of articles with nlp.pipe and yield each article with its
+# "entities" attached, in input order. Articles waiting for their batch are kept
+# in a queue so only the abstracts are sent to the worker processes. When a cache
+# is given, abstracts already in it skip spaCy and new results are stored in it.
+# When a stats dict is given, the time spent waiting on nlp.pipe is added to
+# stats["model_seconds"] and the abstracts it processed to stats["model_documents"].
+def extract_entities(nlp, articles, batch_size=NER_BATCH_SIZE, n_process=NER_N_PROCESS, cache=None, stats=None):
+    pending = deque()  # (article, cached entities or None)
+    if stats is not None:
+        stats.setdefault("model_seconds", 0.0)
+        stats.setdefault("model_documents", 0)
+
+    def texts():
+        for doc in articles:
+            text = doc.get("rel_abs", "")
+            entities = cache.get(text) if cache is not None else None
+            pending.append((doc, entities))
+            if entities is None:
+                yield text
+
+    def release_cached():
+        while pending and pending[0][1] is not None:
+            doc, entities = pending.popleft()
+            doc["entities"] = entities
+            yield doc
+
+    docs = iter(nlp.pipe(texts(), batch_size=batch_size, n_process=n_process))
+    while True:
+        start = time.perf_counter()
+        spacy_doc = next(docs, None)
+        if stats is not None:
+            stats["model_seconds"] += time.perf_counter() - start
+        if spacy_doc is None:
+            break
+        if stats is not None:
+            stats["model_documents"] += 1
+        # Cached articles queued before this one keep their position
+        yield from release_cached()
+        doc, _ = pending.popleft()
+        doc["entities"] = doc_entities(spacy_doc)
+        if cache is not None:
+            cache.put(doc.get("rel_abs", ""), doc["entities"])
+        yield doc
+    yield from release_cached()
+
+
+# Run at image build time to bake the trimmed pipeline into the image
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Serialize the NER-only pipeline loaded by the extractor")
+    parser.add_argument("--save", default=SPACY_TRIMMED_PATH, help="Folder for the trimmed pipeline")
+    parser.add_argument("--model", default=SPACY_MODEL)
+    args = parser.parse_args()
+    save_trimmed_pipeline(args.save, args.model)
@@ -1,12 +1,31 @@
 import os
 import json
+import time
+import signal
 import logging
-import glob
+import zipfile
+import tempfile
+import threading
 from datetime import datetime
+import pika
+from pymongo.errors import PyMongoError
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, split, trim, regexp_replace, to_date, date_format, initcap, udf, struct, to_json
-from pyspark.sql.types import ArrayType, StructType, StructField, StringType
-import pymongo
+from functools import partial
+from urllib.parse import unquote, urlparse
+from pyspark.sql.functions import col, split, trim, regexp_replace, to_date, date_format, initcap, udf, input_file_name, \
+    array, array_join, coalesce, concat, element_at, exists, lit, lower, size, struct, transform, when, aggregate, \
+    max as spark_max, min as spark_min, filter as array_filter, slice as array_slice
+from pyspark.sql.types import ArrayType, StructType, StructField, StringType, LongType
+import common
+import mongo_writer
+from mongo_writer import close_mongo_client, ensure_entity_postings, ensure_facet_counts, find_processed, \
+    mark_processed, merge_stats, record_high_water_mark, record_split_traces, write_partition
+from common.splitio import detect_format, find_split, iter_articles, list_splits, parse_split_name, read_trace, split_name, \
+    strip_extension
+from common.consumer import connection_parameters
+from common.metrics import counter, histogram, start_metrics_server
+from common.dedup import SKIPPED, confirm_splits
+from common.searchindex import SEARCH_INDEX_DIR, IndexWriter, index_entries
 
 # Logger Configuration
 logging.basicConfig(
@@ -17,8 +36,25 @@ logger = logging.getLogger(__name__)
 
 # Environment variables
 AUGMENTED_FOLDER = "/mnt/augmented"
-MONGO_URI = os.getenv("MONGO_URI")
-PROCESSED_LOG = "/mnt/augmented/.processed_files.json"
+PROCESSED_LOG = "/mnt/augmented/.processed_files.json"  # Old completion log, migrated to the processed_splits collection
+PROCESSING_MODE = os.getenv("SPARK_PROCESSING_MODE", "batch")  # "batch" (one job per run), "per-file" or "stream"
+RABBITMQ_AUGMENTED_QUEUE = os.getenv("RABBITMQ_QUEUE_AUGMENTED", "documentos_aumentados")  # Splits announced by the extractor
+MICRO_BATCH_SIZE = int(os.getenv("SPARK_MICRO_BATCH_SIZE", "50"))  # Max splits per micro-batch in stream mode
+MICRO_BATCH_WAIT = float(os.getenv("SPARK_MICRO_BATCH_WAIT", "10"))  # Seconds to wait for a micro-batch to fill
+SOURCE_FILE_COLUMN = "_source_file"
+SPARK_NATIVE_FORMATS = ("ndjson", "parquet")  # Split formats Spark reads itself; the rest are parsed in Python
+SEARCH_INDEX_COLUMNS = ["rel_doi", "rel_title", "rel_abs", "category", "type", "entities"]
+SEARCH_INDEX_SEGMENT_FILES = int(os.getenv("SEARCH_INDEX_SEGMENT_FILES", "100"))  # Split files collected per index segment
+
+# Metrics (exported while the processor runs, continuously in stream mode)
+ROWS = counter("biorxiv_spark_rows_total", "Documents written to MongoDB", ["result"])
+FILES = counter("biorxiv_spark_files_total", "Split files ingested", ["result"])
+MONGO_WRITE_SECONDS = histogram("biorxiv_spark_mongo_bulk_write_seconds", "Latency of each bulk_write to MongoDB")
+INGEST_SECONDS = histogram("biorxiv_spark_ingest_seconds", "Time to ingest one group of split files")
+INDEX_SECONDS = histogram("biorxiv_spark_search_index_seconds", "Time to add one group of split files to the local search index")
+
+# Writer of the local BM25 index, opened on first use (only the driver writes it)
+search_index_writer = None
 
 # Function to transform author names: "First Name, Last Name" -> "Last Name, First Name"
 # def transform_author_name(author_name):
@@ -70,6 +106,34 @@ rel_authors_schema = ArrayType(
     ])
 )
 
+# Esquema de los autores tal como llegan de la API (author_inst es un texto)
+raw_rel_authors_schema = ArrayType(
+    StructType([
+        StructField("author_name", StringType(), True),
+        StructField("author_inst", StringType(), True)
+    ])
+)
+
+# Esquema fijo de los artículos de bioRxiv en los splits aumentados
+article_schema = StructType([
+    StructField("rel_title", StringType(), True),
+    StructField("rel_doi", StringType(), True),
+    StructField("rel_link", StringType(), True),
+    StructField("rel_abs", StringType(), True),
+    StructField("rel_num_authors", LongType(), True),
+    StructField("rel_authors", raw_rel_authors_schema, True),
+    StructField("rel_date", StringType(), True),
+    StructField("rel_site", StringType(), True),
+    StructField("category", StringType(), True),
+    StructField("type", StringType(), True),
+    StructField("entities", ArrayType(
+        StructType([
+            StructField("text", StringType(), True),
+            StructField("label", StringType(), True)
+        ])
+    ), True)
+])
+
 # UDF para transformar nombres de autor y separar instituciones dentro de la estructura anidada
 def transform_nested_authors(rel_authors):
     if rel_authors is None or not isinstance(rel_authors, list):
@@ -78,7 +142,8 @@ def transform_nested_authors(rel_authors):
     transformed = []
     for author in rel_authors:
         if author:
-            author = author.copy()  # Crear copia para no modificar el original
+            # Crear copia para no modificar el original (Row si viene de spark.read.json)
+            author = author.asDict() if hasattr(author, "asDict") else author.copy()
             
             # Transformar author_name a formato "Apellido, Nombre"
             if "author_name" in author and author["author_name"]:
@@ -108,26 +173,170 @@ def transform_nested_authors(rel_authors):
 # Registrar el UDF con el esquema correcto
 transform_nested_authors_udf = udf(transform_nested_authors, rel_authors_schema)
 
-# Loads the list of files already processed
-def load_processed_files():
-    if os.path.exists(PROCESSED_LOG):
-        try:
-            with open(PROCESSED_LOG, 'r') as f:
-                return set(json.load(f))
-        except:
-            return set()
-    return set()
-
-# Saves the list of processed files
-def save_processed_files(processed):
+# Expresiones nativas de Spark equivalentes a los UDFs anteriores.
+# Evitan serializar cada fila hacia los workers de Python y producen exactamente
+# el mismo resultado que las funciones de Python (test_authors.py lo verifica).
+# transform_author_name sigue como UDF: su versión nativa era más lenta.
+
+# Caracteres que str.strip() y str.split() de Python consideran espacios
+PY_WHITESPACE = r"[\t\n\u000B\f\r\u001C-\u001F \u0085\u00A0\u1680\u2000-\u200A\u2028\u2029\u202F\u205F\u3000]"
+
+# Equivalente a str.strip()
+def py_strip(c):
+    return regexp_replace(c, f"^{PY_WHITESPACE}+|{PY_WHITESPACE}+$", "")
+
+# Equivalente a str.split() (para un texto vacío devuelve [""], que también tiene menos de 2 partes)
+def py_split_words(c):
+    return split(py_strip(c), f"{PY_WHITESPACE}+")
+
+# parts -> "parts[-1], parts[0] ... parts[-2]"
+def last_name_first(parts):
+    return concat(element_at(parts, -1), lit(", "), array_join(array_slice(parts, 1, size(parts) - 1), " "))
+
+# Equivalente a [inst.strip() for inst in text.split(sep)] sin los elementos vacíos
+def split_and_strip(c, sep):
+    return array_filter(transform(split(c, sep), py_strip), lambda inst: inst != "")
+
+# Nativo de extract_author_names
+def extract_author_names_expr(rel_authors):
+    return when(rel_authors.isNull(), lit("")) \
+        .otherwise(array_join(transform(rel_authors, lambda a: coalesce(a["author_name"], lit(""))), ", "))
+
+# Nativo de extract_author_insts
+def extract_author_insts_expr(rel_authors):
+    return when(rel_authors.isNull(), lit("")) \
+        .otherwise(array_join(transform(rel_authors, lambda a: coalesce(a["author_inst"], lit(""))), "; "))
+
+# Nativo de transform_nested_authors. Igual que el UDF, un author_inst que queda
+# como texto (vacío, o con "." pero sin ";" ni ",") no cabe en el esquema y queda nulo.
+def transform_nested_authors_expr(rel_authors):
+    def transform_author(author):
+        name = author["author_name"]
+        inst = author["author_inst"]
+        parts = py_split_words(name)
+        new_name = when(name.isNotNull() & (name != "") & (size(parts) >= 2), last_name_first(parts)) \
+            .otherwise(name)
+        new_inst = when(inst.isNull() | (inst == ""), lit(None).cast(ArrayType(StringType()))) \
+            .when(inst.contains(";"), split_and_strip(inst, ";")) \
+            .when(inst.contains(","), split_and_strip(inst, ",")) \
+            .when(inst.contains("."), lit(None).cast(ArrayType(StringType()))) \
+            .otherwise(array(inst))
+        return when(author.isNull(), lit(None)) \
+            .otherwise(struct(new_name.alias("author_name"), new_inst.alias("author_inst")))
+    return transform(rel_authors, transform_author)
+
+# Normalized form of an entity text: case-folded with the whitespace collapsed,
+# the same as mongo_writer.entity_key (" ".join(text.split()).lower())
+def entity_key_expr(text):
+    return lower(array_join(array_filter(py_split_words(text), lambda word: word != ""), " "))
+
+# Adds the normalized "key" to each entity and keeps only the first occurrence
+# of each (label, key) in a document, preserving the original text and order
+def normalize_entities_expr(entities):
+    normalized = transform(entities, lambda e: struct(
+        e["text"].alias("text"), e["label"].alias("label"), entity_key_expr(e["text"]).alias("key")))
+    empty = array_filter(normalized, lambda e: lit(False))
+    def keep_first(kept, e):
+        duplicate = exists(kept, lambda k: k["label"].eqNullSafe(e["label"]) & k["key"].eqNullSafe(e["key"]))
+        return when(duplicate, kept).otherwise(concat(kept, array(e)))
+    return when(entities.isNull(), lit(None)).otherwise(aggregate(normalized, empty, keep_first))
+
+# Moves the old processed files log into the processed_splits collection (once)
+def migrate_processed_log():
+    if not os.path.exists(PROCESSED_LOG):
+        return
     try:
-        with open(PROCESSED_LOG, 'w') as f:
-            json.dump(list(processed), f)
+        with open(PROCESSED_LOG, 'r') as f:
+            processed = json.load(f)
+        mark_processed(processed)
+        os.replace(PROCESSED_LOG, PROCESSED_LOG + ".migrated")
+        logger.info(f"Migrated {len(processed)} processed files from {PROCESSED_LOG}")
     except Exception as e:
-        logger.error(f"Error saving processed file: {e}")
+        logger.error(f"Error migrating {PROCESSED_LOG}: {e}")
 
-# Process a single file with Spark transformations
-def process_file(spark, filename):
+# Spark transformations applied to the articles before saving them
+def transform_articles(df):
+    return df \
+        .withColumn("rel_authors", transform_nested_authors_expr(col("rel_authors"))) \
+        .withColumn("entities", normalize_entities_expr(col("entities"))) \
+        .withColumn("category", initcap(trim(col("category")))) \
+        .withColumn("rel_date", date_format(to_date(col("rel_date"), "yyyy-MM-dd"), "dd/MM/yyyy"))
+
+# Save the transformed articles in MongoDB: each executor upserts its own partitions
+# based on rel_doi in unordered bulk batches, the driver only collects the counters.
+# Rows are hash partitioned on rel_doi so concurrent upserts never share a DOI.
+# Returns the total counters and the per partition counters.
+def write_documents(transformed_df, file_column=None):
+    write_df = transformed_df.repartition(max(1, transformed_df.rdd.getNumPartitions()), "rel_doi")
+    partition_stats = write_df.rdd.mapPartitions(partial(write_partition, file_column=file_column)).collect()
+    stats = merge_stats(partition_stats)
+    ROWS.inc(stats["documents"] - stats["failed"], result="saved")
+    ROWS.inc(stats["failed"], result="failed")
+    SKIPPED.inc(stats["skipped"], stage="spark")
+    for partition in partition_stats:
+        for seconds in partition.get("batch_seconds", []):
+            MONGO_WRITE_SECONDS.observe(seconds)
+    return stats, partition_stats
+
+def log_write_stats(stats, source):
+    logger.info(
+        f"{stats['documents']} documents processed in {source}: "
+        f"{stats['upserted']} upserted, {stats['modified']} modified, "
+        f"{stats['inserted']} inserted, {stats['failed']} failed, {stats['skipped']} unchanged skipped "
+        f"in {stats['batches']} batches ({stats['seconds']:.2f} s)"
+    )
+
+# Adds the saved articles to the local BM25 search index as new segments.
+# The executors tokenize their partitions and the driver writes each segment;
+# with files (source URIs in file_column) only the rows of those files are
+# indexed, SEARCH_INDEX_SEGMENT_FILES files at a time, so a large first ingest
+# never collects every document on the driver at once. Rows of files that
+# failed are left out (they are indexed when the file is retried).
+# Index errors are logged and never fail the ingest.
+def index_documents(transformed_df, file_column=None, files=None):
+    global search_index_writer
+    if not SEARCH_INDEX_DIR:
+        return
+    start = time.time()
+    try:
+        if search_index_writer is None:
+            search_index_writer = IndexWriter()
+        if files is None:
+            groups = [transformed_df]
+        else:
+            files = sorted(files)
+            step = max(1, SEARCH_INDEX_SEGMENT_FILES)
+            groups = [transformed_df.filter(col(file_column).isin(files[i:i + step]))
+                      for i in range(0, len(files), step)]
+        for group_df in groups:
+            entries = group_df.select(*SEARCH_INDEX_COLUMNS).rdd.mapPartitions(index_entries).collect()
+            search_index_writer.add(entry for _, entry in entries)
+    except Exception as e:
+        logger.error(f"Could not update the search index in {SEARCH_INDEX_DIR}: {e}")
+    INDEX_SECONDS.observe(time.time() - start)
+
+# Earliest and latest rel_date of transformed articles as yyyy-MM-dd (they store it as dd/MM/yyyy)
+def rel_date_range():
+    rel_date = to_date(col("rel_date"), "dd/MM/yyyy")
+    return date_format(spark_min(rel_date), "yyyy-MM-dd"), date_format(spark_max(rel_date), "yyyy-MM-dd")
+
+# Reads NDJSON and Parquet split files with the fixed article schema into one DataFrame
+def read_split_files(spark, paths):
+    by_format = {}
+    for path in paths:
+        by_format.setdefault(detect_format(path), []).append(path)
+    frames = []
+    if by_format.get("ndjson"):
+        frames.append(spark.read.schema(article_schema).json(by_format["ndjson"]))
+    if by_format.get("parquet"):
+        frames.append(spark.read.schema(article_schema).parquet(*by_format["parquet"]))
+    df = frames[0]
+    for frame in frames[1:]:
+        df = df.unionByName(frame)
+    return df
+
+# Process a single file with Spark transformations (its rel_date range is added to file_dates)
+def process_file(spark, filename, file_dates=None):
     logger.info(f"Processing file: {filename}")
     filepath = os.path.join(AUGMENTED_FOLDER, filename)
     
@@ -136,55 +345,304 @@ def process_file(spark, filename):
         return False
     
     try:
-        # Load the JSON as text and then as a DataFrame
-        with open(filepath, "r", encoding="utf-8") as f:
-            json_content = f.read()
-        
-        # Parse JSON and create DataFrame
-        json_data = json.loads(json_content)
-        collection_data = json_data.get("collection", [])
-        
-        if not collection_data:
-            logger.warning(f"No data collections in {filepath}")
-            return True  # We consider it processed even if it is empty
-        
-        # First create the author_name column from rel_authors
-        df = spark.createDataFrame(collection_data)
-
-        transformed_df = df \
-            .withColumn("rel_authors", transform_nested_authors_udf(col("rel_authors"))) \
-            .withColumn("category", initcap(trim(col("category")))) \
-            .withColumn("rel_date", date_format(to_date(col("rel_date"), "yyyy-MM-dd"), "dd/MM/yyyy"))
-        # Convert to MongoDB format and save
-        mongo_df = transformed_df.select(to_json(struct("*")).alias("json"))
-        documents = [json.loads(row.json) for row in mongo_df.collect()]
-        
-        # Save in MongoDB
-        client = pymongo.MongoClient(MONGO_URI)
-        db = client.get_database()
-        documents_collection = db.documents
-        
-        if documents:
-            # Insert with upsert based on rel_doi to avoid duplicates
-            for doc in documents:
-                if doc.get("rel_doi"):
-                    documents_collection.update_one(
-                        {"rel_doi": doc["rel_doi"]}, 
-                        {"$set": doc}, 
-                        upsert=True
-                    )
-                else:
-                    documents_collection.insert_one(doc)
-                    
-            logger.info(f"{len(documents)} documents processed in file {filename}")
+        split_format = detect_format(filepath)
+        if split_format == "legacy":
+            # Legacy split: load the whole JSON document and create the DataFrame
+            collection_data = list(iter_articles(filepath))
+            if not collection_data:
+                logger.warning(f"No data collections in {filepath}")
+                return True  # We consider it processed even if it is empty
+            df = spark.createDataFrame(collection_data)
+        elif split_format in SPARK_NATIVE_FORMATS:
+            # NDJSON or Parquet split: Spark reads the file itself
+            df = read_split_files(spark, [filepath])
+        else:
+            # Compressed NDJSON: decompress in Python and parse with the fixed schema
+            lines = [json.dumps(article, ensure_ascii=False) for article in iter_articles(filepath)]
+            if not lines:
+                logger.warning(f"No data collections in {filepath}")
+                return True
+            df = spark.read.schema(article_schema).json(spark.sparkContext.parallelize(lines))
+
+        # Persisted so the write, the high-water mark and the index share one read of the file
+        transformed = transform_articles(df).persist()
+        try:
+            stats, _ = write_documents(transformed)
+            if file_dates is not None:
+                file_dates[filename] = tuple(transformed.agg(*rel_date_range()).first())
+
+            if stats["documents"] or stats["skipped"]:
+                log_write_stats(stats, f"file {filename}")
+                if stats["failed"]:
+                    return False
+                index_documents(transformed)
+            else:
+                logger.warning(f"No data collections in {filepath}")
+        finally:
+            transformed.unpersist()
         
-        client.close()
         return True
     
     except Exception as e:
         logger.error(f"Error processing {filename}: {e}")
         return False
 
+# jobIds of the given split files (names that don't follow <jobId>_<n> are skipped)
+def split_job_ids(filenames):
+    job_ids = set()
+    for filename in filenames:
+        try:
+            job_ids.add(parse_split_name(filename)[0])
+        except ValueError:
+            continue
+    return job_ids
+
+# Name of the split file a row was read from (input_file_name returns a URI)
+def source_filename(uri):
+    return os.path.basename(unquote(urlparse(uri).path))
+
+# Process all pending NDJSON/Parquet splits as a single Spark job with the fixed schema.
+# Returns the set of files that were completely saved.
+def process_batch(spark, filenames, file_dates=None):
+    logger.info(f"Processing {len(filenames)} files in a single batch")
+    paths = [os.path.join(AUGMENTED_FOLDER, filename) for filename in filenames]
+    
+    try:
+        df = read_split_files(spark, paths).withColumn(SOURCE_FILE_COLUMN, input_file_name())
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        return set()
+    # Persisted so the write, the per-file dates and the index share one read and transform of the splits
+    transformed = transform_articles(df).persist()
+    try:
+        return save_batch(transformed, filenames, file_dates)
+    finally:
+        transformed.unpersist()
+
+# Writes a persisted batch and indexes the completed files. The rel_date range
+# of every file (completed or not) is added to file_dates for the high-water mark
+def save_batch(transformed, filenames, file_dates=None):
+    try:
+        stats, partition_stats = write_documents(transformed, file_column=SOURCE_FILE_COLUMN)
+        # Source URI and rel_date range of each file
+        file_rows = transformed.groupBy(SOURCE_FILE_COLUMN).agg(*rel_date_range()).collect()
+        file_uris = {source_filename(row[0]): row[0] for row in file_rows}
+        if file_dates is not None:
+            file_dates.update((source_filename(row[0]), (row[1], row[2])) for row in file_rows)
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        return set()
+    
+    log_write_stats(stats, f"batch of {len(filenames)} files")
+    
+    # A file is complete unless one of the partitions holding its rows had failures
+    failed_files = set()
+    for partition in partition_stats:
+        if partition["failed"]:
+            failed_files.update(source_filename(uri) for uri in partition["files"])
+    if failed_files:
+        logger.warning(f"{len(failed_files)} files had failed writes and will be retried: {sorted(failed_files)}")
+    completed = set(filenames) - failed_files
+    index_documents(transformed, SOURCE_FILE_COLUMN, [uri for name, uri in file_uris.items() if name in completed])
+    return completed
+
+# Saves the given split files and records the completed ones.
+# NDJSON and Parquet splits are read and transformed together in batch mode,
+# legacy and compressed NDJSON splits one by one.
+def ingest_files(spark, filenames):
+    pending_files = list(filenames)
+    completed = set()
+    file_dates = {}
+    start = time.time()
+    # The partitions update facet_counts and entity_postings incrementally, so they must be complete first
+    try:
+        ensure_facet_counts()
+    except PyMongoError as e:
+        logger.error(f"Could not rebuild facet counts, the API will aggregate them on demand: {e}")
+    try:
+        ensure_entity_postings()
+    except PyMongoError as e:
+        logger.error(f"Could not rebuild entity postings, the API will match the documents directly: {e}")
+    if PROCESSING_MODE != "per-file":
+        batch_files = [filename for filename in pending_files if detect_format(filename) in SPARK_NATIVE_FORMATS]
+        if batch_files:
+            completed.update(process_batch(spark, batch_files, file_dates))
+        pending_files = [filename for filename in pending_files if detect_format(filename) not in SPARK_NATIVE_FORMATS]
+    for filename in pending_files:
+        if process_file(spark, filename, file_dates):
+            completed.add(filename)
+    mark_processed(completed)
+    advance_high_water_mark(completed, file_dates)
+    # The extractor's dedup entries for these splits now count as processed
+    confirm_splits("ner", [strip_extension(filename) for filename in completed])
+    record_traces(completed, start)
+    INGEST_SECONDS.observe(time.time() - start)
+    FILES.inc(len(completed), result="saved")
+    FILES.inc(len(set(filenames) - completed), result="failed")
+    return completed
+
+# Advances the high-water mark with the completed files without jumping past a
+# split of the same jobs that is still pending (failed, or in the augmented
+# folder but not ingested yet): the mark stops at the earliest article of the
+# pending splits, and does not move if one of them was not read in this run.
+# lastTotal only follows the jobs with no pending splits left.
+def advance_high_water_mark(completed, file_dates):
+    job_ids = split_job_ids(completed)
+    if not job_ids:
+        return
+    try:
+        pending = [filename for filename in pending_files() if split_job_ids([filename]) & job_ids]
+    except (OSError, PyMongoError) as e:
+        logger.error(f"Could not list the pending splits, the high-water mark is not advanced: {e}")
+        return
+    unknown = [filename for filename in pending if not file_dates.get(filename, (None, None))[0]]
+    if unknown:
+        logger.info(f"High-water mark not advanced: {len(unknown)} pending splits of jobs {sorted(job_ids)} "
+                    f"were not read yet")
+        return
+    latest = max((file_dates[filename][1] for filename in completed
+                  if filename in file_dates and file_dates[filename][1]), default=None)
+    if latest and pending:
+        latest = min([latest] + [file_dates[filename][0] for filename in pending])
+    record_high_water_mark(latest, job_ids - split_job_ids(pending))
+
+# Adds the Spark timings to the trace each split carries from the previous stages
+# and stores it in the job document, so the critical path of a crawl can be followed
+def record_traces(filenames, start):
+    end = time.time()
+    traces = {}
+    for filename in filenames:
+        try:
+            key = parse_split_name(filename)
+        except ValueError:
+            continue
+        trace = read_trace(os.path.join(AUGMENTED_FOLDER, filename))
+        trace["spark"] = {"start": start, "end": end}
+        first_start = min(stage["start"] for stage in trace.values())
+        trace["totalSeconds"] = end - first_start
+        traces[key] = trace
+    record_split_traces(traces)
+
+# Split files in the augmented folder that were not saved yet
+def pending_files():
+    split_files = list_splits(AUGMENTED_FOLDER)
+    processed_files = find_processed(split_files)
+    return [filename for filename in split_files if filename not in processed_files]
+
+# Split file named by an AUGMENTED message (older messages only carry jobId/splitNumber)
+def message_filename(msg):
+    if msg.get("file"):
+        return os.path.basename(msg["file"])
+    path = find_split(AUGMENTED_FOLDER, split_name(msg["jobId"], msg["splitNumber"]))
+    return os.path.basename(path) if path else None
+
+# Runs func in another thread while this one serves the RabbitMQ connection,
+# so heartbeats keep flowing during a long Spark job
+def run_with_heartbeats(connection, func, *args):
+    result = {}
+    def target():
+        try:
+            result["value"] = func(*args)
+        except Exception as e:
+            result["error"] = e
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    while worker.is_alive():
+        connection.process_data_events(time_limit=1)
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+# Waits for the first message and then collects more until the batch is full
+# or MICRO_BATCH_WAIT seconds have passed
+def collect_micro_batch(channel, stopping):
+    deliveries = []
+    deadline = None
+    for method, properties, body in channel.consume(RABBITMQ_AUGMENTED_QUEUE, inactivity_timeout=1):
+        if method is not None:
+            deliveries.append((method.delivery_tag, body))
+            if deadline is None:
+                deadline = time.monotonic() + MICRO_BATCH_WAIT
+        if len(deliveries) >= MICRO_BATCH_SIZE or (deadline and time.monotonic() >= deadline):
+            break
+        if stopping.is_set():
+            break
+    return deliveries
+
+# Saves the splits of a micro-batch and acks their messages; splits that failed are requeued
+def ingest_micro_batch(spark, connection, channel, deliveries):
+    files = {}
+    for delivery_tag, body in deliveries:
+        try:
+            filename = message_filename(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Discarding invalid message {body!r}: {e}")
+            filename = None
+        if filename is None:
+            logger.warning(f"No augmented split for message {body!r}")
+            channel.basic_ack(delivery_tag=delivery_tag)
+            continue
+        files.setdefault(filename, []).append(delivery_tag)
+
+    new_files = set(files) - find_processed(files)
+    completed = run_with_heartbeats(connection, ingest_files, spark, sorted(new_files)) if new_files else set()
+    logger.info(f"Micro-batch of {len(deliveries)} messages: {len(completed)} files saved, "
+                f"{len(files) - len(new_files)} already saved, {len(new_files - completed)} failed")
+    for filename, delivery_tags in files.items():
+        for delivery_tag in delivery_tags:
+            if filename in new_files and filename not in completed:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            else:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+# Long-running mode: ingest the splits as the extractor announces them
+def run_stream(spark):
+    stopping = threading.Event()
+    def stop(signum, frame):
+        logger.info(f"Received signal {signum}, stopping after the current micro-batch")
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Catch up with the splits that arrived while the processor was not running
+    pending = pending_files()
+    if pending:
+        ingest_files(spark, pending)
+
+    while not stopping.is_set():
+        connection = None
+        try:
+            connection = pika.BlockingConnection(connection_parameters())
+            channel = connection.channel()
+            channel.queue_declare(queue=RABBITMQ_AUGMENTED_QUEUE, durable=True)
+            channel.basic_qos(prefetch_count=MICRO_BATCH_SIZE)
+            logger.info(f"Waiting for AUGMENTED messages on {RABBITMQ_AUGMENTED_QUEUE}...")
+            while not stopping.is_set():
+                deliveries = collect_micro_batch(channel, stopping)
+                if deliveries:
+                    ingest_micro_batch(spark, connection, channel, deliveries)
+            # Return the prefetched messages to the queue
+            channel.cancel()
+        except pika.exceptions.AMQPError as e:
+            logger.error(f"RabbitMQ connection error: {e!r}, reconnecting in 5 seconds")
+            stopping.wait(5)
+        finally:
+            if connection is not None and connection.is_open:
+                connection.close()
+
+# Ships the partition writer and the shared package (common.dedup,
+# common.searchindex...) to the Python workers: addPyFile only accepts single
+# files or archives, so common/ is zipped into a temporary file first
+def add_py_files(spark):
+    spark.sparkContext.addPyFile(mongo_writer.__file__)
+    package_dir = os.path.dirname(os.path.abspath(common.__file__))
+    archive = os.path.join(tempfile.mkdtemp(prefix="spark-py-files-"), "common.zip")
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for filename in sorted(os.listdir(package_dir)):
+            if filename.endswith(".py"):
+                zf.write(os.path.join(package_dir, filename), os.path.join("common", filename))
+    spark.sparkContext.addPyFile(archive)
+
 def main():
     logger.info("Starting SparkSQLJobProcessor")
     
@@ -193,35 +651,27 @@ def main():
         .appName("SparkSQLJobProcessor") \
         .config("spark.jars.packages", "org.mongodb.spark:mongo-spark-connector_2.12:3.0.1") \
         .getOrCreate()
+    # Make the partition writer and the shared modules importable by the Python workers
+    add_py_files(spark)
     
+    start_metrics_server()
     try:
-        # Load log of already processed files
-        processed_files = load_processed_files()
+        migrate_processed_log()
         
-        # Get all JSON files in the augmented folder
-        json_files = glob.glob(os.path.join(AUGMENTED_FOLDER, "*.json"))
-        
-        # Process only previously unprocessed files
-        newly_processed = set()
-        for filepath in json_files:
-            filename = os.path.basename(filepath)
-            if filename not in processed_files:
-                success = process_file(spark, filename)
-                if success:
-                    newly_processed.add(filename)
-        
-        # Update and save the list of processed files
-        processed_files.update(newly_processed)
-        save_processed_files(processed_files)
-        
-        logger.info(f"Processed completed. {len(newly_processed)} new processed files.")
+        if PROCESSING_MODE == "stream":
+            run_stream(spark)
+        else:
+            # Process only the split files (NDJSON and legacy JSON) not saved yet
+            newly_processed = ingest_files(spark, pending_files())
+            logger.info(f"Processed completed. {len(newly_processed)} new processed files.")
     
     except Exception as e:
         logger.error(f"General error in the processor {e}")
     
     finally:
+        close_mongo_client()
         spark.stop()
         logger.info("SparkSQLJobProcessor finished.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,138 @@
+import sys
+import time
+import argparse
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, to_json, struct
+from pyspark.sql.types import ArrayType, MapType, StructType, StructField, StringType
+from app import (
+    raw_rel_authors_schema,
+    transform_nested_authors_udf, transform_nested_authors_expr,
+    extract_author_names_udf, extract_author_names_expr,
+    extract_author_insts_udf, extract_author_insts_expr,
+)
+
+# Nombres de autor difíciles: espacios repetidos, tabs, espacios Unicode,
+# nombres de una sola palabra, comas, acentos y caracteres fuera del BMP
+TRICKY_NAMES = [
+    "John Smith", "  John   Smith  ", "Smith", " Smith ", "", "   ", "\t", None,
+    "María José García-López", "Jean\tPierre\nDupont", "Li\u00a0Wei", "Ana\u3000Pérez",
+    "A B C D E", "O'Connor Seán", "van der Berg, Anna", "Smith, John, Mary Jane Doe",
+    ",", ", ,", "John Smith,", " , Smith", "\u2003Zoë\u2009Ünal\u2003", "Name\x1cSeparated",
+    "Ðặng Thị Hương", "山田 太郎", "Emoji 🧬 Researcher", "x\u200by",
+]
+
+# Instituciones difíciles: todos los separadores, piezas vacías, solo puntos
+TRICKY_INSTS = [
+    "Harvard University", "Harvard University; MIT", "Dept. of Biology, Stanford University",
+    "Univ. of Oxford", "a;b,c", ";;", ",", ".", " ; ", "MIT;", ";MIT", "A , B ,, C",
+    "", "   ", None, "Inst\u00a0Pasteur; CNRS\u3000", "Dept. Medicine; Univ. Toronto, Canada",
+    "Karolinska Institutet.", "No separators here", "\tTabbed;\tInstitution\t",
+]
+
+# Corpus de listas de autores (incluye autores nulos y listas nulas/vacías)
+def author_corpus():
+    rows = []
+    for i, name in enumerate(TRICKY_NAMES):
+        inst = TRICKY_INSTS[i % len(TRICKY_INSTS)]
+        rows.append(([{"author_name": name, "author_inst": inst}], name))
+    for i, inst in enumerate(TRICKY_INSTS):
+        name = TRICKY_NAMES[i % len(TRICKY_NAMES)]
+        rows.append(([{"author_name": name, "author_inst": inst},
+                      None,
+                      {"author_name": "Second Author", "author_inst": inst}], name))
+    rows.append((None, None))
+    rows.append(([], ""))
+    return rows
+
+schema = StructType([
+    StructField("rel_authors", raw_rel_authors_schema, True),
+    StructField("author_name", StringType(), True),
+])
+
+# Los UDFs extract_* usan dict.get, por lo que reciben los autores como mapas
+# (como cuando el DataFrame se crea a partir de diccionarios)
+map_schema = StructType([
+    StructField("rel_authors", ArrayType(MapType(StringType(), StringType())), True),
+    StructField("author_name", StringType(), True),
+])
+
+# Pares (nombre, UDF anterior, expresión nativa). Los UDFs extract_* fallan en
+# Python con autores nulos o nombres nulos, así que se comparan sobre filas sin ellos.
+def comparisons():
+    return [
+        ("transform_nested_authors", lambda: transform_nested_authors_udf(col("rel_authors")),
+         lambda: transform_nested_authors_expr(col("rel_authors")), None),
+        ("extract_author_names", lambda: extract_author_names_udf(col("rel_authors")),
+         lambda: extract_author_names_expr(col("rel_authors")), "extract"),
+        ("extract_author_insts", lambda: extract_author_insts_udf(col("rel_authors")),
+         lambda: extract_author_insts_expr(col("rel_authors")), "extract"),
+    ]
+
+def extract_safe(row):
+    authors = row[0]
+    if authors is None:
+        return True
+    return all(a is not None and a["author_name"] is not None and a["author_inst"] is not None for a in authors)
+
+# Compara el JSON de cada fila producido por el UDF y por la expresión nativa.
+# Devuelve (filas comparadas, [(fila, udf, nativo)] de las que difieren)
+def parity_mismatches(spark, udf_column, native_column, subset):
+    rows = author_corpus()
+    if subset == "extract":
+        data = [row for row in rows if extract_safe(row)]
+        df = spark.createDataFrame(data, map_schema)
+    else:
+        data = rows
+        df = spark.createDataFrame(data, schema)
+    expected = [r.json for r in df.select(to_json(struct(udf_column().alias("v"))).alias("json")).collect()]
+    actual = [r.json for r in df.select(to_json(struct(native_column().alias("v"))).alias("json")).collect()]
+    return data, [(data[i], e, a) for i, (e, a) in enumerate(zip(expected, actual)) if e != a]
+
+def check_parity(spark):
+    failures = 0
+    for name, udf_column, native_column, subset in comparisons():
+        data, mismatches = parity_mismatches(spark, udf_column, native_column, subset)
+        status = "ok" if not mismatches else f"{len(mismatches)} DIFF"
+        print(f"parity {name:<28}{len(data):>6} rows  {status}")
+        for row, e, a in mismatches[:10]:
+            print(f"    input:    {row!r}\n    udf:      {e}\n    native:   {a}")
+        failures += len(mismatches)
+    return failures
+
+# Mide filas/segundo de cada versión sobre el corpus replicado (sink noop de Spark)
+def benchmark(spark, n_rows):
+    rows = author_corpus()
+    data = (rows * (n_rows // len(rows) + 1))[:n_rows]
+    df = spark.createDataFrame(data, schema).cache()
+    df.count()
+    # Sin autores nulos y como mapas para que los UDFs extract_* no fallen
+    map_df = spark.createDataFrame([r for r in data if extract_safe(r)], map_schema).cache()
+    map_df.count()
+    print(f"\n{'function':<28}{'udf rows/s':>14}{'native rows/s':>16}{'speedup':>10}")
+    for name, udf_column, native_column, subset in comparisons():
+        source = map_df if subset == "extract" else df
+        timings = []
+        for column in (udf_column, native_column):
+            start = time.perf_counter()
+            source.select(column().alias("v")).write.format("noop").mode("overwrite").save()
+            timings.append(time.perf_counter() - start)
+        count = source.count()
+        print(f"{name:<28}{count / timings[0]:>14.0f}{count / timings[1]:>16.0f}{timings[0] / timings[1]:>9.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Parity check and benchmark of the author transformations")
+    parser.add_argument("--rows", type=int, default=500000, help="Rows used by the benchmark")
+    parser.add_argument("--skip-benchmark", action="store_true", help="Only run the parity check")
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName("AuthorTransformBenchmark").master("local[*]").getOrCreate()
+    try:
+        failures = check_parity(spark)
+        if not args.skip_benchmark:
+            benchmark(spark, args.rows)
+    finally:
+        spark.stop()
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
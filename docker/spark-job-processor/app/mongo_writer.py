@@ -0,0 +1,473 @@
+import os
+import json
+import time
+import logging
+from collections import Counter
+from datetime import datetime, timezone
+import pymongo
+from pyspark import TaskContext
+from pyspark.sql import Row
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from common.dedup import open_dedup_index
+
+logger = logging.getLogger(__name__)
+
+# Environment variables
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_BULK_BATCH_SIZE = int(os.getenv("MONGO_BULK_BATCH_SIZE", "1000"))  # Operations per bulk_write
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "20"))
+BIORXIV_COLLECTION = os.getenv("BIORXIV_COLLECTION", "covid19")  # Key of the crawl high-water mark
+PROCESSED_QUERY_CHUNK = 1000  # File names per $in lookup of the completion state
+
+# Facets kept in the facet_counts collection, the same groups the API's
+# getFacets $facet computes: one count per document for these fields and one
+# per entity (by label) for "entities"
+FACET_FIELDS = ("category", "type", "author_name")
+FACET_META_ID = "_meta"
+ENTITY_POSTINGS_BATCH_SIZE = 1000  # Postings (or document key backfills) per bulk write when rebuilding
+
+# One pooled client per process, reused across files
+_client = None
+
+def get_mongo_client():
+    global _client
+    if _client is None:
+        _client = pymongo.MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
+        try:
+            # Index used by the rel_doi upserts (non unique: older data may hold duplicates)
+            _client.get_database().documents.create_index("rel_doi")
+            # Multikey index used by the API's entity filters (label, or label and normalized key)
+            _client.get_database().documents.create_index([("entities.label", 1), ("entities.key", 1)])
+        except PyMongoError as e:
+            logger.warning(f"Could not ensure the documents indexes: {e}")
+    return _client
+
+def close_mongo_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+# Advance the crawl high-water mark (latest ingested rel_date, yyyy-MM-dd) used by
+# the controller's incremental jobs, together with lastTotal: the article total
+# the controller planned the ingested jobs with (totalArticles in their job
+# documents). Both are written only once the articles are ingested, so an
+# incremental job planned before an earlier job is ingested still counts from
+# the previous high-water mark. $max keeps them monotonic across runs.
+def record_high_water_mark(max_rel_date, job_ids=()):
+    try:
+        db = get_mongo_client().get_database()
+        fields = {}
+        if max_rel_date:
+            fields["highWaterDate"] = max_rel_date
+        if job_ids:
+            totals = [job["totalArticles"] for job in db.jobs.find(
+                {"jobId": {"$in": sorted(set(job_ids))}, "totalArticles": {"$exists": True}}, {"totalArticles": 1})]
+            if totals:
+                fields["lastTotal"] = max(totals)
+        if not fields:
+            return
+        db.crawl_state.update_one({"_id": BIORXIV_COLLECTION}, {"$max": fields}, upsert=True)
+        logger.info(f"Crawl state for {BIORXIV_COLLECTION} is now at least {fields}")
+    except PyMongoError as e:
+        logger.error(f"Could not record high-water mark {max_rel_date}: {e}")
+
+# Completion state of the split files: one document per saved file in the
+# processed_splits collection, keyed (and indexed) by the file name
+def processed_collection():
+    return get_mongo_client().get_database().processed_splits
+
+# Returns which of the given files were already saved
+def find_processed(filenames):
+    filenames = list(filenames)
+    processed = set()
+    for i in range(0, len(filenames), PROCESSED_QUERY_CHUNK):
+        chunk = filenames[i:i + PROCESSED_QUERY_CHUNK]
+        processed.update(doc["_id"] for doc in processed_collection().find({"_id": {"$in": chunk}}, {"_id": 1}))
+    return processed
+
+# Records files as saved (idempotent)
+def mark_processed(filenames):
+    now = datetime.now(timezone.utc)
+    operations = [UpdateOne({"_id": filename}, {"$set": {"processedAt": now}}, upsert=True)
+                  for filename in filenames]
+    if operations:
+        processed_collection().bulk_write(operations, ordered=False)
+
+# Stores the stage timings of each saved split in its job document (trace.<splitNumber>)
+def record_split_traces(traces):
+    operations = [UpdateOne({"jobId": job_id}, {"$set": {f"trace.{split_number}": trace}})
+                  for (job_id, split_number), trace in traces.items()]
+    if not operations:
+        return
+    try:
+        get_mongo_client().get_database().jobs.bulk_write(operations, ordered=False)
+    except PyMongoError as e:
+        logger.error(f"Could not record the traces of {len(operations)} splits: {e}")
+
+# --- Materialized facet counts ---
+# facet_counts holds {facet, value, count} documents kept up to date with $inc
+# as documents are written, plus a meta document. When a write fails halfway the
+# counts can no longer be trusted: the meta document is marked stale, the API
+# falls back to the $facet aggregation and the driver rebuilds the counts.
+
+def facet_collection():
+    return get_mongo_client().get_database().facet_counts
+
+# Hashable key of a facet value (values are stored as they are in the documents)
+def facet_key(facet, value):
+    return facet, json.dumps(value, sort_keys=True, default=str)
+
+# Contribution of one document to the facet counts
+def facet_contributions(doc):
+    counts = Counter(facet_key(field, doc.get(field)) for field in FACET_FIELDS)
+    for entity in doc.get("entities") or []:
+        counts[facet_key("entities", entity.get("label") if isinstance(entity, dict) else None)] += 1
+    return counts
+
+# Projection of the fields that feed the facets
+FACET_PROJECTION = {field: 1 for field in FACET_FIELDS}
+FACET_PROJECTION.update({"rel_doi": 1, "entities.label": 1, "entities.text": 1, "entities.key": 1})
+
+def apply_facet_deltas(deltas):
+    operations = [UpdateOne({"facet": facet, "value": json.loads(value)}, {"$inc": {"count": count}}, upsert=True)
+                  for (facet, value), count in deltas.items() if count]
+    if operations:
+        facet_collection().bulk_write(operations, ordered=False)
+
+def mark_facets_stale():
+    try:
+        facet_collection().update_one({"_id": FACET_META_ID}, {"$set": {"stale": True}}, upsert=True)
+    except PyMongoError as e:
+        logger.error(f"Could not mark facet counts as stale: {e}")
+
+# Rebuilds facet_counts from the documents collection when it is missing or
+# stale. Runs on the driver before ingesting, while no partition is writing.
+def ensure_facet_counts():
+    collection = facet_collection()
+    meta = collection.find_one({"_id": FACET_META_ID})
+    if meta is not None and not meta.get("stale"):
+        return
+    start = time.perf_counter()
+    documents = get_mongo_client().get_database().documents
+    counts = []
+    for field in FACET_FIELDS:
+        counts.extend({"facet": field, "value": group["_id"], "count": group["count"]}
+                      for group in documents.aggregate([{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}],
+                                                       allowDiskUse=True))
+    counts.extend({"facet": "entities", "value": group["_id"], "count": group["count"]}
+                  for group in documents.aggregate([{"$unwind": "$entities"},
+                                                    {"$group": {"_id": "$entities.label", "count": {"$sum": 1}}}],
+                                                   allowDiskUse=True))
+    collection.create_index([("facet", 1), ("value", 1)], unique=True)
+    collection.create_index([("facet", 1), ("count", -1)])
+    collection.delete_many({"_id": {"$ne": FACET_META_ID}})
+    if counts:
+        collection.insert_many(counts, ordered=False)
+    collection.replace_one({"_id": FACET_META_ID},
+                           {"stale": False, "builtAt": datetime.now(timezone.utc)}, upsert=True)
+    logger.info(f"Rebuilt facet counts: {len(counts)} values in {time.perf_counter() - start:.2f} s")
+
+# --- Entity postings ---
+# entity_postings holds one document per (label, key, rel_doi): a document that
+# mentions a normalized entity, with a unique compound index. entity_counts
+# holds one document per entity {label, key, text, count} kept up to date with
+# $inc, which is what the API's entity facets read. Postings are upserted and
+# deleted one by one, so no document grows with the number of mentions. Like
+# facet_counts, a meta document (in entity_counts) marks both collections stale
+# when an update may have been lost and the driver rebuilds them.
+
+def entity_collection():
+    return get_mongo_client().get_database().entity_postings
+
+def entity_count_collection():
+    return get_mongo_client().get_database().entity_counts
+
+# Same normalization as the Spark entity_key_expr
+def entity_key(text):
+    return None if text is None else " ".join(text.split()).lower()
+
+# Normalized entities of a document as {(label, key): text}. Documents saved
+# before the normalization have no "key", it is computed from the text.
+def document_entities(doc):
+    entities = {}
+    for entity in doc.get("entities") or []:
+        if not isinstance(entity, dict):
+            continue
+        key = entity.get("key", entity_key(entity.get("text")))
+        entities.setdefault((entity.get("label"), key), entity.get("text"))
+    return entities
+
+def posting_operations(label, key, added, removed):
+    operations = []
+    for rel_doi in sorted(added):
+        posting = {"label": label, "key": key, "rel_doi": rel_doi}
+        operations.append(ReplaceOne(posting, posting, upsert=True))
+    for rel_doi in sorted(removed):
+        operations.append(DeleteOne({"label": label, "key": key, "rel_doi": rel_doi}))
+    return operations
+
+def entity_count_update(label, key, text, delta):
+    return UpdateOne({"label": label, "key": key}, {"$inc": {"count": delta}, "$setOnInsert": {"text": text}},
+                     upsert=True)
+
+# Adds and removes postings and updates the entity counts: changes is
+# {(label, key): {"text": ..., "added": set, "removed": set}}
+def apply_posting_changes(changes):
+    postings = []
+    counts = []
+    for (label, key), change in changes.items():
+        postings.extend(posting_operations(label, key, change["added"], change["removed"]))
+        delta = len(change["added"]) - len(change["removed"])
+        if delta:
+            counts.append(entity_count_update(label, key, change["text"], delta))
+    if postings:
+        entity_collection().bulk_write(postings, ordered=False)
+    if counts:
+        entity_count_collection().bulk_write(counts, ordered=False)
+
+def mark_entity_postings_stale():
+    try:
+        entity_count_collection().update_one({"_id": FACET_META_ID}, {"$set": {"stale": True}}, upsert=True)
+    except PyMongoError as e:
+        logger.error(f"Could not mark entity postings as stale: {e}")
+
+# Rebuilds entity_postings and entity_counts from the documents collection when
+# they are missing or stale. Runs on the driver before ingesting, while no
+# partition is writing. Postings are streamed in batches (only the counts are
+# kept in memory) and entities saved before the normalization get their "key",
+# so the API's (entities.label, entities.key) index filter finds them.
+def ensure_entity_postings():
+    counts_collection = entity_count_collection()
+    meta = counts_collection.find_one({"_id": FACET_META_ID})
+    if meta is not None and not meta.get("stale"):
+        return
+    start = time.perf_counter()
+    documents = get_mongo_client().get_database().documents
+    postings_collection = entity_collection()
+    # Dropping also removes the indexes of the old one-document-per-entity layout
+    postings_collection.drop()
+    postings_collection.create_index([("label", 1), ("key", 1), ("rel_doi", 1)], unique=True)
+    counts = {}
+    postings = []
+    backfills = []
+    def flush():
+        if postings:
+            postings_collection.insert_many(postings, ordered=False)
+            postings.clear()
+        if backfills:
+            documents.bulk_write(backfills, ordered=False)
+            backfills.clear()
+    for doc in documents.find({"entities.0": {"$exists": True}}, {"_id": 1, "rel_doi": 1, "entities": 1}):
+        entities = [entity for entity in doc["entities"] if isinstance(entity, dict)]
+        if any("key" not in entity for entity in entities):
+            backfills.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"entities": [
+                entity if "key" in entity else {**entity, "key": entity_key(entity.get("text"))}
+                for entity in entities]}}))
+        if doc.get("rel_doi") is not None:
+            for (label, key), text in document_entities(doc).items():
+                postings.append({"label": label, "key": key, "rel_doi": doc["rel_doi"]})
+                entity = counts.setdefault((label, key), {"label": label, "key": key, "text": text, "count": 0})
+                entity["count"] += 1
+        if len(postings) >= ENTITY_POSTINGS_BATCH_SIZE or len(backfills) >= ENTITY_POSTINGS_BATCH_SIZE:
+            flush()
+    flush()
+    counts_collection.create_index([("label", 1), ("key", 1)], unique=True)
+    counts_collection.create_index([("label", 1), ("count", -1)])
+    counts_collection.delete_many({"_id": {"$ne": FACET_META_ID}})
+    values = list(counts.values())
+    for i in range(0, len(values), ENTITY_POSTINGS_BATCH_SIZE):
+        counts_collection.insert_many(values[i:i + ENTITY_POSTINGS_BATCH_SIZE], ordered=False)
+    counts_collection.replace_one({"_id": FACET_META_ID},
+                                  {"stale": False, "builtAt": datetime.now(timezone.utc)}, upsert=True)
+    logger.info(f"Rebuilt entity postings: {len(values)} entities in {time.perf_counter() - start:.2f} s")
+
+# Empty counters for a writer or a batch
+def empty_stats():
+    return {"documents": 0, "batches": 0, "matched": 0, "modified": 0, "upserted": 0, "inserted": 0, "failed": 0,
+            "skipped": 0, "seconds": 0.0}
+
+class BulkUpserter:
+    """
+    Buffers document writes and sends them as unordered bulk_write batches.
+    Documents with rel_doi are upserted on rel_doi with $set (same as the
+    previous update_one calls); documents without it are inserted.
+    Repeated rel_doi values inside a batch are merged in arrival order, so
+    the unordered batch gives the same result as the sequential updates.
+    With track_facets the facet_counts and entity_postings collections are
+    updated with the difference between the stored and the written version
+    of each document.
+    """
+    def __init__(self, collection, batch_size=MONGO_BULK_BATCH_SIZE, label="", track_facets=False):
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.label = label
+        self.track_facets = track_facets
+        self.updates = {}
+        self.inserts = []
+        self.stats = empty_stats()
+        self.stats["batch_seconds"] = []  # Duration of each bulk_write, for the latency metrics
+
+    def add(self, doc):
+        self.stats["documents"] += 1
+        rel_doi = doc.get("rel_doi")
+        if rel_doi:
+            if rel_doi in self.updates:
+                self.updates[rel_doi].update(doc)
+            else:
+                self.updates[rel_doi] = dict(doc)
+        else:
+            self.inserts.append(doc)
+        if len(self.updates) + len(self.inserts) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        operations = [UpdateOne({"rel_doi": rel_doi}, {"$set": doc}, upsert=True)
+                      for rel_doi, doc in self.updates.items()]
+        operations.extend(InsertOne(doc) for doc in self.inserts)
+        changes = self.derived_changes() if self.track_facets and operations else None
+        self.updates = {}
+        self.inserts = []
+        if not operations:
+            return
+
+        batch = empty_stats()
+        batch["batches"] = 1
+        start = time.perf_counter()
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            batch["failed"] = len(details.get("writeErrors", []))
+            for error in details.get("writeErrors", [])[:5]:
+                logger.error(f"Bulk write error at operation {error.get('index')}: {error.get('errmsg')}")
+        except PyMongoError as e:
+            details = {}
+            batch["failed"] = len(operations)
+            logger.error(f"Bulk write of {len(operations)} operations failed: {e}")
+        batch["seconds"] = time.perf_counter() - start
+        batch["matched"] = details.get("nMatched", 0)
+        batch["modified"] = details.get("nModified", 0)
+        batch["upserted"] = details.get("nUpserted", 0)
+        batch["inserted"] = details.get("nInserted", 0)
+
+        logger.info(
+            f"Bulk write {self.label}: {len(operations)} ops in {batch['seconds'] * 1000:.0f} ms "
+            f"(upserted {batch['upserted']}, modified {batch['modified']}, "
+            f"inserted {batch['inserted']}, failed {batch['failed']})"
+        )
+        for key, value in batch.items():
+            self.stats[key] += value
+        self.stats["batch_seconds"].append(batch["seconds"])
+        if self.track_facets:
+            self.update_derived(changes, failed=batch["failed"])
+
+    def derived_changes(self):
+        """
+        Change in the facet counts and in the entity postings if every pending
+        operation succeeds, as (facet deltas, posting changes). None if the
+        stored versions of the documents can't be read.
+        """
+        deltas = Counter()
+        postings = {}
+        try:
+            previous = {doc["rel_doi"]: doc for doc in self.collection.find(
+                {"rel_doi": {"$in": list(self.updates)}}, FACET_PROJECTION)}
+        except PyMongoError as e:
+            logger.error(f"Could not read the stored facets of {len(self.updates)} documents: {e}")
+            return None
+        for rel_doi, doc in self.updates.items():
+            old = previous.get(rel_doi)
+            old_entities = {}
+            if old is not None:
+                deltas.subtract(facet_contributions(old))
+                old_entities = document_entities(old)
+                # $set keeps the stored fields the new version doesn't carry
+                doc = {**old, **doc}
+            deltas.update(facet_contributions(doc))
+            new_entities = document_entities(doc)
+            for entity in old_entities.keys() | new_entities.keys():
+                if (entity in old_entities) == (entity in new_entities):
+                    continue
+                change = postings.setdefault(entity, {"text": new_entities.get(entity, old_entities.get(entity)),
+                                                      "added": set(), "removed": set()})
+                change["added" if entity in new_entities else "removed"].add(rel_doi)
+        for doc in self.inserts:
+            # Documents without rel_doi have no id to list in the postings
+            deltas.update(facet_contributions(doc))
+        return deltas, postings
+
+    def update_derived(self, changes, failed):
+        if failed or changes is None:
+            # Unknown which operations were applied: the counts and postings must be rebuilt
+            mark_facets_stale()
+            mark_entity_postings_stale()
+            return
+        deltas, postings = changes
+        try:
+            apply_facet_deltas(deltas)
+        except PyMongoError as e:
+            logger.error(f"Could not update facet counts: {e}")
+            mark_facets_stale()
+        try:
+            apply_posting_changes(postings)
+        except PyMongoError as e:
+            logger.error(f"Could not update entity postings: {e}")
+            mark_entity_postings_stale()
+
+    def close(self):
+        """Flushes pending operations and returns the accumulated counters."""
+        self.flush()
+        return self.stats
+
+# Convert a Spark value into the document value to_json would have produced:
+# null struct fields are omitted, everything else is kept as is
+def to_document_value(value):
+    if isinstance(value, Row):
+        return {key: to_document_value(item) for key, item in value.asDict().items() if item is not None}
+    if isinstance(value, dict):
+        return {key: to_document_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_document_value(item) for item in value]
+    return value
+
+# Executor side writer: upserts the rows of one partition and returns its counters,
+# so the driver only receives one small dict per partition. When file_column is
+# given that column is not saved and the counters list the files it came from.
+# Documents identical to the last saved copy of their rel_doi (dedup index) are
+# skipped; the saved ones are recorded only if the whole partition was written.
+def write_partition(rows, file_column=None):
+    context = TaskContext.get()
+    label = f"partition {context.partitionId()}" if context else "partition"
+    writer = BulkUpserter(get_mongo_client().get_database().documents, label=label, track_facets=True)
+    dedup = open_dedup_index("spark")
+    files = set()
+    skipped = 0
+    for row in rows:
+        doc = to_document_value(row)
+        if file_column:
+            files.add(doc.pop(file_column, None))
+        if dedup is not None and dedup.seen(doc):
+            skipped += 1
+            continue
+        writer.add(doc)
+    stats = writer.close()
+    if dedup is not None:
+        if stats["failed"]:
+            dedup.discard()
+        else:
+            dedup.commit()
+        dedup.close()
+    stats["skipped"] = skipped
+    stats["files"] = sorted(f for f in files if f)
+    yield stats
+
+# Add up the counters returned by each partition
+def merge_stats(partition_stats):
+    total = empty_stats()
+    for stats in partition_stats:
+        for key in total:
+            total[key] += stats.get(key, 0)
+    return total
@@ -0,0 +1,28 @@
+import os
+import shutil
+import pytest
+
+# Paridad entre los UDFs de autores y sus expresiones nativas sobre el corpus de
+# benchmark_authors.py. Requiere pyspark (la imagen usa 3.3.0) y un runtime de Java.
+pytest.importorskip("pyspark")
+if not (os.environ.get("JAVA_HOME") or shutil.which("java")):
+    pytest.skip("Spark needs a Java runtime", allow_module_level=True)
+
+from pyspark.sql import SparkSession
+import app
+from benchmark_authors import comparisons, parity_mismatches
+
+@pytest.fixture(scope="module")
+def spark():
+    session = SparkSession.builder.appName("AuthorTransformParity").master("local[2]").getOrCreate()
+    # Los UDFs se serializan por referencia al módulo app, que los workers deben poder importar
+    app.add_py_files(session)
+    session.sparkContext.addPyFile(app.__file__)
+    yield session
+    session.stop()
+
+@pytest.mark.parametrize("name, udf_column, native_column, subset", comparisons(), ids=[c[0] for c in comparisons()])
+def test_native_expression_matches_udf(spark, name, udf_column, native_column, subset):
+    data, mismatches = parity_mismatches(spark, udf_column, native_column, subset)
+    assert data
+    assert mismatches == [], f"{name}: {len(mismatches)} rows differ, first: {mismatches[0]}"
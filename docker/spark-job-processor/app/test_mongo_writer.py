@@ -0,0 +1,108 @@
+import pytest
+
+# mongo_writer imports pyspark (TaskContext, Row) and pymongo at module level
+pytest.importorskip("pyspark")
+pytest.importorskip("pymongo")
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import mongo_writer
+from mongo_writer import BulkUpserter, facet_key
+
+class FakeResult:
+    def __init__(self, details):
+        self.bulk_api_result = details
+
+# In-memory stand-in for the documents collection: find() serves the stored
+# documents by rel_doi and bulk_write() records the operations it receives
+class FakeCollection:
+    def __init__(self, docs=(), error=None):
+        self.docs = {doc["rel_doi"]: doc for doc in docs}
+        self.error = error
+        self.batches = []
+
+    def find(self, query, projection=None):
+        return [self.docs[rel_doi] for rel_doi in query["rel_doi"]["$in"] if rel_doi in self.docs]
+
+    def bulk_write(self, operations, ordered=True):
+        self.batches.append(operations)
+        if self.error is not None:
+            raise self.error
+        updates = sum(isinstance(operation, UpdateOne) for operation in operations)
+        return FakeResult({"nMatched": 0, "nModified": 0, "nUpserted": updates,
+                           "nInserted": len(operations) - updates})
+
+@pytest.fixture
+def derived(monkeypatch):
+    calls = {"deltas": [], "postings": [], "stale": []}
+    monkeypatch.setattr(mongo_writer, "apply_facet_deltas", calls["deltas"].append)
+    monkeypatch.setattr(mongo_writer, "apply_posting_changes", calls["postings"].append)
+    monkeypatch.setattr(mongo_writer, "mark_facets_stale", lambda: calls["stale"].append("facets"))
+    monkeypatch.setattr(mongo_writer, "mark_entity_postings_stale", lambda: calls["stale"].append("entities"))
+    return calls
+
+def test_same_batch_updates_are_merged():
+    collection = FakeCollection()
+    writer = BulkUpserter(collection, batch_size=10)
+    writer.add({"rel_doi": "a", "rel_title": "Old", "category": "Genetics"})
+    writer.add({"rel_title": "No DOI"})
+    writer.add({"rel_doi": "a", "rel_title": "New"})
+    stats = writer.close()
+
+    [operations] = collection.batches
+    assert len(operations) == 2
+    update, insert = operations
+    assert isinstance(update, UpdateOne) and isinstance(insert, InsertOne)
+    # Later fields win, earlier ones the new version doesn't carry are kept
+    assert update._filter == {"rel_doi": "a"}
+    assert update._doc == {"$set": {"rel_doi": "a", "rel_title": "New", "category": "Genetics"}}
+    assert stats["documents"] == 3
+    assert stats["upserted"] == 1 and stats["inserted"] == 1 and stats["batches"] == 1
+
+def test_flushes_every_batch_size():
+    collection = FakeCollection()
+    writer = BulkUpserter(collection, batch_size=2)
+    for rel_doi in "abcde":
+        writer.add({"rel_doi": rel_doi})
+    assert writer.close()["batches"] == 3
+    assert [len(batch) for batch in collection.batches] == [2, 2, 1]
+
+def test_facet_deltas_and_posting_changes(derived):
+    stored = {"rel_doi": "a", "category": "Genetics", "type": "new results", "author_name": "Pérez, Ana",
+              "entities": [{"text": "WHO", "label": "ORG", "key": "who"}]}
+    collection = FakeCollection([stored])
+    writer = BulkUpserter(collection, batch_size=10, track_facets=True)
+    writer.add({"rel_doi": "a", "category": "Zoology",
+                "entities": [{"text": "Spain", "label": "GPE", "key": "spain"}]})
+    writer.add({"rel_doi": "b", "category": "Zoology", "type": "new results", "author_name": "Li, Wei",
+                "entities": [{"text": "WHO ", "label": "ORG", "key": "who"}]})
+    writer.add({"category": "Zoology"})
+    writer.close()
+
+    [deltas] = derived["deltas"]
+    expected = {
+        facet_key("category", "Genetics"): -1,
+        facet_key("category", "Zoology"): 3,
+        # "a" keeps its stored type and author through $set, "b" adds one of each
+        facet_key("type", "new results"): 1,
+        facet_key("type", None): 1,
+        facet_key("author_name", "Li, Wei"): 1,
+        facet_key("author_name", None): 1,
+        facet_key("entities", "GPE"): 1,
+    }
+    assert {key: count for key, count in deltas.items() if count} == expected
+    [postings] = derived["postings"]
+    assert postings == {
+        ("ORG", "who"): {"text": "WHO", "added": {"b"}, "removed": {"a"}},
+        ("GPE", "spain"): {"text": "Spain", "added": {"a"}, "removed": set()},
+    }
+    assert derived["stale"] == []
+
+def test_failed_batch_marks_derived_collections_stale(derived):
+    error = BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "duplicate key"}], "nInserted": 0})
+    writer = BulkUpserter(FakeCollection(error=error), track_facets=True)
+    writer.add({"rel_doi": "a", "category": "Genetics"})
+    stats = writer.close()
+    assert stats["failed"] == 1
+    assert derived["deltas"] == [] and derived["postings"] == []
+    assert sorted(derived["stale"]) == ["entities", "facets"]
@@ -79,7 +79,7 @@ const FacetFilters = ({ availableFacets, selectedFacets, onChange }) => {
     <div className="bg-white shadow-md rounded-lg p-4">
       <h2 className="text-lg font-bold mb-4">Filtros</h2>
       
-      {renderFacetGroup('entities.label', 'Entidades', availableFacets['entities.label'])}
+      {renderFacetGroup('entities', 'Entidades', availableFacets['entities'])}
       {renderFacetGroup('category', 'Categorías', availableFacets['category'])}
       {renderFacetGroup('type', 'Tipos', availableFacets['type'])}
       {renderFacetGroup('author_name', 'Autores', availableFacets['author_name'])}
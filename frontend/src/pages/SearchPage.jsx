@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useNavigate, useSearchParams } from 'react-router-dom';
 import { services } from '../services/api';
 import Header from '../components/layout/Header';
@@ -13,6 +13,9 @@ function SearchPage() {
   const [pagination, setPagination] = useState({ total: 0, page: 1, limit: 10, pages: 0 });
   const [facets, setFacets] = useState({});
   const [availableFacets, setAvailableFacets] = useState({});
+  // Cursores de paginación ya conocidos (número de página -> cursor) para la
+  // búsqueda actual; la API los usa para no recorrer las páginas anteriores
+  const cursors = useRef({ key: null, pages: {} });
   const navigate = useNavigate();
 
   // Extraer parámetros de búsqueda
@@ -46,6 +49,13 @@ function SearchPage() {
     
     try {
       const params = { q: query, page };
+      const searchKey = JSON.stringify([query, facets]);
+      if (cursors.current.key !== searchKey) {
+        cursors.current = { key: searchKey, pages: {} };
+      }
+      if (cursors.current.pages[page]) {
+        params.cursor = cursors.current.pages[page];
+      }
       
       // Añadir facets a la consulta
       Object.entries(facets).forEach(([key, values]) => {
@@ -57,6 +67,9 @@ function SearchPage() {
       const response = await services.documents.search(params);
       setResults(response.data.results);
       setPagination(response.data.pagination);
+      if (response.data.pagination.nextCursor) {
+        cursors.current.pages[page + 1] = response.data.pagination.nextCursor;
+      }
     } catch (error) {
       console.error('Error en búsqueda:', error);
     } finally {